@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+
+"""benchterm: Throughput benchmarks for lineterm terminal emulation
+
+Drives lineterm.Terminal with synthetic pty streams (generated from a fixed
+random seed, so that runs are reproducible) and with recorded streams
+(e.g., captured using "script -q typescript"). Each stream is run in a
+forked child process, to isolate peak memory measurements.
+
+Usage:
+    python benchterm.py                        # Run all synthetic streams
+    python benchterm.py -s plain,sgr -b 4      # Selected streams, 4 MB each
+    python benchterm.py -r typescript          # Recorded stream
+    python benchterm.py -o results.json        # Save results
+    python benchterm.py -c results.json        # Compare with saved results
+"""
+
+import json
+import optparse
+import os
+import random
+import resource
+import sys
+import time
+
+import lineterm
+
+COOKIE = "1234567890"
+TERM_WIDTH = 80
+TERM_HEIGHT = 25
+
+UPDATE_BYTES = 16384   # Bytes of pty data between screen updates (approximates UPDATE_INTERVAL)
+REGRESSION_PCT = 10    # Percentage slowdown in throughput reported as regression
+
+WORDS = ["graphterm", "lineterm", "notebook", "terminal", "pagelet", "cursor", "screen", "update",
+         "the", "a", "of", "and", "to", "in", "is", "for", "with", "on"]
+UNICODE_WORDS = [u"\u03b1\u03b2\u03b3", u"caf\xe9", u"\u65e5\u672c\u8a9e",
+                 u"na\xefve", u"\xfcber", u"\u0436\u0437\u0438", u"\u2603", u"\xa9\xae"]
+
+def text_line(rnd, width=TERM_WIDTH-1, words=WORDS):
+    line = []
+    length = 0
+    while length < width:
+        word = rnd.choice(words)
+        line.append(word)
+        length += len(word) + 1
+    return " ".join(line)[:width]
+
+def gen_plain(rnd, nbytes):
+    """Plain text flood, like cat of a large file"""
+    chunks = []
+    size = 0
+    while size < nbytes:
+        chunk = text_line(rnd) + "\r\n"
+        chunks.append(chunk)
+        size += len(chunk)
+    return "".join(chunks)
+
+def gen_sgr(rnd, nbytes):
+    """Heavy SGR color output, like ls --color or colored compiler output"""
+    chunks = []
+    size = 0
+    while size < nbytes:
+        words = []
+        for word in text_line(rnd).split():
+            words.append("\x1b[%d;%dm%s\x1b[0m" % (rnd.choice((0, 1, 4)), rnd.randint(30, 37), word))
+        chunk = " ".join(words) + "\r\n"
+        chunks.append(chunk)
+        size += len(chunk)
+    return "".join(chunks)
+
+def gen_curses(rnd, nbytes):
+    """Full-screen redraws in the alternate screen, like vim or top"""
+    chunks = ["\x1b[?1049h\x1b[1;%dr" % TERM_HEIGHT]
+    size = 0
+    while size < nbytes:
+        frame = ["\x1b[H\x1b[2J"]
+        for row in range(1, TERM_HEIGHT+1):
+            if rnd.random() < 0.5:
+                # Partial row redraw, as in top
+                frame.append("\x1b[%d;%dH\x1b[K%s" % (row, rnd.randint(1, 40), text_line(rnd, width=30)))
+            else:
+                frame.append("\x1b[%d;1H\x1b[7m%s\x1b[27m" % (row, text_line(rnd)))
+        frame.append("\x1b[%d;1H" % TERM_HEIGHT)
+        chunk = "".join(frame)
+        chunks.append(chunk)
+        size += len(chunk)
+    chunks.append("\x1b[?1049l")
+    return "".join(chunks)
+
+def gen_utf8(rnd, nbytes):
+    """Long UTF-8 lines, wrapping over several screen rows"""
+    chunks = []
+    size = 0
+    while size < nbytes:
+        chunk = text_line(rnd, width=8*TERM_WIDTH, words=UNICODE_WORDS+WORDS).encode("utf-8") + "\r\n"
+        chunks.append(chunk)
+        size += len(chunk)
+    return "".join(chunks)
+
+def gen_pagelet(rnd, nbytes):
+    """Pagelet-heavy gterm output, like repeated gls or gimage invocations"""
+    headers = json.dumps({"x_gterm_response": "pagelet", "x_gterm_parameters": {"display": "block"},
+                          "content_type": "text/html"})
+    chunks = []
+    size = 0
+    while size < nbytes:
+        rows = "".join("<tr><td>%s</td><td>%d</td></tr>" % (text_line(rnd, width=30), rnd.randint(0, 99999))
+                       for j in range(20))
+        chunk = "\x1b[?%d;%sh%s\n\n<table>%s</table>\x1b[?%dl\r\n" % (lineterm.GRAPHTERM_SCREEN_CODES[1], COOKIE,
+                                                                     headers, rows,
+                                                                     lineterm.GRAPHTERM_SCREEN_CODES[1])
+        chunks.append(chunk)
+        size += len(chunk)
+    return "".join(chunks)
+
+GENERATORS = [("plain", gen_plain), ("sgr", gen_sgr), ("curses", gen_curses),
+              ("utf8", gen_utf8), ("pagelet", gen_pagelet)]
+
+class Timer(object):
+    """Wraps method, accumulating call count and elapsed time"""
+    def __init__(self, method):
+        self.method = method
+        self.calls = 0
+        self.elapsed = 0.0
+
+    def __call__(self, *args, **kwargs):
+        start_time = time.time()
+        try:
+            return self.method(*args, **kwargs)
+        finally:
+            self.elapsed += time.time() - start_time
+            self.calls += 1
+
+def run_stream(name, data, chunk_bytes=lineterm.CHUNK_BYTES, update_bytes=UPDATE_BYTES):
+    """Feed data to a new terminal in pty-sized chunks; return dict of results"""
+    stats = {"updates": 0, "update_bytes": 0}
+    def screen_callback(term_name, response_id, command, arg):
+        if command in ("row_update", "graphterm_output"):
+            stats["updates"] += 1
+            stats["update_bytes"] += len(json.dumps(arg))
+
+    null_fd = os.open(os.devnull, os.O_WRONLY)
+    term = lineterm.Terminal("bench", null_fd, 0, screen_callback, height=TERM_HEIGHT, width=TERM_WIDTH,
+                             cookie=COOKIE, pdelim=["", ""])
+    write_timer = Timer(term.write)
+    scroll_timer = Timer(term.scroll_screen)
+    update_timer = Timer(term.screen_buf.update)
+    term.write = write_timer
+    term.scroll_screen = scroll_timer
+    term.screen_buf.update = update_timer
+
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_time = time.time()
+    pending = 0
+    for offset in xrange(0, len(data), chunk_bytes):
+        term.pty_read(data[offset:offset+chunk_bytes])
+        pending += chunk_bytes
+        if pending >= update_bytes and term.needs_updating:
+            term.update()
+            pending = 0
+    if term.needs_updating:
+        term.update()
+    elapsed = time.time() - start_time
+    os.close(null_fd)
+
+    mbytes = len(data) / 1.0e6
+    return {"stream": name, "bytes": len(data), "elapsed": elapsed,
+            "mb_per_sec": mbytes/elapsed if elapsed else 0.0,
+            "updates": stats["updates"],
+            "updates_per_sec": stats["updates"]/elapsed if elapsed else 0.0,
+            "bytes_per_update": stats["update_bytes"]/stats["updates"] if stats["updates"] else 0,
+            "write_sec": write_timer.elapsed, "scroll_sec": scroll_timer.elapsed, "scroll_calls": scroll_timer.calls,
+            "update_sec": update_timer.elapsed, "update_calls": update_timer.calls,
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "delta_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss}
+
+def run_forked(name, get_data, **kwargs):
+    """Run stream in child process, returning results dict"""
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if not pid:
+        # Child
+        os.close(rfd)
+        try:
+            result = run_stream(name, get_data(), **kwargs)
+        except Exception, excp:
+            result = {"stream": name, "error": str(excp)}
+        os.write(wfd, json.dumps(result))
+        os._exit(0)
+
+    os.close(wfd)
+    output = []
+    while True:
+        data = os.read(rfd, 65536)
+        if not data:
+            break
+        output.append(data)
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    return json.loads("".join(output))
+
+RESULT_FORMAT = "%-10s %8.2f %10.1f %10.0f %8.3f %8.3f %8.3f %10d"
+HEADER_FORMAT = "%-10s %8s %10s %10s %8s %8s %8s %10s"
+
+def print_results(results, baseline={}):
+    print HEADER_FORMAT % ("stream", "MB/s", "updates/s", "B/update", "write_s", "scroll_s", "update_s", "peak_kb")
+    for result in results:
+        if "error" in result:
+            print "%-10s ERROR %s" % (result["stream"], result["error"])
+            continue
+        line = RESULT_FORMAT % (result["stream"], result["mb_per_sec"], result["updates_per_sec"],
+                                result["bytes_per_update"], result["write_sec"], result["scroll_sec"],
+                                result["update_sec"], result["peak_rss_kb"])
+        prev = baseline.get(result["stream"])
+        if prev and prev.get("mb_per_sec"):
+            change = 100.0 * (result["mb_per_sec"] - prev["mb_per_sec"]) / prev["mb_per_sec"]
+            line += "  %+.1f%%" % change
+            if change < -REGRESSION_PCT:
+                line += " REGRESSION"
+        print line
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = optparse.OptionParser(usage="usage: %prog [-s stream1,...] [-r recorded_file] [-o output.json] [-c baseline.json]")
+    parser.add_option("-s", "--streams", dest="streams", default=",".join(name for name, gen in GENERATORS),
+                      help="Comma-separated synthetic streams (default: all)")
+    parser.add_option("-r", "--recorded", dest="recorded", action="append", default=[],
+                      help="Recorded pty stream file (may be repeated)")
+    parser.add_option("-b", "--mbytes", dest="mbytes", type="float", default=2.0,
+                      help="Megabytes of synthetic data per stream (default: 2)")
+    parser.add_option("", "--seed", dest="seed", type="int", default=1,
+                      help="Random seed for synthetic data (default: 1)")
+    parser.add_option("-o", "--output", dest="output", default="",
+                      help="Save results to JSON file")
+    parser.add_option("-c", "--compare", dest="compare", default="",
+                      help="Compare throughput with results from JSON file")
+    (options, args) = parser.parse_args(args)
+
+    generators = dict(GENERATORS)
+    streams = [name.strip() for name in options.streams.split(",") if name.strip()]
+    for name in streams:
+        if name not in generators:
+            parser.error("Invalid stream name: "+name)
+
+    nbytes = int(options.mbytes * 1000000)
+    results = []
+    for name in streams:
+        get_data = lambda gen=generators[name]: gen(random.Random(options.seed), nbytes)
+        results.append(run_forked(name, get_data))
+
+    for filepath in options.recorded:
+        def get_data(filepath=filepath):
+            with open(filepath) as f:
+                return f.read()
+        results.append(run_forked(os.path.basename(filepath), get_data))
+
+    baseline = {}
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = dict((result["stream"], result) for result in json.loads(f.read()))
+
+    print_results(results, baseline)
+
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(json.dumps(results, indent=1)+"\n")
+
+if __name__ == "__main__":
+    main()
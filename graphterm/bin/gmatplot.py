@@ -26,6 +26,11 @@ pylab.show(False)     # To display as new image
 gm.display(fig)       # To display figure
 gm.resize_win()       # To resize default image to fit window
 
+gm.stream(fps=10)     # Streaming mode for animated/live plots (skip unchanged
+                      # frames, throttle updates)
+gm.stream_flush()     # Display last frame, if skipped due to throttling
+gm.stream(0)          # Disable streaming mode
+
 Note: If setting up using gm.setup(nopatch=True),
  use gm.show(), gm.figure(), gm.draw() instead of pylab functions
 
@@ -33,12 +38,17 @@ Note: If setting up using gm.setup(nopatch=True),
 
 from __future__ import absolute_import, print_function
 
+import atexit
+import hashlib
 import time
+
 try:
     import gterm
 except ImportError:
     import graphterm.bin.gterm as gterm
 
+STREAM_FPS = 10           # Default maximum frame rate in streaming mode
+
 pyplot_dict = {}
 
 def setup(nopatch=False, figsize="4.0, 3.0"):
@@ -56,6 +66,10 @@ def setup(nopatch=False, figsize="4.0, 3.0"):
     pyplot_dict["new_cell"] = False
     pyplot_dict["new_plot"] = True
     pyplot_dict["drawing"] = False
+    pyplot_dict["stream_fps"] = 0
+    pyplot_dict["stream_time"] = 0
+    pyplot_dict["stream_digest"] = ""
+    pyplot_dict["stream_pending"] = None
     pyplot_dict["draw"] = matplotlib.pyplot.draw
     pyplot_dict["figure"] = matplotlib.pyplot.figure
     pyplot_dict["show"] = matplotlib.pyplot.show
@@ -121,14 +135,39 @@ def show(*args, **kwargs):
     outfile = kwargs.pop("outfile", "")
     title = kwargs.pop("title", "")
     fullscreen = kwargs.pop("fullscreen", False)
+    force = kwargs.pop("force", False)
 
     import matplotlib.pyplot as plt
-    retval = display(plt, overwrite=overwrite, format=format, outfile=outfile, title=title, fullscreen=fullscreen)
+    retval = display(plt, overwrite=overwrite, format=format, outfile=outfile, title=title, fullscreen=fullscreen,
+                     force=force)
     pyplot_dict["new_plot"] = False
     return retval
 
-def display(fig, overwrite=False, format="png", outfile="", title="", fullscreen=False, max_bytes=25000000):
+def stream(fps=STREAM_FPS):
+    """Enable streaming plot mode, for animated or live plots (disable, if fps is 0).
+    In streaming mode, figure updates (overwrites) are throttled to fps frames/sec,
+    and unchanged frames are skipped.
+    """
+    if not pyplot_dict:
+        raise Exception("gmatplot.setup not invoked")
+    if not fps:
+        stream_flush()
+    elif not pyplot_dict["stream_fps"]:
+        atexit.register(stream_flush)
+    pyplot_dict["stream_fps"] = fps
+    pyplot_dict["stream_digest"] = ""
+
+def stream_flush():
+    """Display last figure update, if it was skipped due to throttling in streaming mode"""
+    pending = pyplot_dict.get("stream_pending")
+    if pending:
+        fig, kwargs = pending
+        display(fig, force=True, **kwargs)
+
+def display(fig, overwrite=False, format="png", outfile="", title="", fullscreen=False, max_bytes=25000000,
+            force=False):
     """Save figure as a blob and display as block image
+    (In streaming mode, overwrites are throttled, unless force is true.)
     """
     if not pyplot_dict:
         raise Exception("gmatplot.setup not invoked")
@@ -137,6 +176,16 @@ def display(fig, overwrite=False, format="png", outfile="", title="", fullscreen
         fig.savefig(outfile, format=format)
         return
 
+    fps = pyplot_dict["stream_fps"]
+    if fps and overwrite and not pyplot_dict["new_cell"]:
+        if not force and time.time() - pyplot_dict["stream_time"] < 1.0/fps:
+            # Throttle frame
+            pyplot_dict["stream_pending"] = (fig, dict(overwrite=overwrite, format=format, title=title,
+                                                       fullscreen=fullscreen, max_bytes=max_bytes))
+            return
+        pyplot_dict["stream_pending"] = None
+        pyplot_dict["stream_time"] = time.time()
+
     content_type = "application/pdf" if format=="pdf" else "image/"+format
     outbuf = gterm.BlobBytesIO(max_bytes=max_bytes)
     pyplot_dict["drawing"] = True
@@ -154,8 +203,25 @@ def display(fig, overwrite=False, format="png", outfile="", title="", fullscreen
         #gterm.display_blockimg(blob_url, overwrite=overwrite, alt=title, toggle=True)
         #gterm.display_blob(gterm.get_blob_id(blob_url), overwrite=overwrite, toggle=True,
         #                   display="fullscreen" if fullscreen else "block")
-        gterm.display_data(content_type, fig_data, overwrite=overwrite, toggle=True,
-                           display="fullscreen" if fullscreen else "block")
+        if fps:
+            display_frame(content_type, fig_data, overwrite=overwrite, fullscreen=fullscreen)
+        else:
+            gterm.display_data(content_type, fig_data, overwrite=overwrite, toggle=True,
+                               display="fullscreen" if fullscreen else "block")
+
+def display_frame(content_type, fig_data, overwrite=False, fullscreen=False):
+    """Display figure data in streaming mode, skipping unchanged frames.
+    (Blobs are not re-used for earlier frames, because the host deletes
+    the blob of an overwritten image.)
+    """
+    digest = hashlib.md5(fig_data).hexdigest()
+    if overwrite and digest == pyplot_dict["stream_digest"]:
+        # Unchanged frame
+        return
+    pyplot_dict["stream_digest"] = digest
+
+    gterm.display_data(content_type, fig_data, overwrite=overwrite, toggle=True,
+                       display="fullscreen" if fullscreen else "block")
 
 
 def resize_win(dimensions=""):
@@ -200,17 +266,31 @@ def main():
     import matplotlib.pyplot as plt
     from optparse import OptionParser
 
-    usage = "usage: %prog [--animate]"
+    usage = "usage: %prog [--animate|--stream]"
     parser = OptionParser(usage=usage)
     parser.add_option("", "--animate",
                       action="store_true", dest="animate", default=False,
                       help="Simple animation demo")
+    parser.add_option("", "--stream",
+                      action="store_true", dest="stream", default=False,
+                      help="Streaming animation demo (periodic, throttled)")
 
     (options, args) = parser.parse_args()
 
     fmt = "png"
 
-    if options.animate:
+    if options.stream:
+        import math
+        stream()
+        plt.plot([0])
+        show(overwrite=False, format=fmt, title="Streaming animation")
+
+        for j in range(200):
+            time.sleep(0.02)
+            plt.clf()
+            plt.plot([math.sin(0.1*(j % 20) + 0.5*k) for k in range(20)])
+            show(overwrite=True, format=fmt)
+    elif options.animate:
         plt.plot([1,2,3,2,3,1])
         show(overwrite=False, format=fmt, title="Simple animation")
 
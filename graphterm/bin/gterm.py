@@ -13,6 +13,7 @@ from __future__ import absolute_import, print_function
 #    https://github.com/mitotic/graphterm
 
 import base64
+import contextlib
 import getpass
 import hashlib
 import hmac
@@ -22,6 +23,7 @@ import mimetypes
 import os
 import random
 import re
+import socket
 import stat
 import subprocess
 import sys
@@ -119,6 +121,10 @@ Path = env("PATH", lc=True)
 Shared_secret = env("SHARED_SECRET", lc=True)
 URL = env("URL", "http://localhost:%d" % DEFAULT_HTTP_PORT)
 Blob_server = env("BLOB_SERVER", "")
+Bulk_socket = env("BULK_SOCKET", "")   # Unix socket for binary bulk transfers (bypassing the pty)
+
+BULK_MIN_BYTES = 8192    # Minimum content size for using bulk transfer socket
+BULK_TIMEOUT = 60        # Timeout (sec) for bulk transfer replies
 
 Server_protocol, netloc, path, params, query, fragment = urlparse(URL)
 Server, _, Server_port = netloc.partition(":")
@@ -193,6 +199,7 @@ APP_OAUTH_FILENAME = "gterm_oauth.json"
 APP_GROUPS_FILENAME = "gterm_groups.json"
 APP_PREFS_FILENAME = "gterm_prefs.json"
 APP_SECRET_FILENAME = "gterm_secret"
+SUBMIT_INDEX_FILENAME = ".gterm_submissions.json"
 SIGN_SEP = "|"
 
 class MsgException(Exception):
@@ -335,6 +342,33 @@ def write_prefs(prefs_dict, user=""):
     prefs_file = write_param_file(prefs_dict, APP_PREFS_FILENAME, appdir=get_app_dir(user))
     return prefs_file, "Saved preferences" if prefs_file else "ERROR in saving prefs"
 
+def read_submissions(submit_dir):
+    """Return dict of submission entries from index file in submit_dir, keyed by filename.
+    Each entry is a dict with keys user, time, size, md5, count
+    """
+    index_path = os.path.join(submit_dir, SUBMIT_INDEX_FILENAME)
+    if not os.path.exists(index_path):
+        return {}
+    try:
+        with open(index_path) as f:
+            return json.loads(f.read())
+    except Exception as excp:
+        logging.error("Error in reading submission index %s: %s", index_path, excp)
+        return {}
+
+def write_submissions(submit_dir, submissions):
+    """Atomically write submission index file in submit_dir; return True on success"""
+    index_path = os.path.join(submit_dir, SUBMIT_INDEX_FILENAME)
+    tem_path = index_path + ".tmp"
+    try:
+        with open(tem_path, "w") as f:
+            f.write(json.dumps(submissions, separators=(",",":"), sort_keys=True)+"\n")
+        os.rename(tem_path, index_path)
+        return True
+    except Exception as excp:
+        logging.error("Error in writing submission index %s: %s", index_path, excp)
+        return False
+
 def compute_hmac(key, message, hex_digits=HEX_DIGITS):
     return hmac.new(to_bytes(key), to_bytes(message), digestmod=hashlib.sha256).hexdigest()[:hex_digits]
 
@@ -522,10 +556,73 @@ def display_data(content_type, content, overwrite=False, toggle=False, display="
     if exit_page:
         params += " exit_page=yes"
 
+    if len(content) >= BULK_MIN_BYTES and Bulk_socket and Host:
+        # Create blob using bulk transfer socket, and display it
+        blob_id, blob_url = make_blob_url()
+        headers = {"x_gterm_response": "create_blob",
+                   "x_gterm_parameters": {"blob": blob_id},
+                   "content_type": content_type}
+        if bulk_send(headers, content):
+            display_blob(blob_id, overwrite=overwrite, toggle=toggle, display=display, exit_page=exit_page, stderr=stderr)
+            return
+
     html = '<!--gterm data %s-->%s;base64,%s' % (params, content_type, base64.b64encode(content))
         
     raw_wrap_write(html, stderr=stderr)
 
+def bulk_connect(timeout=BULK_TIMEOUT):
+    """Return (socket, reader) connected to the bulk transfer socket, or (None, None) if not available"""
+    if not Bulk_socket or not Cookie or Export_host or not hasattr(socket, "AF_UNIX"):
+        return (None, None)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(Bulk_socket)
+    except Exception as excp:
+        sock.close()
+        logging.warning("Bulk transfer connect failed: %s", excp)
+        return (None, None)
+    return (sock, sock.makefile("rb"))
+
+def bulk_request(sock, reader, headers, content=b""):
+    """Send request over bulk transfer connection, returning (status_dict, reply_content).
+    Reply content, if any, follows the status line and is status["content_length"] bytes long.
+    """
+    content = to_bytes(content)
+    headers = dict(headers, content_length=len(content))
+    sock.sendall(to_bytes(Cookie + " " + json.dumps(headers) + "\n") + content)
+    reply = reader.readline()
+    if not reply.endswith(b"\n"):
+        raise Exception("Bulk transfer connection closed")
+    status = json.loads(reply.decode("utf-8"))
+    reply_content = b""
+    if status.get("content_length"):
+        reply_content = reader.read(status["content_length"])
+        if len(reply_content) != status["content_length"]:
+            raise Exception("Bulk transfer reply truncated")
+    return (status, reply_content)
+
+def bulk_send(headers, content):
+    """Send raw content, with headers, over the bulk transfer socket, bypassing the pty.
+    Returns True on success (False if the socket is not available)
+    """
+    sock, reader = bulk_connect()
+    if not sock:
+        return False
+    try:
+        try:
+            status, reply_content = bulk_request(sock, reader, headers, content)
+        finally:
+            reader.close()
+            sock.close()
+        if status.get("status") != "ok":
+            logging.warning("Bulk transfer failed: %s", status.get("error"))
+            return False
+        return True
+    except Exception as excp:
+        logging.warning("Bulk transfer failed: %s", excp)
+        return False
+
 def display_blob(blob_id="", overwrite=False, toggle=False, display="block", exit_page=False, stderr=False):
     """Display blob image, overwriting previous image, if desired.
     toggle allows images to be hidden by clicking.
@@ -796,6 +893,11 @@ def create_blob(content=None, from_file="", content_type="", blob_id="", host=""
                "x_gterm_parameters": params,
                "content_type": content_type or ""}
 
+    if content is not None and len(content) >= BULK_MIN_BYTES and Bulk_socket:
+        # (Local files are read directly by the terminal, and need not be transferred)
+        if bulk_send(headers, content):
+            return blob_url
+
     wrap_encoded_file_or_data(filepath, content=content, headers=headers, stderr=stderr)
     return blob_url
     
@@ -1104,35 +1206,53 @@ def set_tty_echo(fd, enabled):
         tem_settings[3] &= ~termios.ECHO
     termios.tcsetattr(fd, termios.TCSADRAIN, tem_settings)
 
-CHUNK_BYTES = 4096
-def receive_data(stderr=False, binary=False, verbose=False):
-    """Receive from client via stdin, returning (errmsg, headers, content)"""
-    saved_stdin = sys.stdin.fileno()
-    saved_settings = termios.tcgetattr(saved_stdin)
+CHUNK_BYTES = 65536
+
+@contextlib.contextmanager
+def raw_stdin():
+    """Context for raw tty input without echo (e.g., for multiple calls to receive_data with raw=True)"""
+    fd = sys.stdin.fileno()
+    saved_settings = termios.tcgetattr(fd)
+    try:
+        tty.setraw(fd)
+        yield fd
+    finally:
+        termios.tcsetattr(fd, termios.TCSADRAIN, saved_settings)
+
+def receive_data(stderr=False, binary=False, verbose=False, outfile=None, raw=False):
+    """Receive from client via stdin, returning (errmsg, headers, content)
+    If outfile is specified, decoded content is written to it (and returned content is None).
+    If raw, stdin is assumed to be already in raw mode (see raw_stdin).
+    """
+    if raw:
+        return _receive_data(sys.stdin.fileno(), stderr=stderr, binary=binary, verbose=verbose, outfile=outfile)
+    with raw_stdin() as fd:
+        return _receive_data(fd, stderr=stderr, binary=binary, verbose=verbose, outfile=outfile)
 
+def _receive_data(fd, stderr=False, binary=False, verbose=False, outfile=None):
     try:
-        # Raw tty input without echo
-        tty.setraw(saved_stdin)
-        line = ""
-        header_line = ""
+        # Read blocks of input, until the blank line terminating the (multi-line) JSON header
+        buf = b""
         header_start = False
         while True:
-            ch = sys.stdin.read(1)
-            if ch == "\x03" or ch == "\x04": # ^C/^D
-                return ("Interrupted", None, None)
+            data = os.read(fd, CHUNK_BYTES)
+            if not data:
+                return ("EOF", None, None)
+            buf += data
             if not header_start:
-                if ch == "{":
-                    header_start = True
-                    line = ch
-                continue
-            if ch != "\n":
-                line += ch
-                continue
-            if line:
-                header_line += line
-                line = ""
-            else:
-                # Terminal null line
+                offset = buf.find(b"{")
+                skipped = buf if offset < 0 else buf[:offset]
+                if b"\x03" in skipped or b"\x04" in skipped: # ^C/^D
+                    return ("Interrupted", None, None)
+                if offset < 0:
+                    buf = b""
+                    continue
+                header_start = True
+                buf = buf[offset:]
+            offset = buf.find(b"\n\n")
+            if offset >= 0:
+                header_line = buf[:offset].replace(b"\n", b"").decode("utf-8")
+                buf = buf[offset+2:]
                 break
 
         if verbose and not stderr:
@@ -1144,6 +1264,9 @@ def receive_data(stderr=False, binary=False, verbose=False):
 
         headers = json.loads(header_line)
 
+        if headers.get("x_gterm_error"):
+            return (headers["x_gterm_error"], headers, None)
+
         content_type = headers.get("content_type", "")
         if content_type.startswith("none/"):
             return ("Null content", None, None)
@@ -1162,29 +1285,35 @@ def receive_data(stderr=False, binary=False, verbose=False):
 
         count = expect_length
         assert not (count % 4)
-        prefix = ""
-        content_list = bytearray()
+        prefix = b""
+        content_list = []
         digest_buf = hashlib.md5()
         while count > 0:
-            chunk = sys.stdin.read(min(count, CHUNK_BYTES))
-            assert chunk
+            if buf:
+                chunk, buf = buf[:count], b""
+            else:
+                chunk = os.read(fd, min(count, CHUNK_BYTES))
+            if not chunk:
+                return ("EOF", headers, None)
             count = count - len(chunk)
+            digest_buf.update(chunk)
             line = prefix + chunk
-            prefix = ""
             offset = len(line) % 4
-            if offset:
-                prefix = line[-offset:]
-                line = line[:-offset]
+            prefix = line[len(line)-offset:]
+            line = line[:len(line)-offset]
             if verbose and not stderr:
-                print("line(%d,%s)=%s" % (len(chunk), count, line,), file=sys.stderr)
-            line_bytes = line.encode()
-            digest_buf.update(line_bytes)
-            content_list.extend(base64.b64decode(line_bytes))
+                print("line(%d,%s)" % (len(chunk), count), file=sys.stderr)
+            if outfile is not None:
+                outfile.write(base64.b64decode(line))
+            else:
+                content_list.append(base64.b64decode(line))
         assert not prefix
         if digest_buf.hexdigest() != md5_digest:
             return ("MD5 digest mismatch", headers, None)
+        elif outfile is not None:
+            return ("", headers, None)
         else:
-            content = bytes(content_list)
+            content = b"".join(content_list)
             if not binary and not isinstance(content, str):
                 content = content.decode()
             return ("", headers, content)
@@ -1192,8 +1321,100 @@ def receive_data(stderr=False, binary=False, verbose=False):
         if verbose and not stderr:
             print("receive_data: ERROR %s" % excp, file=sys.stderr)
         return (str(excp), None, None)
-    finally:
-        termios.tcsetattr(saved_stdin, termios.TCSADRAIN, saved_settings)
+
+class PartialFile(object):
+    """File written in chunks, possibly out of order and by multiple threads, that can be
+    resumed after an interrupted transfer. Data is written to filepath+PARTIAL_SUFFIX,
+    with a log of completed chunks in filepath+PARTIAL_SUFFIX+".log". The first log line
+    is the JSON source info (which must match for resuming) and each following line has
+    the index and MD5 digest of a completed chunk. On resuming, completed chunks are
+    re-verified against their digests.
+    """
+    PARTIAL_SUFFIX = ".gtpart"
+    def __init__(self, filepath, size, chunk_size, source_info={}):
+        self.filepath = filepath
+        self.size = size
+        self.chunk_size = chunk_size
+        self.nchunks = (size + chunk_size - 1) // chunk_size
+        self.part_path = filepath + self.PARTIAL_SUFFIX
+        self.log_path = self.part_path + ".log"
+        self.info = dict(source_info, size=size, chunk_size=chunk_size)
+        self.lock = threading.Lock()
+        self.digests = {}
+
+        if self.read_log():
+            self.datafile = open(self.part_path, "r+b")
+            self.verify()
+        else:
+            self.datafile = open(self.part_path, "wb")
+        self.datafile.truncate(size)
+        self.logfile = open(self.log_path, "a" if self.digests else "w")
+        if not self.digests:
+            self.logfile.write(json.dumps(self.info, sort_keys=True)+"\n")
+            self.logfile.flush()
+
+    def read_log(self):
+        """Read log of completed chunks; return True if transfer can be resumed"""
+        if not os.path.exists(self.part_path) or not os.path.exists(self.log_path):
+            return False
+        try:
+            with open(self.log_path) as f:
+                lines = f.read().splitlines()
+            if not lines or json.loads(lines[0]) != json.loads(json.dumps(self.info)):
+                return False
+            for line in lines[1:]:
+                comps = line.split()
+                if len(comps) == 2 and comps[0].isdigit() and int(comps[0]) < self.nchunks:
+                    self.digests[int(comps[0])] = comps[1]
+            return True
+        except Exception:
+            return False
+
+    def verify(self):
+        """Discard completed chunks whose content does not match the logged digest"""
+        for index in sorted(self.digests.keys()):
+            offset, size = self.chunk_range(index)
+            self.datafile.seek(offset)
+            if hashlib.md5(self.datafile.read(size)).hexdigest() != self.digests[index]:
+                del self.digests[index]
+
+    def chunk_range(self, index):
+        """Return (offset, size) for chunk"""
+        offset = index * self.chunk_size
+        return (offset, min(self.chunk_size, self.size - offset))
+
+    def completed_bytes(self):
+        return sum(self.chunk_range(index)[1] for index in self.digests)
+
+    def missing(self):
+        """Return list of indices of chunks yet to be written"""
+        return [index for index in range(self.nchunks) if index not in self.digests]
+
+    def write_chunk(self, index, data):
+        offset, size = self.chunk_range(index)
+        if len(data) != size:
+            raise Exception("Chunk %d size mismatch: %d != %d" % (index, len(data), size))
+        digest = hashlib.md5(data).hexdigest()
+        with self.lock:
+            self.datafile.seek(offset)
+            self.datafile.write(data)
+            self.datafile.flush()
+            self.digests[index] = digest
+            self.logfile.write("%d %s\n" % (index, digest))
+            self.logfile.flush()
+
+    def close(self):
+        with self.lock:
+            self.datafile.close()
+            self.logfile.close()
+
+    def complete(self):
+        """Rename completed file to final path, deleting log"""
+        self.close()
+        if len(self.digests) != self.nchunks:
+            raise Exception("Incomplete file %s: %d of %d chunks" % (self.part_path, len(self.digests), self.nchunks))
+        os.rename(self.part_path, self.filepath)
+        os.remove(self.log_path)
 
 def getuid(pid):
     """Return uid of running process"""
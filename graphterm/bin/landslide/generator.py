@@ -19,23 +19,87 @@
 import os
 import re
 import codecs
+import cPickle
+import hashlib
 import inspect
 import jinja2
+import json
+import multiprocessing
 import shutil
 import tempfile
+import time
 import utils
+import uuid
 import ConfigParser
 
 from subprocess import Popen
 
 import macro as macro_module
-from parser import Parser
+from parser import Parser, SUPPORTED_FORMATS
 
 
 BASE_DIR = os.path.dirname(__file__)
 THEMES_DIR = os.path.join(BASE_DIR, 'themes')
 TOC_MAX_LEVEL = 2
 VALID_LINENOS = ('no', 'inline', 'table')
+CACHE_VERSION = 1        # Increment to invalidate existing render caches
+CACHE_DIRNAME = 'landslide_cache'  # Render cache directory (in graphterm app directory)
+POOL_MIN_JOBS = 8        # Minimum number of uncached files/slides for using process pool
+WATCH_INTERVAL = 0.5     # Polling interval (sec) for source changes in watch mode
+
+# Embedded images repeated in the presentation (and at least this long) are
+# stored only once, in a list used by a script to set the image sources
+SHARED_IMAGE_MIN_BYTES = 1024
+BLANK_IMAGE_URL = u"data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7"
+EMBEDDED_IMG_RE = re.compile(r'\bsrc="(data:[^"]+)"', re.UNICODE)
+BACKGROUND_URL_RE = re.compile(r'(\s+background(?:-image)?:\surl\()(.+?)(?=\).+;)',
+                               re.DOTALL | re.UNICODE)
+
+SHARED_IMAGES_SCRIPT = u"""<script>
+(function() {
+    var images = %s;
+    var elements = document.querySelectorAll('img[data-landslide-image]');
+    for (var j = 0; j < elements.length; j++)
+        elements[j].src = images[parseInt(elements[j].getAttribute('data-landslide-image'))];
+})();
+</script>
+"""
+
+# Script added to presentation in watch mode, which reloads the presentation
+# whenever the version script (re-written after each rebuild) changes
+WATCH_SCRIPT = u"""<script>
+(function() {
+    var version = %(version)d;
+    window.landslideVersion = function(newVersion) {
+        if (newVersion != version) window.location.reload();
+    };
+    setInterval(function() {
+        var script = document.createElement('script');
+        script.src = '%(url)s?t=' + new Date().getTime();
+        script.onload = script.onerror = function() { script.parentNode.removeChild(script); };
+        document.body.appendChild(script);
+    }, %(interval)d);
+})();
+</script>
+"""
+
+# Generator whose slides are being rendered by the process pool (inherited by
+# the forked worker processes, so that the generator need not be pickled)
+_pool_generator = None
+
+
+def _parse_worker(args):
+    """ Parses file contents in a pool worker; returns list of slide sources.
+    """
+    return _pool_generator.parse_contents(*args)
+
+
+def _slide_worker(args):
+    """ Computes slide vars in a pool worker; returns (slide_vars, log messages).
+    """
+    messages = []
+    _pool_generator.logger = lambda message, type='notice': messages.append((message, type))
+    return _pool_generator.get_slide_vars(*args), messages
 
 
 class Generator(object):
@@ -67,6 +131,8 @@ class Generator(object):
             - ``embed``: generates a standalone document, with embedded assets
             - ``encoding``: the encoding to use for this presentation
             - ``extensions``: Comma separated list of markdown extensions
+            - ``cache``: cache rendered slides (in graphterm app directory)
+            - ``jobs``: number of processes for rendering (0 for cpu count)
             - ``logger``: a logger lambda to use for logging
             - ``relative``: enable relative asset urls
             - ``theme``: path to the theme to use for this presentation
@@ -80,6 +146,8 @@ class Generator(object):
         self.embed = kwargs.get('embed', False)
         self.encoding = kwargs.get('encoding', 'utf8')
         self.extensions = kwargs.get('extensions', None)
+        self.cache = kwargs.get('cache', False)
+        self.jobs = kwargs.get('jobs', 1)
         self.logger = kwargs.get('logger', None)
         self.relative = kwargs.get('relative', False)
         self.theme = kwargs.get('theme', 'default')
@@ -87,6 +155,11 @@ class Generator(object):
         self.linenos = self.linenos_check(kwargs.get('linenos'))
         self.num_slides = 0
         self.__toc = []
+        self.template = None
+        self.slide_cache = None   # In-memory render cache (in watch mode)
+        self.watch_files = []
+        self.watch_version = 0
+        self.watch_url = ''
 
         # macros registering
         self.macros = []
@@ -94,7 +167,9 @@ class Generator(object):
 
         if self.direct:
             # Only output html in direct output mode, not log messages
+            # (and do not cache, because there is no destination file)
             self.verbose = False
+            self.cache = False
 
         if source and not os.path.exists(source) and not os.path.isabs(source):
             # Look in graphterm/docs directory
@@ -218,26 +293,85 @@ class Generator(object):
         return os.path.join(default_dir, 'base.html')
 
     def fetch_contents(self, source):
-        """ Recursively fetches Markdown contents from a single file or
-            directory containing itself Markdown files.
+        """ Fetches Markdown contents from a single file or directory
+            containing itself Markdown files, and computes the slide vars.
+            Slides are looked up in the render cache (if enabled), and
+            uncached files and slides are processed in parallel.
         """
+        if self.slide_cache is not None:
+            cache = self.slide_cache
+        else:
+            cache = self.read_cache() if self.cache else {}
+        new_cache = {}
+
+        files = self.fetch_sources(source)
+        self.watch_files = [filepath for filepath, parser, file_contents in files]
+
+        # Parse files
+        file_keys = [self.get_cache_key(parser.format, parser.md_extensions,
+                                        file_contents)
+                     for filepath, parser, file_contents in files]
+        parse_args = [(parser, file_contents)
+                      for (filepath, parser, file_contents), key in zip(files, file_keys)
+                      if key not in cache]
+        parsed = iter(self.map_jobs(_parse_worker, parse_args))
+        for key in file_keys:
+            new_cache[key] = cache[key] if key in cache else parsed.next()
+
+        # Compute slide vars for inner slides
+        inner_slides = []
+        for (filepath, parser, file_contents), key in zip(files, file_keys):
+            inner_slides.extend((inner_slide, filepath)
+                                for inner_slide in new_cache[key])
+
+        slide_keys = [self.get_slide_key(inner_slide, filepath)
+                      for inner_slide, filepath in inner_slides]
+        slide_args = [args for args, key in zip(inner_slides, slide_keys)
+                      if key not in cache]
+        rendered = iter(self.map_jobs(_slide_worker, slide_args))
         slides = []
+        for key in slide_keys:
+            if key not in cache:
+                slide_vars, messages = rendered.next()
+                if self.logger:
+                    for message, type in messages:
+                        self.logger(message, type)
+                cache[key] = slide_vars
+            new_cache[key] = cache[key]
+            slides.append(cache[key])
+
+        if self.slide_cache is not None:
+            self.slide_cache = new_cache
+        if self.cache or self.slide_cache is not None:
+            self.log(u"Rendered %d of %d slides (%d cached)"
+                     % (len(slide_args), len(slides), len(slides)-len(slide_args)))
+        if self.cache:
+            self.write_cache(new_cache)
+
+        return slides
+
+    def fetch_sources(self, source):
+        """ Recursively fetches Markdown contents from a single file or
+            directory containing itself Markdown files. Returns list of
+            ``(filepath, parser, file_contents)`` tuples.
+        """
+        files = []
 
         if type(source) is list:
             for entry in source:
-                slides.extend(self.fetch_contents(entry))
+                files.extend(self.fetch_sources(entry))
         elif os.path.isdir(source):
             self.log(u"Entering %s" % source)
             entries = os.listdir(source)
             entries.sort()
             for entry in entries:
-                slides.extend(self.fetch_contents(os.path.join(source, entry)))
+                files.extend(self.fetch_sources(os.path.join(source, entry)))
         else:
             try:
                 parser = Parser(os.path.splitext(source)[1], self.encoding,
                     self.extensions)
             except NotImplementedError:
-                return slides
+                return files
 
             self.log(u"Adding   %s (%s)" % (source, parser.format))
 
@@ -248,14 +382,107 @@ class Generator(object):
                 self.log(u"Unable to decode source %s: skipping" % source,
                          'warning')
             else:
-                inner_slides = re.split(r'<hr.+>', parser.parse(file_contents))
-                for inner_slide in inner_slides:
-                    slides.append(self.get_slide_vars(inner_slide, source))
+                files.append((source, parser, file_contents))
 
-        if not slides:
+        if not files:
             self.log(u"Exiting  %s: no contents found" % source, 'notice')
 
-        return slides
+        return files
+
+    def parse_contents(self, parser, file_contents):
+        """ Parses file contents, returning list of html slide sources.
+        """
+        return re.split(r'<hr.+>', parser.parse(file_contents))
+
+    def map_jobs(self, worker, args_list):
+        """ Applies pool worker function to list of arguments, using a
+            process pool if there are enough jobs.
+        """
+        global _pool_generator
+        jobs = self.jobs or multiprocessing.cpu_count()
+        logger = self.logger
+        _pool_generator = self
+        try:
+            if jobs <= 1 or len(args_list) < POOL_MIN_JOBS:
+                return [worker(args) for args in args_list]
+            pool = multiprocessing.Pool(min(jobs, len(args_list)))
+            try:
+                return pool.map(worker, args_list,
+                                chunksize=1 + len(args_list) // (4*jobs))
+            finally:
+                pool.terminate()
+        finally:
+            _pool_generator = None
+            self.logger = logger
+
+    def get_cache_file(self):
+        """ Returns path of render cache file for destination file, in the
+            graphterm app directory (or null string, if not available).
+        """
+        if not utils.gterm:
+            return ''
+        dest_key = hashlib.sha1(os.path.abspath(self.destination_file)).hexdigest()
+        return os.path.join(utils.gterm.App_dir, CACHE_DIRNAME, '%s.cache' % dest_key)
+
+    def get_cache_key(self, *values):
+        """ Returns cache key string for a tuple of values.
+        """
+        return hashlib.sha1(repr((CACHE_VERSION,) + values)).hexdigest()
+
+    def get_slide_key(self, slide_src, source):
+        """ Returns cache key for slide vars, computed from slide source,
+            theme and options (including any images to be embedded).
+        """
+        images = []
+        if self.embed:
+            source_dir = os.path.dirname(source)
+            for image_url in re.findall(r'<img\s.*?src="(.+?)"', slide_src,
+                                        re.DOTALL | re.UNICODE):
+                try:
+                    stat = os.stat(os.path.join(source_dir, image_url))
+                    images.append((image_url, stat.st_mtime, stat.st_size))
+                except (OSError, UnicodeError):
+                    images.append((image_url, None, None))
+
+        return self.get_cache_key(slide_src, os.path.abspath(source),
+                                  utils.get_path_url(source, self.relative),
+                                  self.theme, self.embed, self.relative,
+                                  self.linenos, images,
+                                  [(m.__module__, m.__name__) for m in self.macros])
+
+    def read_cache(self):
+        """ Returns render cache dict (empty, if no valid cache file).
+        """
+        cache_file = self.get_cache_file()
+        if not cache_file or not os.path.exists(cache_file):
+            return {}
+        try:
+            with open(cache_file, 'rb') as f:
+                cache = cPickle.load(f)
+            if isinstance(cache, dict):
+                return cache
+        except Exception, e:
+            self.log(u"Unable to read cache file %s: %s" % (cache_file, e),
+                     'warning')
+        return {}
+
+    def write_cache(self, cache):
+        """ Writes render cache dict (atomically) to cache file.
+        """
+        cache_file = self.get_cache_file()
+        if not cache_file:
+            return
+        try:
+            cache_dir = os.path.dirname(cache_file)
+            if not os.path.exists(cache_dir):
+                os.makedirs(cache_dir, 0700)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(cache_file))
+            with os.fdopen(fd, 'wb') as f:
+                cPickle.dump(cache, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(temp_path, cache_file)
+        except Exception, e:
+            self.log(u"Unable to write cache file %s: %s" % (cache_file, e),
+                     'warning')
 
     def find_theme_dir(self, theme, copy_theme=False):
         """ Finds them dir path from its name.
@@ -468,32 +695,168 @@ class Generator(object):
     def render(self):
         """ Returns generated html code.
         """
-        template_src = codecs.open(self.template_file, encoding=self.encoding)
-        template = jinja2.Template(template_src.read())
+        if not self.template:
+            template_src = codecs.open(self.template_file, encoding=self.encoding)
+            self.template = jinja2.Template(template_src.read())
+        self.num_slides = 0
+        self.__toc = []
         slides = self.fetch_contents(self.source)
         context = self.get_template_vars(slides)
 
-        html = template.render(context)
-
-        if self.embed:
-            images = re.findall(r'\s+background(?:-image)?:\surl\((.+?)\).+;',
-                            html, re.DOTALL | re.UNICODE)
+        html = self.template.render(context)
 
-            for img_url in images:
-                img_url = img_url.replace('"', '').replace("'", '')
+        if self.watch_url:
+            html = html.replace(u'</body>', WATCH_SCRIPT % {
+                'version': self.watch_version, 'url': self.watch_url,
+                'interval': int(1000*WATCH_INTERVAL)} + u'</body>', 1)
 
-                source = os.path.join(THEMES_DIR, self.theme, 'css')
+        if self.embed:
+            source = os.path.join(THEMES_DIR, self.theme, 'css')
 
+            def embed_background(match):
+                img_url = match.group(2).replace('"', '').replace("'", '')
                 encoded_url = utils.encode_image_from_url(img_url, source)
+                if not encoded_url:
+                    return match.group(0)
+                return match.group(1) + match.group(2).replace(img_url, encoded_url)
+
+            html = BACKGROUND_URL_RE.sub(embed_background, html)
 
-                html = html.replace(img_url, encoded_url, 1)
+            if self.file_type == 'html':
+                html = self.share_embedded_images(html)
 
         return html
 
-    def write(self):
-        """ Writes generated presentation code into the destination file.
+    def share_embedded_images(self, html):
+        """ Replaces repeated embedded images (such as logos) with references
+            to a single copy of each image, which is set by a script when the
+            presentation is loaded.
+        """
+        counts = {}
+        for data_url in EMBEDDED_IMG_RE.findall(html):
+            if len(data_url) >= SHARED_IMAGE_MIN_BYTES:
+                counts[data_url] = counts.get(data_url, 0) + 1
+
+        shared_urls = sorted(data_url for data_url, count in counts.items() if count > 1)
+        if not shared_urls:
+            return html
+        indices = dict((data_url, index) for index, data_url in enumerate(shared_urls))
+
+        def share_image(match):
+            index = indices.get(match.group(1))
+            if index is None:
+                return match.group(0)
+            return u'src="%s" data-landslide-image="%d"' % (BLANK_IMAGE_URL, index)
+
+        html = EMBEDDED_IMG_RE.sub(share_image, html)
+        return html.replace(u'</body>', SHARED_IMAGES_SCRIPT
+                            % json.dumps(shared_urls) + u'</body>', 1)
+
+    def watch(self, interval=WATCH_INTERVAL):
+        """ Watches the presentation sources (and template), rebuilding the
+            presentation whenever they change, until interrupted. Parsed
+            slides are kept in memory, so that only changed slides are
+            rendered. Within GraphTerm, the presentation is displayed in a
+            frame, which reloads itself after each rebuild.
+        """
+        if self.direct:
+            raise IOError(u"Direct output mode is not available for watch "
+                           "mode")
+
+        self.slide_cache = self.read_cache() if self.cache else {}
+
+        gterm = utils.gterm if utils.gterm and utils.gterm.Cookie else None
+        html_blob_id = version_blob_id = version_file = ''
+        if self.file_type == 'html':
+            if gterm:
+                # Re-use blob ids, so that the frame can reload in place
+                html_blob_id = str(uuid.uuid4())
+                version_blob_id, self.watch_url = gterm.make_blob_url(
+                    html_blob_id + '-version', untrusted=True)
+            else:
+                dest_dir, dest_name = os.path.split(
+                    os.path.abspath(self.destination_file))
+                version_file = os.path.join(dest_dir, '.%s.version.js' % dest_name)
+                self.watch_url = os.path.basename(version_file)
+
+        mtimes = None
+        displayed = False
+        try:
+            while True:
+                new_mtimes = self.get_watch_mtimes()
+                if new_mtimes != mtimes:
+                    if mtimes is not None:
+                        self.log(u"Rebuilding %s" % self.destination_file)
+                        if new_mtimes.get(self.template_file) != mtimes.get(self.template_file):
+                            self.template = None
+                    self.watch_version += 1
+                    try:
+                        html = self.render()
+                        self.write(html)
+                    except Exception, e:
+                        self.log(u"Error in rebuilding presentation: %s" % e,
+                                 'warning')
+                    else:
+                        version_js = "landslideVersion(%d);\n" % self.watch_version
+                        if html_blob_id:
+                            html_url = gterm.create_blob(html.encode('utf_8'),
+                                content_type="text/html", blob_id=html_blob_id,
+                                untrusted=True)
+                            gterm.create_blob(version_js,
+                                content_type="application/javascript",
+                                blob_id=version_blob_id, untrusted=True)
+                            if not displayed:
+                                iframe_html = gterm.iframe_html(html_url,
+                                    header=True, fullscreen=True)
+                                gterm.untrusted_wrap_write(
+                                    gterm.iframe_header_html(iframe_html,
+                                                             fullscreen=True))
+                                displayed = True
+                        elif version_file:
+                            with open(version_file, 'w') as f:
+                                f.write(version_js)
+                        self.log(u"Generated file: %s" % self.destination_file)
+
+                    # Include any new source files
+                    mtimes = new_mtimes
+                    mtimes.update(self.get_watch_mtimes(exclude=mtimes))
+
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            if displayed:
+                gterm.write_blank(exit_page=True)
+
+    def get_watch_mtimes(self, exclude={}):
+        """ Returns dict of modification times of watched files, and of
+            source file names in watched directories (to detect added files).
+        """
+        extensions = set(ext for exts in SUPPORTED_FORMATS.values() for ext in exts)
+        paths = set(self.watch_files)
+        paths.add(self.template_file)
+        for source in (self.source if type(self.source) is list else [self.source]):
+            paths.add(source)
+        paths.update(os.path.dirname(filepath) or '.' for filepath in self.watch_files)
+
+        mtimes = {}
+        for path in paths:
+            if path in exclude:
+                continue
+            try:
+                if os.path.isdir(path):
+                    mtimes[path] = sorted(name for name in os.listdir(path)
+                                          if os.path.splitext(name)[1] in extensions)
+                else:
+                    mtimes[path] = os.stat(path).st_mtime
+            except OSError:
+                mtimes[path] = None
+        return mtimes
+
+    def write(self, html=None):
+        """ Writes generated presentation code (rendered, if not provided)
+            into the destination file.
         """
-        html = self.render()
+        if html is None:
+            html = self.render()
 
         if self.file_type == 'pdf':
             self.write_pdf(html)
@@ -90,32 +90,31 @@ class CodeHighlightingMacro(Macro):
 
 class EmbedImagesMacro(Macro):
     """This Macro extracts images url and embed them using the base64
-       algorithm.
+       algorithm. Images are substituted in a single pass over the content.
     """
+    img_src_re = re.compile(r'(<img\s[^>]*?src=")(.+?)(")',
+                            re.DOTALL | re.UNICODE)
+
     def process(self, content, source=None):
         classes = []
 
         if not self.embed:
             return content, classes
 
-        images = re.findall(r'<img\s.*?src="(.+?)"\s?.*?/?>', content,
-                            re.DOTALL | re.UNICODE)
-
         source_dir = os.path.dirname(source)
 
-        for image_url in images:
+        def embed_image(match):
+            image_url = match.group(2)
             encoded_url = utils.encode_image_from_url(image_url, source_dir)
 
             if not encoded_url:
                 self.logger(u"Failed to embed image \"%s\"" % image_url, 'warning')
-                return content, classes
-
-            content = content.replace(u"src=\"" + image_url,
-                                      u"src=\"" + encoded_url, 1)
+                return match.group(0)
 
             self.logger(u"Embedded image %s" % image_url, 'notice')
+            return match.group(1) + encoded_url + match.group(3)
 
-        return content, classes
+        return self.img_src_re.sub(embed_image, content), classes
 
 
 class FixImagePathsMacro(Macro):
@@ -91,6 +91,22 @@ def _parse_options():
         default="inline",
     )
 
+    parser.add_option(
+        "-j", "--jobs",
+        type="int",
+        dest="jobs",
+        help="Number of processes for rendering slides (default: 0, "
+             "for number of cpus)",
+        default=0)
+
+    parser.add_option(
+        "-n", "--no-cache",
+        action="store_false",
+        dest="cache",
+        help="Do not cache rendered slides (cache is stored in the "
+             "graphterm app directory, ~/.graphterm; not used with -o)",
+        default=True)
+
     parser.add_option(
         "-o", "--direct-output",
         action="store_true",
@@ -129,6 +145,14 @@ def _parse_options():
         help="Write informational messages to stdout (enabled by default)",
         default=True)
 
+    parser.add_option(
+        "-w", "--watch",
+        action="store_true",
+        dest="watch",
+        help="Watch source files, rebuilding the presentation when they "
+             "change (and refreshing its display in GraphTerm)",
+        default=False)
+
     parser.add_option(
         "-x", "--extensions",
         dest="extensions",
@@ -155,7 +179,11 @@ def run(input_file, options):
     """ Runs the Generator using parsed options.
     """
     options.logger = log
-    generator.Generator(input_file, **options.__dict__).execute()
+    gen = generator.Generator(input_file, **options.__dict__)
+    if options.watch:
+        gen.watch()
+    else:
+        gen.execute()
 
 
 def main():
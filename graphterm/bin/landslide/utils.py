@@ -19,6 +19,7 @@
 import os
 import sys
 import base64
+import hashlib
 import mimetypes
 
 try:
@@ -30,6 +31,10 @@ except ImportError:
         import gterm
     except ImportError:
         gterm = None
+
+# Cache of encoded images (shared across slides, and across rebuilds in watch mode)
+Encoded_images = {}   # (mime type, content hash) -> data URI
+Image_keys = {}       # (path, mtime, size) -> (mime type, content hash)
     
 def get_abs_path_url(path, blob=False):
     """ Returns the absolute url for a given local path.
@@ -89,11 +94,18 @@ def encode_image_from_url(url, source_path):
         return False
 
     try:
-        image_contents = open(real_path).read()
-        encoded_image = base64.b64encode(image_contents)
+        stat = os.stat(real_path)
+        stat_key = (os.path.abspath(real_path), stat.st_mtime, stat.st_size)
+        image_key = Image_keys.get(stat_key)
+        if image_key not in Encoded_images:
+            image_contents = open(real_path, 'rb').read()
+            image_key = (mime_type, hashlib.sha1(image_contents).hexdigest())
+            if image_key not in Encoded_images:
+                Encoded_images[image_key] = u"data:%s;base64,%s" % (mime_type, base64.b64encode(image_contents))
+            Image_keys[stat_key] = image_key
     except IOError:
         return False
     except Exception:
         return False
 
-    return u"data:%s;base64,%s" % (mime_type, encoded_image)
+    return Encoded_images[image_key]
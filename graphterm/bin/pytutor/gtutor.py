@@ -14,12 +14,16 @@ Typical interactive usage:
 For delayed "tracing", save the command output to a file and load it later using gframe:
    gtutor.py example.py > example_trace.html
    gframe -f example_trace.html
+
+For long traces, stream the trace in windows of steps (each window is loaded only when displayed):
+   gtutor.py --window=100 --max_steps=5000 example.py | gframe -f
 """
 
 import cgi
 import json
 import os
 import sys
+import tempfile
 
 from optparse import OptionParser
 
@@ -37,7 +41,16 @@ except ImportError:
 LOG_QUERIES = False
 
 if LOG_QUERIES:
-  import os, datetime, create_log_db, sqlite3
+  import datetime, create_log_db, sqlite3
+
+try:
+  import gterm
+except ImportError:
+  sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+  try:
+    import gterm
+  except ImportError:
+    gterm = None
 
 HEADERFMT = """This is a command-line version of the Online Python Tutorial. See <a href="http://pythontutor.com" target="_blank">pythontutor.com</a> for more info.  To exit, click on the X to the right.
   <hr>
@@ -72,6 +85,108 @@ IFRAMEFMT = """
 -->
 <script>
 var traceOutput=%(traceOutput)s;
+var traceIndex=%(traceIndex)s;
+var traceVisualizer = null;
+
+// Traces generated using --incremental record only the heap objects changed
+// at each step (heap_delta), with periodic full heaps (heap_keyframe).
+// Define a heap property for each step that rebuilds its heap on demand.
+function expandHeapDeltas(trace) {
+  var cache = {index: -1, heap: null};
+
+  function heapAt(index) {
+    if (index == cache.index)
+      return cache.heap;
+    var start = index;
+    while (start > 0 && !trace[start].heap_keyframe && start-1 != cache.index)
+      start--;
+    var heap = (start-1 == cache.index && !trace[start].heap_keyframe) ? $.extend({}, cache.heap) : {};
+    for (var j = start; j <= index; j++) {
+      var entry = trace[j];
+      if (!entry.heap_delta)
+        continue;
+      for (var k = 0; k < entry.heap_removed.length; k++)
+        delete heap[entry.heap_removed[k]];
+      $.extend(heap, entry.heap_delta);
+    }
+    cache.index = index;
+    cache.heap = heap;
+    return heap;
+  }
+
+  $.each(trace, function(index, entry) {
+    if (entry.heap_delta && !('heap' in entry))
+      Object.defineProperty(entry, 'heap', {get: function() { return heapAt(index); }, enumerable: true});
+  });
+}
+
+if (traceOutput && traceOutput.trace)
+  expandHeapDeltas(traceOutput.trace);
+
+// Traces generated using --window are delivered in chunks (windows of steps),
+// described by traceIndex. Chunks are loaded (as blob scripts, or from inline
+// script elements) only when displayed, and at most MAX_TRACE_CHUNKS are kept.
+var MAX_TRACE_CHUNKS = 3;
+var traceChunks = {};
+var traceChunkOrder = [];
+var traceChunkCallbacks = {};
+
+function gtutorChunk(index, entries) {
+  traceChunks[index] = entries;
+  traceChunkOrder.push(index);
+  while (traceChunkOrder.length > MAX_TRACE_CHUNKS)
+    delete traceChunks[traceChunkOrder.shift()];
+  var callbacks = traceChunkCallbacks[index] || [];
+  delete traceChunkCallbacks[index];
+  for (var j = 0; j < callbacks.length; j++)
+    callbacks[j]();
+}
+
+function loadTraceChunk(index, callback) {
+  if (index in traceChunks) {
+    // Move to end of least recently used list
+    traceChunkOrder.splice($.inArray(index, traceChunkOrder), 1);
+    traceChunkOrder.push(index);
+    if (callback)
+      callback();
+  } else if (index in traceChunkCallbacks) {
+    // Already loading
+    if (callback)
+      traceChunkCallbacks[index].push(callback);
+  } else {
+    traceChunkCallbacks[index] = callback ? [callback] : [];
+    if (traceIndex.urls.length) {
+      var script = document.createElement('script');
+      script.src = traceIndex.urls[index];
+      document.getElementsByTagName('head')[0].appendChild(script);
+    } else {
+      gtutorChunk(index, JSON.parse($('#gtutor-chunk-' + index).html()));
+    }
+  }
+}
+
+function showTraceWindow(index, step, options) {
+  loadTraceChunk(index, function() {
+    var trace = traceChunks[index];
+    var first = index * traceIndex.chunk_size;
+    expandHeapDeltas(trace);
+
+    $('#traceNav').show();
+    $('#traceNavLabel').text('Steps ' + (first+1) + '-' + (first+trace.length) + ' of ' + traceIndex.total);
+    $('#traceNavPrev').unbind('click').click(function() { showTraceWindow(index-1, traceIndex.chunk_size-1, options); }).toggle(index > 0);
+    $('#traceNavNext').unbind('click').click(function() { showTraceWindow(index+1, 0, options); }).toggle(index < traceIndex.counts.length-1);
+
+    $('#traceDiv').empty();
+    traceVisualizer = new ExecutionVisualizer('traceDiv', {code: traceIndex.code, trace: trace},
+                                              $.extend({}, options, {startingInstruction: step, jumpToEnd: false}));
+
+    // Prefetch adjacent windows
+    if (index+1 < traceIndex.counts.length)
+      loadTraceChunk(index+1);
+    if (index > 0)
+      loadTraceChunk(index-1);
+  });
+}
 
 // 2. When the HTML document finishes loading, populate the div
 //    (traceDiv) with the visualization
@@ -90,11 +205,18 @@ $(document).ready(function() {
   // editCodeBaseURL is the base URL to prepend onto the 'Edit code' link.
 
   // Render listSumTrace inside of listSumDiv
-  var traceVisualizer = new ExecutionVisualizer('traceDiv', traceOutput,
-                                                {embeddedMode: %(embeddedMode)s,
-                                                 startingInstruction: %(startingInstruction)d,
-                                                 jumpToEnd: %(jumpToEnd)s,
-                                                 editCodeBaseURL: "%(editCodeBaseURL)s"});
+  var visualizerOptions = {embeddedMode: %(embeddedMode)s,
+                           startingInstruction: %(startingInstruction)d,
+                           jumpToEnd: %(jumpToEnd)s,
+                           editCodeBaseURL: "%(editCodeBaseURL)s"};
+  if (traceIndex) {
+    // Windowed trace: display window containing starting step
+    var startStep = visualizerOptions.jumpToEnd ? traceIndex.total-1 : Math.min(visualizerOptions.startingInstruction, traceIndex.total-1);
+    var startChunk = Math.floor(startStep / traceIndex.chunk_size);
+    showTraceWindow(startChunk, startStep - startChunk*traceIndex.chunk_size, visualizerOptions);
+  } else {
+    traceVisualizer = new ExecutionVisualizer('traceDiv', traceOutput, visualizerOptions);
+  }
 
   // The redrawConnectors() method needs to be called whenever
   // HTML elements move around on-screen. This is because the SVG
@@ -104,7 +226,8 @@ $(document).ready(function() {
   // Call redrawConnectors() whenever the window is resized,
   // since HTML elements might have moved during a resize.
   $(window).resize(function() {
-    traceVisualizer.redrawConnectors();
+    if (traceVisualizer)
+      traceVisualizer.redrawConnectors();
   });
 
 
@@ -138,8 +261,13 @@ $(document).ready(function() {
 %(header)s
 </div>
   <p>
+  <div id="traceNav" style="display: none;">
+    <button id="traceNavPrev">&lt; Prev steps</button>
+    <span id="traceNavLabel"></span>
+    <button id="traceNavNext">Next steps &gt;</button>
+  </div>
   <div id="traceDiv"></div>
-
+%(traceChunks)s
 </body>
 </html>
 """
@@ -147,6 +275,34 @@ $(document).ready(function() {
 ONLINE_STATIC_URL = "http://pythontutor.com"
 OFFLINE_STATIC_URL = "/static/pytutor"
 
+CHUNKFMT = """<script type="text/x-gtutor-chunk" id="gtutor-chunk-%(index)d">%(data)s</script>
+"""
+
+class TraceSpool(object):
+  """Spools JSON-encoded trace chunks to a temporary file.
+  (The file is opened before the user script is run, because the
+  sandbox does not permit new files to be opened while it runs.)"""
+  def __init__(self):
+    self.spool_file = tempfile.TemporaryFile()
+    self.chunk_info = []   # (offset, length, entry_count)
+
+  def write(self, entries):
+    data = json.dumps(entries, indent=None)
+    self.spool_file.seek(0, 2)
+    self.chunk_info.append( (self.spool_file.tell(), len(data), len(entries)) )
+    self.spool_file.write(data)
+
+  def counts(self):
+    return [count for offset, length, count in self.chunk_info]
+
+  def chunks(self):
+    for offset, length, count in self.chunk_info:
+      self.spool_file.seek(offset)
+      yield self.spool_file.read(length)
+
+  def close(self):
+    self.spool_file.close()
+
 def main():
   usage = "usage: %prog [options] python_file"
   parser = OptionParser(usage=usage)
@@ -157,6 +313,15 @@ def main():
   parser.add_option("", "--end", action="store_true", dest="end", default=False,
                     help="Skip to end")
 
+  parser.add_option("", "--fast", action="store_true", dest="fast", default=False,
+                    help="Use fast tracer (sys.settrace hook, rather than bdb)")
+
+  parser.add_option("", "--incremental", action="store_true", dest="incremental", default=False,
+                    help="Record only changed heap objects at each step (for programs with large data structures)")
+
+  parser.add_option("", "--max_steps", dest="max_steps", type="int", default=pg_logger.MAX_EXECUTED_LINES,
+                    help="Maximum number of steps to trace (default: %d)" % pg_logger.MAX_EXECUTED_LINES)
+
   parser.add_option("", "--offline", action="store_true", dest="offline", default=False,
                     help="Generate output for offline use")
 
@@ -166,6 +331,9 @@ def main():
   parser.add_option("", "--step", dest="step", default=0,
                     help="Starting step (default: 0)")
 
+  parser.add_option("", "--window", dest="window", type="int", default=0,
+                    help="Stream trace in windows of steps, loaded only when displayed (default: 0, for full trace)")
+
   (options, args) = parser.parse_args()
   if not args:
     print >> sys.stderr, parser.get_usage()
@@ -173,6 +341,16 @@ def main():
 
   filepath = args[0]
 
+  pg_logger.MAX_EXECUTED_LINES = options.max_steps
+
+  window = options.window
+  if window and options.incremental:
+    # Each window must start with a heap keyframe
+    interval = pg_logger.pg_encoder.HEAP_KEYFRAME_INTERVAL
+    window = interval * ((window + interval - 1) // interval)
+
+  spool = TraceSpool() if window else None
+
   def cgi_finalizer(input_code, output_trace):
     """Write JSON output for js/pytutor.js as a CGI result."""
     ret = dict(code=input_code, trace=output_trace)
@@ -201,8 +379,30 @@ def main():
         # this is bad form, but silently fail on error ...
         print(err)
 
+    trace_index = None
+    trace_chunks = ""
+    if spool:
+      # Stream mode: remaining entries form the last window(s)
+      for offset in range(0, len(output_trace), window):
+        spool.write(output_trace[offset:offset+window])
+      counts = spool.counts()
+      trace_index = dict(code=input_code, chunk_size=window, counts=counts, total=sum(counts), urls=[])
+      if gterm and gterm.Cookie:
+        # Chunks are scripts, because untrusted blobs may be served from a different origin
+        for index, data in enumerate(spool.chunks()):
+          trace_index["urls"].append(gterm.create_blob("gtutorChunk(%d, %s);\n" % (index, data),
+                                                       content_type="application/javascript",
+                                                       untrusted=True, stderr=True))
+      else:
+        trace_chunks = "".join(CHUNKFMT % {"index": index, "data": data.replace("</", "<\\/")}
+                               for index, data in enumerate(spool.chunks()))
+      spool.close()
+      json_output = "null"
+
     header = "" if options.bare else HEADERFMT % {"filepath": filepath}
     print IFRAMEFMT % {"traceOutput": json_output,
+                       "traceIndex": json.dumps(trace_index),
+                       "traceChunks": trace_chunks,
                        "embeddedMode": "false" if options.output else "true",
                        "startingInstruction": options.step,
                        "jumpToEnd": "true" if options.end else "false",
@@ -227,7 +427,9 @@ def main():
   # Ensure that the file compiles
   compile(user_script, filepath, "exec")
 
-  pg_logger.exec_script_str(user_script, cumulative_mode, cgi_finalizer)
+  pg_logger.exec_script_str(user_script, cumulative_mode, cgi_finalizer, incremental_heap=options.incremental,
+                            fast=options.fast, chunk_func=spool.write if spool else None,
+                            chunk_size=window or 100)
 
 if __name__ == "__main__":
     main()
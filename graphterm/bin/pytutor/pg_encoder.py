@@ -50,11 +50,22 @@
 #   * compound object reference - ['REF', target object's unique_id]
 #
 # the unique_id is derived from id(), which allows us to capture aliasing
+#
+# Incremental heap encoding (see ObjectEncoder.diff_heap):
+#   Instead of the full heap, each trace step may record only the encoded
+#   objects that changed since the previous step ('heap_delta'), and the
+#   unique_ids of objects that are no longer reachable ('heap_removed').
+#   Every HEAP_KEYFRAME_INTERVAL steps, the full heap is recorded as the
+#   delta ('heap_keyframe': true), so that the front end can rebuild the
+#   heap for any step without replaying the whole trace.
 
 
 # number of significant digits for floats
 FLOAT_PRECISION = 4
 
+# number of steps between full heap records, for incremental encoding
+HEAP_KEYFRAME_INTERVAL = 50
+
 
 import re, types
 import sys
@@ -102,11 +113,38 @@ class ObjectEncoder:
     self.id_to_small_IDs = {}
     self.cur_small_ID = 1
 
+    # heap (encoded objects) of the previous step, for diff_heap
+    self.prev_heap_objects = {}
+    self.diff_count = 0
+
 
   def get_heap(self):
     return self.encoded_heap_objects
 
 
+  def diff_heap(self):
+    """Compare the current heap with that of the previous call, returning
+    (changed_objects_dict, removed_small_IDs, is_keyframe). Unchanged encoded
+    objects are replaced by those of the previous heap, so that consecutive
+    heaps share structure rather than holding full copies."""
+    heap = self.encoded_heap_objects
+    prev_heap = self.prev_heap_objects
+    changed = {}
+    for (small_id, new_obj) in heap.items():
+      prev_obj = prev_heap.get(small_id)
+      if prev_obj is not None and prev_obj == new_obj:
+        heap[small_id] = prev_obj
+      else:
+        changed[small_id] = new_obj
+    removed = [small_id for small_id in prev_heap if small_id not in heap]
+
+    self.prev_heap_objects = heap
+    self.diff_count += 1
+    if self.diff_count % HEAP_KEYFRAME_INTERVAL == 1:
+      return (dict(heap), [], True)
+    return (changed, removed, False)
+
+
   def reset_heap(self):
     # VERY IMPORTANT to reassign to an empty dict rather than just
     # clearing the existing dict, since get_heap() could have been
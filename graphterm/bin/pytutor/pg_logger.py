@@ -188,7 +188,8 @@ def visit_function_obj(v, ids_seen_set):
 
 class PGLogger(bdb.Bdb):
 
-    def __init__(self, cumulative_mode, finalizer_func):
+    def __init__(self, cumulative_mode, finalizer_func, incremental_heap=False,
+                 chunk_func=None, chunk_size=100):
         bdb.Bdb.__init__(self)
         self.mainpyfile = ''
         self._wait_for_mainpyfile = 0
@@ -202,10 +203,24 @@ class PGLogger(bdb.Bdb):
         # lexical parents)
         self.cumulative_mode = cumulative_mode
 
+        # if True, then each trace entry records only the heap objects
+        # that changed since the previous entry (see pg_encoder.ObjectEncoder.diff_heap)
+        self.incremental_heap = incremental_heap
+
         # each entry contains a dict with the information for a single
         # executed line
         self.trace = []
 
+        # if chunk_func is specified, completed trace entries are passed to it
+        # in lists of chunk_size entries, rather than accumulating in self.trace
+        # (the last two entries are always kept, for finalize)
+        self.chunk_func = chunk_func
+        self.chunk_size = chunk_size
+        self.chunked_count = 0
+
+        # messages of all 'exception' entries in the trace
+        self.exception_msgs = set()
+
         #http://stackoverflow.com/questions/2112396/in-python-in-google-app-engine-how-do-you-capture-output-produced-by-the-print
         self.GAE_STDOUT = sys.stdout
 
@@ -662,17 +677,31 @@ class PGLogger(bdb.Bdb):
                            globals=encoded_globals,
                            ordered_globals=ordered_globals,
                            stack_to_render=stack_to_render,
-                           heap=self.encoder.get_heap(),
                            stdout=get_user_stdout(tos[0]))
 
+        # share unchanged heap objects with the previous entry
+        heap_delta, heap_removed, heap_keyframe = self.encoder.diff_heap()
+        if self.incremental_heap:
+          trace_entry['heap_delta'] = heap_delta
+          trace_entry['heap_removed'] = heap_removed
+          trace_entry['heap_keyframe'] = heap_keyframe
+        else:
+          trace_entry['heap'] = self.encoder.get_heap()
+
         # if there's an exception, then record its info:
         if event_type == 'exception':
           # always check in f_locals
           exc = frame.f_locals['__exception__']
           trace_entry['exception_msg'] = exc[0].__name__ + ': ' + str(exc[1])
+          self.exception_msgs.add(trace_entry['exception_msg'])
 
         self.trace.append(trace_entry)
 
+        if self.chunk_func and len(self.trace) >= self.chunk_size + 2:
+          self.chunk_func(self.trace[:self.chunk_size])
+          self.trace = self.trace[self.chunk_size:]
+          self.chunked_count += self.chunk_size
+
 
         # sanity check to make sure the state of the world at a 'call' instruction
         # is identical to that at the instruction immediately following it ...
@@ -689,7 +718,7 @@ class PGLogger(bdb.Bdb):
         '''
 
 
-        if len(self.trace) >= MAX_EXECUTED_LINES:
+        if self.chunked_count + len(self.trace) >= MAX_EXECUTED_LINES:
           self.trace.append(dict(event='instruction_limit_reached', exception_msg='(stopped after ' + str(MAX_EXECUTED_LINES) + ' steps to prevent possible infinite loop)'))
           self.force_terminate()
 
@@ -794,11 +823,7 @@ class PGLogger(bdb.Bdb):
           # SUPER SUBTLE! if this exact same exception has already been
           # recorded by the program, then DON'T record it again as an
           # uncaught_exception
-          already_caught = False
-          for e in self.trace:
-            if e['event'] == 'exception' and e['exception_msg'] == trace_entry['exception_msg']:
-              already_caught = True
-              break
+          already_caught = trace_entry['exception_msg'] in self.exception_msgs
 
           if not already_caught:
             self.trace.append(trace_entry)
@@ -839,13 +864,64 @@ class PGLogger(bdb.Bdb):
 
       self.trace = res
 
+      # (if chunk_func was specified, only the entries not yet passed to it)
       self.finalizer_func(self.executed_script, self.trace)
 
 
 
+class FastPGLogger(PGLogger):
+    """Logger that uses a lean sys.settrace hook instead of bdb's dispatch.
+
+    Frames whose code was not compiled from the user's script (filename
+    '<string>') are never traced locally, so library code runs at full
+    speed. User frames are traced with the same user_* methods and
+    interaction(), so the output trace is the same as PGLogger's."""
+
+    def run(self, cmd, globals=None, locals=None):
+        if not isinstance(cmd, types.CodeType):
+          cmd = cmd + '\n'
+        self.reset()
+        # frames below this one form the user program's stack (see interaction)
+        self.botframe = sys._getframe()
+        sys.settrace(self.trace_call)
+        try:
+          exec(cmd, globals, locals)
+        except bdb.BdbQuit:
+          pass
+        finally:
+          self.quitting = 1
+          sys.settrace(None)
+
+    def trace_call(self, frame, event, arg):
+        # global trace function; invoked only for 'call' events
+        if self.quitting:
+          return None
+        if frame.f_code.co_filename != '<string>':
+          return None
+        self.user_call(frame, None)
+        if self.quitting:
+          raise bdb.BdbQuit
+        return self.trace_local
+
+    def trace_local(self, frame, event, arg):
+        # local trace function for user frames
+        if event == 'line':
+          self.user_line(frame)
+        elif event == 'return':
+          self.user_return(frame, arg)
+        elif event == 'exception':
+          self.user_exception(frame, arg)
+        if self.quitting:
+          raise bdb.BdbQuit
+        return self.trace_local
+
+
 # the MAIN meaty function!!!
-def exec_script_str(script_str, cumulative_mode, finalizer_func):
-  logger = PGLogger(cumulative_mode, finalizer_func)
+def exec_script_str(script_str, cumulative_mode, finalizer_func, incremental_heap=False, fast=False,
+                    chunk_func=None, chunk_size=100):
+  logger_class = FastPGLogger if fast else PGLogger
+  logger = logger_class(cumulative_mode, finalizer_func, incremental_heap=incremental_heap,
+                        chunk_func=chunk_func, chunk_size=chunk_size)
 
   try:
     logger._runscript(script_str)
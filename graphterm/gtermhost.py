@@ -11,12 +11,14 @@ import datetime
 import email.utils
 import functools
 import hashlib
+import json
 import logging
 import mimetypes
 import otrace
 import os
 import re
 import signal
+import socket
 import stat
 import sys
 import threading
@@ -47,6 +49,11 @@ import packetserver
 
 RETRY_SEC = 15
 
+MAX_SUBMIT_PENDING = 1000   # Max. number of notebook submissions waiting to be written
+
+MAX_BULK_BYTES = 25000000   # Max. content size for bulk transfers
+MAX_RANGE_BYTES = 8388608   # Max. content size for byte range file requests
+
 AJAX_EDITORS = set(["ace", "ckeditor", "textarea"])
 
 OSHELL_NAME = "osh"
@@ -62,6 +69,8 @@ Host_secret = None
 IO_loop = None
 IO_loop_control = False
 Widget_server = None
+Bulk_server = None
+Bulk_socket_path = ""
 
 def get_normalized_host(host):
     """Return identifier version of hostname"""
@@ -94,35 +103,141 @@ class HtmlWrapper(object):
         return HTML_ESCAPES[0] + self.lterm_cookie + HTML_ESCAPES[1]  + html + HTML_ESCAPES[-1]
 
 class BlobCache(object):
+    """Thread-safe cache of (base64 encoded) blobs; blobs are added from the lineterm thread,
+    and from the IOLoop thread (widget and bulk transfer sockets)
+    """
     def __init__(self, max_bytes=10000000, max_time=5400):
         self.max_bytes = max_bytes
         self.max_time = max_time
         self.cache = OrderedDict()
         self.cache_size = 0
+        self.lock = threading.Lock()
 
     def get_blob(self, blob_id):
         """Return (mod_time, headers, content)"""
-        return self.cache.get(blob_id) or (None, None, None)
+        with self.lock:
+            return self.cache.get(blob_id) or (None, None, None)
 
     def add_blob(self, blob_id, headers, content):
         """Add blob, refreshing cache, if need be"""
-        if blob_id in self.cache:
-            self.delete_blob(blob_id)
-
-        self.cache_size += len(content)
-        cur_time = time.time()
-        for bid in self.cache.keys():
-            btime, bheaders, bcontent = self.cache[bid]
-            if (cur_time - btime) > self.max_time or self.cache_size > self.max_bytes:
-                self.cache.pop(bid)
-                self.cache_size -= len(bcontent)
-        self.cache[blob_id] = (cur_time, headers, content)
+        with self.lock:
+            self._delete_blob(blob_id)
+
+            self.cache_size += len(content)
+            cur_time = time.time()
+            for bid in self.cache.keys():
+                btime, bheaders, bcontent = self.cache[bid]
+                if (cur_time - btime) > self.max_time or self.cache_size > self.max_bytes:
+                    self.cache.pop(bid)
+                    self.cache_size -= len(bcontent)
+            self.cache[blob_id] = (cur_time, headers, content)
 
     def delete_blob(self, blob_id):
+        with self.lock:
+            self._delete_blob(blob_id)
+
+    def _delete_blob(self, blob_id):
         if blob_id in self.cache:
             btime, bheaders, bcontent = self.cache.pop(blob_id)
             self.cache_size -= len(bcontent)
 
+class SubmissionQueue(object):
+    """Writes submitted notebooks in a background thread, using atomic renames.
+    Repeated submissions of the same file that are still pending are coalesced,
+    and an index of submissions is maintained in each submission directory.
+    """
+    def __init__(self, max_pending=MAX_SUBMIT_PENDING):
+        self.max_pending = max_pending
+        self.pending = OrderedDict()  # filepath -> [user, filedata, callbacks]
+        self.indices = {}             # submit_dir -> submission index dict
+        self.cond = threading.Condition()
+        self.thread = None
+        self.stopping = False
+
+    def submit(self, filepath, filedata, user="", callback=None):
+        """Queue submission for writing. callback(status_msg) is invoked from writer thread.
+        Returns error message if queue is full, else ""
+        """
+        with self.cond:
+            if filepath in self.pending:
+                # Resubmitted before previous version was written; write only latest version
+                entry = self.pending[filepath]
+                entry[1] = filedata
+                if callback:
+                    entry[2].append(callback)
+                return ""
+            if len(self.pending) >= self.max_pending:
+                return "Too many pending submissions; please try again"
+            self.pending[filepath] = [user, filedata, [callback] if callback else []]
+            if not self.thread:
+                self.thread = threading.Thread(target=self.writer, name="gterm-submit")
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify()
+        return ""
+
+    def shutdown(self, timeout=5):
+        """Stop writer thread, after flushing pending submissions"""
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        if self.thread:
+            self.thread.join(timeout)
+            self.thread = None
+
+    def writer(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.stopping:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                batch = self.pending.items()
+                self.pending.clear()
+
+            modified_dirs = set()
+            for filepath, (user, filedata, callbacks) in batch:
+                status_msg = self.write_submission(filepath, filedata, user)
+                if not status_msg.startswith("Error"):
+                    modified_dirs.add(os.path.dirname(filepath))
+                for callback in callbacks:
+                    try:
+                        callback(status_msg)
+                    except Exception, excp:
+                        logging.error("SubmissionQueue.writer: callback error %s", excp)
+
+            for submit_dir in modified_dirs:
+                # Update index once per batch
+                gterm.write_submissions(submit_dir, self.indices[submit_dir])
+
+    def write_submission(self, filepath, filedata, user=""):
+        """Write file atomically and update index entry. Return status message"""
+        submit_dir, filename = os.path.split(filepath)
+        if submit_dir not in self.indices:
+            self.indices[submit_dir] = gterm.read_submissions(submit_dir)
+        index = self.indices[submit_dir]
+
+        if isinstance(filedata, unicode):
+            filedata = filedata.encode("utf-8")
+        md5_digest = hashlib.md5(filedata).hexdigest()
+        prev_entry = index.get(filename)
+        if prev_entry and prev_entry["md5"] == md5_digest and os.path.exists(filepath):
+            return "Notebook %s unchanged since last submission" % filepath
+
+        tem_path = os.path.join(submit_dir, "."+filename+".tmp")
+        try:
+            with open(tem_path, "w") as f:
+                f.write(filedata)
+            os.rename(tem_path, filepath)
+        except Exception, excp:
+            status_msg = "Error in submitting notebook %s: %s" % (filepath, excp)
+            logging.error("SubmissionQueue.write_submission: %s", status_msg)
+            return status_msg
+
+        index[filename] = {"user": user, "time": int(time.time()), "size": len(filedata), "md5": md5_digest,
+                           "count": (prev_entry["count"]+1) if prev_entry else 1}
+        return "Submitted notebook %s" % filepath
+
 class TerminalClient(packetserver.RPCLink, packetserver.PacketClient):
     _all_connections = {}
     all_cookies = {}
@@ -141,6 +256,7 @@ class TerminalClient(packetserver.RPCLink, packetserver.PacketClient):
         self.blob_server = ""
         self.osh_cookie = lineterm.make_lterm_cookie()
         self.blob_cache = BlobCache()
+        self.submit_queue = SubmissionQueue()
         self.host_settings = {}
         self.widget_port = 0
         self.log_filename = ""
@@ -150,6 +266,7 @@ class TerminalClient(packetserver.RPCLink, packetserver.PacketClient):
         if self.lineterm:
             self.lineterm.shutdown()
         self.lineterm = None
+        self.submit_queue.shutdown()
 
     def connection_validated(self):
         normalized_host = get_normalized_host(self.connection_id)
@@ -200,7 +317,8 @@ class TerminalClient(packetserver.RPCLink, packetserver.PacketClient):
                                                term_type=self.host_settings["term_type"],
                                                api_version=version_str, widget_port=self.widget_port,
                                                prompt_list=self.host_settings["prompt_list"], blob_server=self.blob_server,
-                                               term_params=self.host_settings["lterm_params"], logfile=self.lterm_logfile)
+                                               term_params=self.host_settings["lterm_params"], logfile=self.lterm_logfile,
+                                               bulk_socket=Bulk_socket_path)
         term_name, lterm_cookie, alert_msg = self.lineterm.terminal(term_name, height=height, width=width,
                                                                     winheight=winheight, winwidth=winwidth,
                                                                     parent=parent)
@@ -271,6 +389,9 @@ class TerminalClient(packetserver.RPCLink, packetserver.PacketClient):
             Widget_server.listen(self.widget_port, address="localhost")
             logging.warning("GraphTerm widgets listening on %s:%s", "localhost", self.widget_port)
 
+        if not Bulk_server:
+            BulkServer.start()
+
     def remote_response(self, term_name, websocket_id, message_list, _content=None):
         self.send_request_threadsafe("response", term_name, websocket_id, message_list, _content=_content)
 
@@ -286,11 +407,12 @@ class TerminalClient(packetserver.RPCLink, packetserver.PacketClient):
           click_paste <text> <file_url> {command:, clear_last:, normalize:, enter:}
           paste_command <text>
           get_finder <kind> <directory>
+          page_request <pager_id> <page>
           save_data <save_params> <filedata>|None
           open_notebook <filepath> <share> <prompts> <content>
           close_notebook <discard>
           save_notebook <filepath> <input_data> <params>
-          submit_notebook <source_terminal> <filepath> <file_data>
+          submit_notebook <source_terminal> <filepath> <file_data> [<user>]
           note_lock <offset>
           add_cell <new_cell_type> <init_text> <before_cell_index>
           select_cell <cell_index> <move_up> <next_code>
@@ -367,7 +489,15 @@ class TerminalClient(packetserver.RPCLink, packetserver.PacketClient):
                             data = _content
                         else:
                             data = cmd[1]
-                        self.lineterm.save_data(term_name, cmd[0], data)
+                        if cmd[0].get("x_gterm_location") == "bulk":
+                            # Uploaded chunk requested via bulk transfer socket
+                            BulkStream.upload_data(self.terms.get(term_name, [None])[0], cmd[0], data)
+                        else:
+                            self.lineterm.save_data(term_name, cmd[0], data)
+
+                elif action == "page_request":
+                    # page_request <pager_id> <page>
+                    BulkStream.page_request(self, term_name, cmd[0], cmd[1])
 
                 elif action == "save_prefs":
                     # save_prefs <prefs_dict>
@@ -396,16 +526,14 @@ class TerminalClient(packetserver.RPCLink, packetserver.PacketClient):
                         self.lineterm.save_notebook(term_name, cmd[0], cmd[1], cmd[2])
 
                 elif action == "submit_notebook":
-                    # submit_notebook <source_terminal> <filepath> <filedata>
-                    try:
-                        with open(cmd[1], "w") as f:
-                            f.write(cmd[2])
-                        status_msg = "Submitted notebook %s" % cmd[1]
-                    except Exception, excp:
-                        status_msg = "Error in submitting notebook %s: %s" % (cmd[1], excp)
-                        logging.error("TerminalClient.remote_request: %s", status_msg)
-
-                    self.remote_response(term_name, "", [["terminal", "remote_alert", [cmd[0], status_msg] ]])
+                    # submit_notebook <source_terminal> <filepath> <filedata> [<user>]
+                    def submit_callback(status_msg, source_terminal=cmd[0]):
+                        self.remote_response(term_name, "", [["terminal", "remote_alert", [source_terminal, status_msg] ]])
+                    errmsg = self.submit_queue.submit(cmd[1], cmd[2], user=cmd[3] if len(cmd) > 3 else "",
+                                                      callback=submit_callback)
+                    if errmsg:
+                        logging.error("TerminalClient.remote_request: %s", errmsg)
+                        submit_callback(errmsg)
 
                 elif action == "note_lock":
                     # note_lock <offset>
@@ -538,12 +666,15 @@ class TerminalClient(packetserver.RPCLink, packetserver.PacketClient):
                         resp_list.append(["output", "\n".join(entry_list)])
 
                 elif action == "file_request":
-                    request_id, request_method, file_path, if_mod_since = cmd
+                    request_id, request_method, file_path, if_mod_since = cmd[:4]
+                    byte_range = cmd[4] if len(cmd) > 4 else None   # [start, end|None] (inclusive)
                     status = (404, "Not Found")
                     etag = None
                     last_modified = None
                     content_type = None
                     content_length = None
+                    content_range = None
+                    digest = None
                     content_b64 = ""
                     remote_modtime = None
                     if if_mod_since:
@@ -573,7 +704,30 @@ class TerminalClient(packetserver.RPCLink, packetserver.PacketClient):
                         if os.path.isfile(abspath) and os.access(abspath, os.R_OK):
                             mod_datetime = datetime.datetime.fromtimestamp(os.path.getmtime(abspath))
 
-                            if remote_modtime and remote_modtime >= mod_datetime:
+                            if byte_range:
+                                # Read byte range of file (with MD5 digest, for verification of chunk)
+                                try:
+                                    last_modified = datetime2str(mod_datetime)
+                                    content_type = mimetypes.guess_type(abspath)[0] or "application/octet-stream"
+                                    file_size = os.path.getsize(abspath)
+                                    start, end = byte_range
+                                    end = file_size-1 if end is None else min(end, file_size-1)
+                                    end = min(end, start+MAX_RANGE_BYTES-1)
+                                    etag = '"%x-%x"' % (int(os.path.getmtime(abspath)), file_size)
+                                    if start >= file_size or end < start:
+                                        # Beyond end of file, or reversed range
+                                        status = (416, "Requested Range Not Satisfiable")
+                                    else:
+                                        with open(abspath, "rb") as file:
+                                            file.seek(start)
+                                            data = file.read(max(0, end-start+1))
+                                        content_range = "bytes %d-%d/%d" % (start, start+len(data)-1, file_size)
+                                        digest = hashlib.md5(data).hexdigest()
+                                        content_b64 = base64.b64encode(data)
+                                        status = (206, "Partial Content")
+                                except Exception:
+                                    pass
+                            elif remote_modtime and remote_modtime >= mod_datetime:
                                 status = (304, "Not Modified")
                             else:
                                 # Read file contents
@@ -602,6 +756,7 @@ class TerminalClient(packetserver.RPCLink, packetserver.PacketClient):
                                       dict(status=status, last_modified=last_modified,
                                            etag=etag,
                                            content_type=content_type, content_length=content_length,
+                                           content_range=content_range, digest=digest,
                                            content_b64=None if content_b64 else "")])
                     if content_b64:
                         # Send response with file content right away
@@ -822,6 +977,204 @@ class WidgetServer(TCPServer):
         widget_stream = WidgetStream(stream, address)
         widget_stream.next_packet()
 
+class BulkStream(object):
+    """Binary bulk transfers over a local Unix socket, bypassing the pty
+    (and the base64 encoding/parsing of escape sequences in lineterm).
+    Each request is a header line, "<terminal_cookie> <JSON headers>\\n",
+    followed by content_length bytes of raw content. Each request is
+    acknowledged with a JSON line, {"status": "ok"|"error", ...}, which
+    may be followed by content_length bytes of raw reply content.
+
+    create_blob: blob is created before the acknowledgement, so that it is
+    available before it is referenced in terminal output.
+    upload_chunk: chunk of file being uploaded is requested from the browser,
+    and returned as raw reply content, with its MD5 digest (see gupload).
+    serve_pages: registers stream as page server for a paginated listing
+    (see gls). Page requests from the browser are forwarded as JSON lines,
+    {"page": n}, and answered with (unacknowledged) page_content requests.
+    """
+    _all_streams = []
+    _upload_waiters = {}
+    _page_servers = {}
+    blob_id_re = re.compile(r"^[\w\-]+$")
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._all_streams.append(self)
+        self.stream.set_close_callback(self.on_close)
+
+    @classmethod
+    def upload_data(cls, cookie, save_params, data):
+        """Route chunk uploaded by browser (with x_gterm_location == "bulk") to requesting stream"""
+        key = (cookie, save_params.get("x_gterm_upload"), save_params.get("x_gterm_offset"))
+        bulk_stream = cls._upload_waiters.pop(key, None)
+        if bulk_stream:
+            IO_loop.add_callback(functools.partial(bulk_stream.send_chunk, save_params, data))
+        else:
+            logging.warning("BulkStream.upload_data: No request for chunk %s", key[1:])
+
+    @classmethod
+    def shutdown_all(cls):
+        for bulk_stream in cls._all_streams[:]:
+            bulk_stream.shutdown()
+
+    @classmethod
+    def page_request(cls, host_connection, term_name, pager_id, page):
+        """Forward page request from browser to page server"""
+        key = (host_connection.terms.get(term_name, [None])[0], pager_id)
+        bulk_stream = cls._page_servers.get(key)
+        if bulk_stream:
+            IO_loop.add_callback(functools.partial(bulk_stream.send_line, {"page": page}))
+        else:
+            headers = {"x_gterm_response": "pagelet_page",
+                       "x_gterm_parameters": {"pager": pager_id, "page": page, "error": "Listing expired"}}
+            host_connection.screen_callback(term_name, "", "graphterm_output",
+                                            [{"validated": True, "headers": headers}, ""])
+
+    def on_close(self):
+        if self in self._all_streams:
+            self._all_streams.remove(self)
+        for waiters in (self._upload_waiters, self._page_servers):
+            for key, bulk_stream in waiters.items():
+                if bulk_stream is self:
+                    del waiters[key]
+        self.stream = None
+
+    def shutdown(self):
+        if not self.stream:
+            return
+        try:
+            self.stream.close()
+        except Exception:
+            pass
+        self.on_close()
+
+    def reply(self, status, **kwargs):
+        kwargs["status"] = status
+        self.send_line(kwargs)
+
+    def send_line(self, msg):
+        if self.stream:
+            self.stream.write(json.dumps(msg)+"\n")
+
+    def next_request(self):
+        if self.stream:
+            self.stream.read_until("\n", self.receive_header)
+
+    def receive_header(self, data):
+        cookie, sep, headers_json = data.strip().partition(" ")
+        if not cookie.isdigit() or cookie not in TerminalClient.all_cookies:
+            return self.shutdown()
+        try:
+            headers = json.loads(headers_json)
+            content_length = int(headers["content_length"])
+        except Exception, excp:
+            self.reply("error", error="Invalid headers: %s" % excp)
+            return self.shutdown()
+        if content_length > MAX_BULK_BYTES:
+            self.reply("error", error="Content length %d exceeds limit" % content_length)
+            return self.shutdown()
+        if self.stream:
+            self.stream.read_bytes(content_length, functools.partial(self.receive_content, cookie, headers))
+
+    def receive_content(self, cookie, headers, content):
+        term_info = TerminalClient.all_cookies.get(cookie)
+        if not term_info:
+            return self.shutdown()
+        host_connection, term_name = term_info
+
+        resp_type = headers.get("x_gterm_response")
+        if resp_type == "create_blob":
+            blob_id = headers.get("x_gterm_parameters", {}).get("blob", "")
+            if not self.blob_id_re.match(blob_id) or not headers.get("content_type"):
+                self.reply("error", error="Invalid blob id or content type")
+            elif not host_connection.lineterm or \
+                 not host_connection.lineterm.create_blob(term_name, blob_id, headers, base64.b64encode(content)):
+                self.reply("error", error="Unable to create blob %s" % blob_id)
+            else:
+                self.reply("ok", blob=blob_id)
+        elif resp_type == "upload_chunk":
+            params = headers.get("x_gterm_parameters", {})
+            key = (cookie, params.get("upload"), params.get("offset"))
+            if not params.get("upload") or not isinstance(params.get("offset"), (int, long)) or key in self._upload_waiters:
+                self.reply("error", error="Invalid upload chunk request")
+            else:
+                # Request chunk from browser; wait for upload_data
+                self._upload_waiters[key] = self
+                chunk_headers = {"x_gterm_response": "upload_chunk",
+                                 "x_gterm_parameters": dict(params, bulk=True)}
+                host_connection.screen_callback(term_name, "", "graphterm_output",
+                                                [{"validated": True, "headers": chunk_headers}, ""])
+                return
+        elif resp_type == "serve_pages":
+            pager_id = headers.get("x_gterm_parameters", {}).get("pager", "")
+            if not self.blob_id_re.match(pager_id) or (cookie, pager_id) in self._page_servers:
+                self.reply("error", error="Invalid pager id")
+            else:
+                self._page_servers[(cookie, pager_id)] = self
+                self.reply("ok", pager=pager_id)
+        elif resp_type == "page_content":
+            params = headers.get("x_gterm_parameters", {})
+            if self._page_servers.get((cookie, params.get("pager"))) is self:
+                page_headers = {"x_gterm_response": "pagelet_page", "x_gterm_parameters": params,
+                                "content_type": "text/html"}
+                host_connection.screen_callback(term_name, "", "graphterm_output",
+                                                [{"validated": True, "headers": page_headers}, base64.b64encode(content)])
+        else:
+            self.reply("error", error="Invalid bulk request %s" % resp_type)
+        self.next_request()
+
+    def send_chunk(self, save_params, data):
+        if not self.stream:
+            return
+        if save_params.get("x_gterm_error"):
+            self.reply("error", error=save_params["x_gterm_error"])
+        else:
+            if not isinstance(data, str):
+                data = data.encode(lineterm.ENCODING, "replace")
+            self.reply("ok", content_length=len(data), digest=hashlib.md5(data).hexdigest())
+            if data:
+                self.stream.write(data)
+        self.next_request()
+
+class BulkServer(TCPServer):
+    def handle_stream(self, stream, address):
+        BulkStream(stream).next_request()
+
+    @classmethod
+    def start(cls):
+        """Start bulk transfer server on a Unix socket (readable only by user)"""
+        global Bulk_server, Bulk_socket_path
+        try:
+            from tornado.netutil import bind_unix_socket
+        except ImportError:
+            return
+        if not hasattr(socket, "AF_UNIX"):
+            return
+        socket_path = os.path.join(gterm.App_dir, "bulk.%d.sock" % os.getpid())
+        try:
+            sock = bind_unix_socket(socket_path, mode=0600)
+            Bulk_server = cls()
+            Bulk_server.add_socket(sock)
+            Bulk_socket_path = socket_path
+            logging.warning("GraphTerm bulk transfers listening on %s", socket_path)
+        except Exception, excp:
+            logging.warning("Unable to create bulk transfer socket %s: %s", socket_path, excp)
+
+    @classmethod
+    def stop(cls):
+        global Bulk_server, Bulk_socket_path
+        BulkStream.shutdown_all()
+        if Bulk_server:
+            Bulk_server.stop()
+            Bulk_server = None
+        if Bulk_socket_path:
+            try:
+                os.remove(Bulk_socket_path)
+            except OSError:
+                pass
+            Bulk_socket_path = ""
+
 def gterm_shutdown(trace_shell=None):
     if trace_shell:
         trace_shell.shutdown()
@@ -830,6 +1183,7 @@ def gterm_shutdown(trace_shell=None):
         global IO_loop, IO_loop_control
         TerminalClient.shutdown_all()
         WidgetStream.shutdown_all()
+        BulkServer.stop()
         if IO_loop and IO_loop_control:
             IO_loop.stop()
             IO_loop = None
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+
+"""gtermload: Latency and fan-out load generator for gtermserver
+
+Starts a local gtermserver (with no authentication, on localhost), connects N
+simulated hosts (gtermhost.TerminalClient subclasses that echo keystrokes and
+generate synthetic output, without creating any pseudo-terminals) and M
+websocket watchers per terminal. The first watcher for each terminal is the
+controller, which sends keystrokes and measures keystroke-to-echo latency.
+
+Usage:
+    python gtermload.py -n 10 -m 5 -d 30
+    python gtermload.py -n 50 -m 2 -r 50 -k 20 -o results.json
+
+Requires tornado 3.0+ (for the websocket client)
+"""
+
+import json
+import optparse
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import tornado.httpclient
+import tornado.ioloop
+import tornado.websocket
+
+import gtermhost
+
+SERVER_STARTUP_SEC = 15
+CONNECT_TIMEOUT_SEC = 30
+HOST_PREFIX = "loadhost"
+TERM_PREFIX = "tty"
+ECHO_PREFIX = "ECHO "
+LINE_WIDTH = 80
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values)-1, int(round((pct/100.0) * (len(sorted_values)-1))))
+    return sorted_values[index]
+
+def row_update(update_rows, update_scroll, width=LINE_WIDTH, height=25):
+    return ["terminal", "row_update", [dict(alt_mode=False, reset=False, command="", active_rows=1, pre_offset=0),
+                                       width, height, 0, 0, update_rows, update_scroll]]
+
+def scroll_line(text):
+    return [0, 0, "", ["", {}], text, None]
+
+def get_process_stats(pid):
+    """Return (cpu_seconds, rss_kbytes) for process, using /proc if available, or ps"""
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            fields = f.read().rpartition(")")[2].split()
+        cpu_sec = (int(fields[11]) + int(fields[12])) / float(os.sysconf("SC_CLK_TCK"))
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return cpu_sec, int(line.split()[1])
+        return cpu_sec, 0
+    except Exception:
+        pass
+    try:
+        rss, cputime = subprocess.check_output(["ps", "-o", "rss=", "-o", "time=", "-p", str(pid)]).split()
+        secs = 0
+        for comp in cputime.replace("-", ":").split(":"):
+            secs = 60*secs + float(comp)
+        return secs, int(rss)
+    except Exception:
+        return 0.0, 0
+
+class LoadHost(gtermhost.TerminalClient):
+    """Simulated host: echoes keystrokes and generates synthetic output for its terminals"""
+    _all_connections = {}
+    def __init__(self, *args, **kwargs):
+        super(LoadHost, self).__init__(*args, **kwargs)
+        self.output_count = 0
+
+    def remote_request(self, term_name, from_user, req_list, _content=None):
+        for cmd in req_list:
+            action = cmd[0]
+            if action == "reconnect":
+                if term_name not in self.terms:
+                    self.terms[term_name] = ("", {})
+                    self.send_request("terminal_update", term_name, True)
+            elif action == "keypress":
+                self.send_request("response", term_name, "",
+                                  [row_update([[0, 0, "", ["", {}], [[0, ECHO_PREFIX+cmd[1]]], None]], [])])
+
+    def send_output(self, lines):
+        """Send synthetic scroll output to all terminals"""
+        if not self.rpc_ready:
+            return
+        for term_name in self.terms:
+            self.output_count += 1
+            text = ("%s %d " % (term_name, self.output_count)).ljust(LINE_WIDTH, "x")
+            self.send_request("response", term_name, "", [row_update([], [scroll_line(text)]*lines)])
+
+class LoadWatcher(object):
+    """Websocket client for a terminal; the controller also sends keystrokes"""
+    def __init__(self, stats, url, origin, controller=False):
+        self.stats = stats
+        self.controller = controller
+        self.conn = None
+        self.key_count = 0
+        self.key_times = {}
+        request = tornado.httpclient.HTTPRequest(url, headers={"Origin": origin},
+                                                 connect_timeout=CONNECT_TIMEOUT_SEC)
+        tornado.websocket.websocket_connect(request, callback=self.on_connect)
+
+    def on_connect(self, future):
+        try:
+            self.conn = future.result()
+        except Exception, excp:
+            self.stats["errors"] += 1
+            print >> sys.stderr, "gtermload: websocket connect error", excp
+            return
+        self.stats["connected"] += 1
+        self.conn.read_message(callback=self.on_message)
+
+    def on_message(self, future):
+        try:
+            message = future.result()
+        except Exception:
+            # Socket closed
+            message = None
+        if message is None:
+            if self.conn:
+                self.stats["closed"] += 1
+            self.conn = None
+            return
+        recv_time = time.time()
+        self.stats["messages"] += 1
+        self.stats["bytes"] += len(message)
+        if self.controller and self.key_times and ECHO_PREFIX in message:
+            for msg in json.loads(message):
+                if msg[0] == "terminal" and msg[1] == "row_update":
+                    for row in msg[2][5]:
+                        text = "".join(span[1] for span in row[4])
+                        if text.startswith(ECHO_PREFIX):
+                            send_time = self.key_times.pop(text[len(ECHO_PREFIX):], None)
+                            if send_time:
+                                self.stats["latencies"].append(recv_time - send_time)
+        if self.conn:
+            self.conn.read_message(callback=self.on_message)
+
+    def send_key(self):
+        if not self.conn:
+            return
+        self.key_count += 1
+        key = "k%d" % self.key_count
+        self.key_times[key] = time.time()
+        self.conn.write_message(json.dumps([["keypress", key]]))
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+def wait_for_port(port, timeout):
+    end_time = time.time() + timeout
+    while time.time() < end_time:
+        try:
+            sock = socket.create_connection(("localhost", port), timeout=1)
+            sock.close()
+            return True
+        except socket.error:
+            time.sleep(0.2)
+    return False
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = optparse.OptionParser(usage="usage: %prog [-n hosts] [-t terms_per_host] [-m watchers_per_term] [-d duration]")
+    parser.add_option("-n", "--hosts", dest="hosts", type="int", default=4,
+                      help="Number of simulated hosts (default: 4)")
+    parser.add_option("-t", "--terms", dest="terms", type="int", default=1,
+                      help="Terminals per host (default: 1)")
+    parser.add_option("-m", "--watchers", dest="watchers", type="int", default=3,
+                      help="Websocket watchers per terminal, including controller (default: 3)")
+    parser.add_option("-d", "--duration", dest="duration", type="float", default=10.0,
+                      help="Measurement duration in seconds (default: 10)")
+    parser.add_option("-r", "--output_rate", dest="output_rate", type="float", default=20.0,
+                      help="Output updates per second per host (default: 20)")
+    parser.add_option("-l", "--lines", dest="lines", type="int", default=5,
+                      help="Scroll lines per output update (default: 5)")
+    parser.add_option("-k", "--key_rate", dest="key_rate", type="float", default=10.0,
+                      help="Keystrokes per second per terminal (default: 10)")
+    parser.add_option("-p", "--port", dest="port", type="int", default=8950,
+                      help="HTTP port for local server (default: 8950)")
+    parser.add_option("", "--server_pid", dest="server_pid", type="int", default=0,
+                      help="Use already running server with this process id (on --port)")
+    parser.add_option("-o", "--output", dest="output", default="",
+                      help="Save results to JSON file")
+    (options, args) = parser.parse_args(args)
+
+    http_port = options.port
+    host_port = http_port - 1
+    server_proc = None
+    if options.server_pid:
+        server_pid = options.server_pid
+    else:
+        server_cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "gtermserver.py"),
+                      "--auth_type=none", "--no_formcheck", "--nolocal", "--widget_port=0",
+                      "--host=localhost", "--port=%d" % http_port, "--internal_port=%d" % host_port]
+        server_proc = subprocess.Popen(server_cmd)
+        server_pid = server_proc.pid
+
+    try:
+        if not wait_for_port(http_port, SERVER_STARTUP_SEC) or not wait_for_port(host_port, SERVER_STARTUP_SEC):
+            sys.exit("gtermload: Server failed to start on port %d" % http_port)
+        return run_load(options, http_port, host_port, server_pid)
+    finally:
+        if server_proc:
+            server_proc.terminate()
+            server_proc.wait()
+
+def run_load(options, http_port, host_port, server_pid):
+    io_loop = tornado.ioloop.IOLoop.instance()
+    gtermhost.IO_loop = io_loop
+
+    stats = {"connected": 0, "closed": 0, "errors": 0, "messages": 0, "bytes": 0, "latencies": []}
+    hosts = []
+    for j in range(options.hosts):
+        host_name = "%s%d" % (HOST_PREFIX, j+1)
+        hosts.append(LoadHost.get_client(host_name, connect=("localhost", host_port, ""),
+                                         connect_kw={"io_loop": io_loop, "key_id": str(host_port)}))
+
+    origin = "http://localhost:%d" % http_port
+    controllers = []
+    watchers = []
+    def connect_watchers():
+        for host in hosts:
+            for k in range(options.terms):
+                path = "%s/%s%d" % (host.connection_id, TERM_PREFIX, k+1)
+                url = "ws://localhost:%d/_websocket/%s/?qauth=load" % (http_port, path)
+                controllers.append(LoadWatcher(stats, url, origin, controller=True))
+                watchers.append(controllers[-1])
+        # Delay connecting watchers, so that controllers create the terminals
+        io_loop.add_timeout(time.time()+1, connect_viewers)
+
+    def connect_viewers():
+        for host in hosts:
+            for k in range(options.terms):
+                path = "%s/%s%d" % (host.connection_id, TERM_PREFIX, k+1)
+                url = "ws://localhost:%d/_websocket/%s/watch?qauth=load" % (http_port, path)
+                for m in range(options.watchers-1):
+                    watchers.append(LoadWatcher(stats, url, origin))
+
+    callbacks = []
+    results = {}
+    def start_measurement():
+        if stats["connected"] + stats["errors"] < len(hosts)*options.terms*options.watchers:
+            if time.time() < start_time + CONNECT_TIMEOUT_SEC:
+                io_loop.add_timeout(time.time()+0.5, start_measurement)
+                return
+            print >> sys.stderr, "gtermload: Only %d of %d watchers connected" % (stats["connected"], len(watchers))
+        stats["messages"] = 0
+        stats["bytes"] = 0
+        del stats["latencies"][:]
+        results["cpu_start"], results["rss_start"] = get_process_stats(server_pid)
+        results["time_start"] = time.time()
+        if options.output_rate > 0:
+            callbacks.append(tornado.ioloop.PeriodicCallback(lambda: [host.send_output(options.lines) for host in hosts],
+                                                             1000.0/options.output_rate, io_loop=io_loop))
+        if options.key_rate > 0:
+            callbacks.append(tornado.ioloop.PeriodicCallback(lambda: [controller.send_key() for controller in controllers],
+                                                             1000.0/options.key_rate, io_loop=io_loop))
+        for callback in callbacks:
+            callback.start()
+        io_loop.add_timeout(time.time()+options.duration, stop_measurement)
+
+    def stop_measurement():
+        elapsed = time.time() - results["time_start"]
+        cpu_end, rss_end = get_process_stats(server_pid)
+        for callback in callbacks:
+            callback.stop()
+        for watcher in watchers:
+            watcher.close()
+        for host in hosts:
+            host.shutdown()
+        latencies = sorted(stats["latencies"])
+        keys_sent = sum(controller.key_count for controller in controllers)
+        results.update({"hosts": len(hosts), "terminals": len(controllers), "watchers": stats["connected"],
+                        "errors": stats["errors"], "elapsed": elapsed,
+                        "keys_sent": keys_sent, "keys_echoed": len(latencies),
+                        "latency_ms": dict(("p%d" % pct, 1000*percentile(latencies, pct)) for pct in (50, 90, 99, 100)),
+                        "ws_messages_per_sec": stats["messages"]/elapsed,
+                        "ws_mbytes_per_sec": stats["bytes"]/(elapsed*1.0e6),
+                        "server_cpu_pct": 100.0*(cpu_end-results["cpu_start"])/elapsed,
+                        "server_rss_kb": rss_end})
+        io_loop.add_timeout(time.time()+0.5, io_loop.stop)
+
+    start_time = time.time()
+    io_loop.add_timeout(time.time()+1, connect_watchers)
+    io_loop.add_timeout(time.time()+2, start_measurement)
+    io_loop.start()
+
+    if not results.get("elapsed"):
+        sys.exit("gtermload: Measurement not completed")
+
+    print "hosts=%d terminals=%d watchers=%d errors=%d duration=%.1fs" % (results["hosts"], results["terminals"],
+                                                                          results["watchers"], results["errors"],
+                                                                          results["elapsed"])
+    print "keystroke-to-echo latency (ms): p50=%(p50).1f p90=%(p90).1f p99=%(p99).1f max=%(p100).1f" % results["latency_ms"],
+    print "(%d/%d echoed)" % (results["keys_echoed"], results["keys_sent"])
+    print "fan-out: %.0f websocket messages/s, %.2f MB/s" % (results["ws_messages_per_sec"], results["ws_mbytes_per_sec"])
+    print "server: cpu=%.1f%% rss=%d KB" % (results["server_cpu_pct"], results["server_rss_kb"])
+
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(json.dumps(results, indent=1)+"\n")
+    return results
+
+if __name__ == "__main__":
+    main()
@@ -45,6 +45,7 @@ except ImportError:
 import about
 import gtermhost
 import lineterm
+import metrics
 import optconfig
 import packetserver
 
@@ -86,11 +87,18 @@ COOKIE_TIMEOUT = 86400
 
 REQUEST_TIMEOUT = 15
 
+RANGE_RE = re.compile(r"^bytes=(\d+)-(\d*)$")   # Single byte range for file requests
+
 AUTH_DIGITS = 12    # Form authentication code hex-digits
                     # Note: Less than half of the 32 hex-digit state id should be used for form authentication
 
 RSS_FEED_URL = "http://code.mindmeldr.com/graphterm/graphterm-announce/posts.xml"
 
+Ws_writes = metrics.counter("gterm_websocket_writes_total", "Websocket messages written")
+Ws_write_bytes = metrics.counter("gterm_websocket_write_bytes_total", "Websocket bytes written")
+Ws_queue_bytes = metrics.histogram("gterm_websocket_queue_bytes", "Websocket write buffer size after write",
+                                   buckets=metrics.BYTE_BUCKETS)
+
 def cgi_escape(s):
     return cgi.escape(s) if s else ""
 
@@ -199,6 +207,19 @@ def ssl_cert_gen(certfile, keyfile="", hostname="localhost", cwd=None, new=False
 def get_user(ws):
     return ws.authorized.get("user", "") if ws and ws.authorized else ""
 
+def get_write_buffer_bytes(stream):
+    """Returns bytes pending in IOStream write buffer (depends upon tornado version)"""
+    size = getattr(stream, "_write_buffer_size", None)
+    if size is not None:
+        return size
+    write_buffer = getattr(stream, "_write_buffer", None)
+    if isinstance(write_buffer, collections.deque):
+        return sum(len(chunk) for chunk in write_buffer)
+    try:
+        return len(write_buffer)
+    except Exception:
+        return 0
+
 def get_first_arg(query_data, argname, default=""):
     return query_data.get(argname, [default])[0]
 
@@ -955,6 +976,9 @@ class GTSocket(tornado.websocket.WebSocketHandler):
     def gterm_write(self, data, binary=False):
         try:
             self.write_message(data, binary=binary)
+            Ws_writes.inc()
+            Ws_write_bytes.inc(len(data))
+            Ws_queue_bytes.observe(get_write_buffer_bytes(getattr(self.ws_connection, "stream", None)))
         except Exception, excp:
             logging.error("gterm_write: ERROR %s", excp)
             closed_excp = getattr(tornado.websocket, "WebSocketClosedError", None)
@@ -1468,7 +1492,7 @@ class TerminalConnection(packetserver.RPCLink, packetserver.PacketConnection):
                 if tparams and tparams["nb_submit"]:
                     fpath = os.path.join(tparams["nb_submit"], user+"_"+os.path.basename(tparams["nb_file"]))
                     thost, tname = tpath.split("/")
-                    TerminalConnection.send_to_connection(thost, "request", tname, "", [["submit_notebook", term_path, fpath, filedata]])
+                    TerminalConnection.send_to_connection(thost, "request", tname, "", [["submit_notebook", term_path, fpath, filedata, user]])
 
             elif  msg[0] == "terminal" and msg[1] == "remote_alert":
                 if GTSocket.is_super_or_single(terminal_params["owner"], terminal_params["auth_type"]):
@@ -1789,12 +1813,21 @@ class ProxyFileHandler(tornado.web.RequestHandler):
                         self.cached_copy = (btime, bheaders, bcontent)
                         if_mod_since = last_modified
 
+        byte_range = None
+        range_match = self.request.path.startswith(gterm.FILE_PREFIX) and self.request.method == "GET" and \
+                      RANGE_RE.match(self.request.headers.get("Range", ""))
+        if range_match:
+            # Partial content request for file (never cached)
+            byte_range = [int(range_match.group(1)), int(range_match.group(2)) if range_match.group(2) else None]
+            self.cached_copy = None
+            if_mod_since = None
+
         self.async_id = self.get_async_id()
         self._async_requests[self.async_id] = self
 
         self.timeout_callback = IO_loop.add_timeout(time.time()+REQUEST_TIMEOUT, functools.partial(self.complete_request, self.async_id))
 
-        TerminalConnection.send_to_connection(host, "request", "", "", [["file_request", self.async_id, self.request.method, self.file_path, if_mod_since]])
+        TerminalConnection.send_to_connection(host, "request", "", "", [["file_request", self.async_id, self.request.method, self.file_path, if_mod_since, byte_range]])
 
     def finish_write(self, headers, content, cache=False):
         for name, value in headers:
@@ -1809,7 +1842,7 @@ class ProxyFileHandler(tornado.web.RequestHandler):
             Proxy_cache.add_blob(self.request.path, headers, content)
 
     def complete_get(self, status=(), last_modified=None, etag=None, content_type=None, content_length=None,
-                     content_b64=""):
+                     content_range=None, digest=None, content_b64=""):
         # Callback for get
         if not status:
             # Timed out
@@ -1827,11 +1860,14 @@ class ProxyFileHandler(tornado.web.RequestHandler):
             self.finish()
             return
 
-        if status[0] != 200:
+        if status[0] not in (200, 206):
             # "Error" status
             self.send_error(status[0])
             return
 
+        if content_range:
+            self.set_status(206)
+
         headers = []
         content = ""
 
@@ -1855,6 +1891,13 @@ class ProxyFileHandler(tornado.web.RequestHandler):
         if etag:
             headers.append(("Etag", etag))
 
+        if self.request.path.startswith(gterm.FILE_PREFIX):
+            headers.append(("Accept-Ranges", "bytes"))
+
+        if content_range:
+            headers.append(("Content-Range", content_range))
+            headers.append(("X-Gterm-Digest", digest))
+
         if self.request.path.startswith(gterm.BLOB_PREFIX):
             headers.append(("Expires", datetime.datetime.utcnow() +
                                       datetime.timedelta(seconds=MAX_CACHE_TIME)))
@@ -1862,8 +1905,8 @@ class ProxyFileHandler(tornado.web.RequestHandler):
         elif last_modified and content_type:
             headers.append(("Cache-Control", "private, max-age=0, must-revalidate"))
 
-        cache = self.request.method != "HEAD" and (self.request.path.startswith(gterm.BLOB_PREFIX) or
-                                                     (Cache_files and last_modified) )
+        cache = self.request.method != "HEAD" and not content_range and \
+                (self.request.path.startswith(gterm.BLOB_PREFIX) or (Cache_files and last_modified) )
         self.finish_write(headers, content, cache=cache)
 
 def same_group(user1, user2):
@@ -1942,6 +1985,22 @@ def run_server(options, args):
             self.set_header("Content-Type", "text/plain")
             self.write(server_nonce+":"+client_token)
 
+    class MetricsHandler(tornado.web.RequestHandler):
+        """Serves metrics in Prometheus text format, for super users
+        (or with header "Authorization: Bearer <metrics_token>", for scrapers)
+        """
+        def get(self):
+            metrics_token = Server_settings["metrics_token"]
+            auth_type, sep, bearer_token = self.request.headers.get("Authorization", "").partition(" ")
+            state_value = GTSocket.get_request_state(self.request)
+            if not (GTSocket.get_auth_type() == GTSocket.NULL_AUTH or
+                    (metrics_token and auth_type.lower() == "bearer" and
+                     hmac.compare_digest(str(bearer_token.strip()), metrics_token)) or
+                    (state_value and GTSocket.is_super_or_single(state_value["user"], state_value["auth_type"]))):
+                raise tornado.web.HTTPError(403)
+            self.set_header("Content-Type", "text/plain; version=0.0.4")
+            self.write(metrics.export_text())
+
     class GoogleOAuth2LoginHandler(tornado.web.RequestHandler, tornado.auth.GoogleOAuth2Mixin):
         @tornado.gen.coroutine
         def get(self):
@@ -2075,7 +2134,8 @@ If you have not set up the GraphTerm web app for Google authentication, here is
                        "nb_autosave": options.nb_autosave, "nb_server": options.nb_server,
                        "nogoog_auth": options.nogoog_auth, "user_groups": membership_dict,
                        "users_dir": options.users_dir, "gtermhost_args": gtermhost_args,
-                       "mathjax": not options.nomathjax, "max_terminals": options.max_terminals}
+                       "mathjax": not options.nomathjax, "max_terminals": options.max_terminals,
+                       "metrics_token": str(options.metrics_token)}
 
     Host_settings = {"lterm_params": {"nb_ext": options.nb_ext, "term_opts": options.term_opts,
                                       "lc_export": options.lc_export},
@@ -2149,6 +2209,7 @@ If you have not set up the GraphTerm web app for Google authentication, here is
                 (r"/_steal/.*", ActionHandler),
                 (r"/_watch/.*", ActionHandler),
                 (r"/_websocket/.*", GTSocket),
+                (r"/_metrics", MetricsHandler),
                 (gterm.STATIC_PREFIX+r"(.*)", tornado.web.StaticFileHandler, {"path": Doc_rootdir}),
                 (gterm.BLOB_PREFIX+r"([\w\-]+/"+gterm.TRUSTED_PREFIX+r".*)", ProxyFileHandler, {}),
                 (gterm.FILE_PREFIX+r"(.*)", ProxyFileHandler, {}),
@@ -2470,7 +2531,7 @@ def main():
     parser.add_option("term_encoding", default="utf-8",
                       help="Terminal character encoding (utf-8/latin-1/...)")
     parser.add_option("term_opts", default="",
-                      help="Terminal options: no_colors,no_pyindent,no_untrusted,...")
+                      help="Terminal options: no_colors,no_pyindent,no_untrusted,note_cache,...")
     parser.add_option("term_settings", default="{}",
                       help="Terminal settings (JSON)")
     parser.add_option("max_terminals", default=10,
@@ -2481,6 +2542,8 @@ def main():
                       help="Log to ~/.graphterm/gtermserver.log")
     parser.add_option("widget_port", default=-1, opt_type="int",
                       help="Port number for widget socket (default: -1 for auto)")
+    parser.add_option("metrics_token", default="",
+                      help="Bearer token for scraping /_metrics (Authorization header)")
 
     parser.add_option("daemon", default="",
                       help="daemon=start/stop/restart/status")
@@ -46,6 +46,8 @@ import uuid
 
 from bin import gterm
 
+import metrics
+
 GT_PREFIX = gterm.GT_PREFIX
 
 ESCAPE_BUF_LEN = 256
@@ -56,6 +58,13 @@ CHUNK_BYTES = 4096            # Chunk size for receiving data in stdin
 
 MAX_PAGELET_BYTES = 5000000   # Max size for pagelet buffer
 
+MAX_NOTE_CACHE_BYTES = 20000000   # Max size for notebook cell output cache (term_opts: note_cache)
+                                  # (Unchanged cells are replayed from cache, without re-execution)
+
+Pty_bytes_read = metrics.counter("gterm_pty_bytes_read_total", "Bytes read from pseudo-terminals")
+Screen_update_seconds = metrics.histogram("gterm_screen_update_seconds", "ScreenBuf.update duration")
+Loop_iteration_seconds = metrics.histogram("gterm_multiplex_loop_seconds", "Multiplex.loop iteration time (excluding select wait)")
+
 IDLE_TIMEOUT = 300      # Idle timeout in seconds
 UPDATE_INTERVAL = 0.05  # Fullscreen update time interval
 TERM_TYPE = "xterm"     # "screen" may be a better default terminal, but arrow keys do not always work
@@ -762,6 +771,15 @@ class ScreenBuf(object):
                alt_screen=None, pdelim=[], reconnecting=False):
         """ Returns full_update, update_rows, update_scroll
         """
+        start_time = time.time()
+        try:
+            return self.update_aux(active_rows, width, height, cursorx, cursory, main_screen,
+                                   alt_screen=alt_screen, pdelim=pdelim, reconnecting=reconnecting)
+        finally:
+            Screen_update_seconds.observe(time.time()-start_time)
+
+    def update_aux(self, active_rows, width, height, cursorx, cursory, main_screen,
+                   alt_screen=None, pdelim=[], reconnecting=False):
         full_update = self.full_update or reconnecting
 
         if not reconnecting and (width != self.width or height != self.height):
@@ -910,6 +928,9 @@ class Terminal(object):
 
         self.note_count = 0
         self.note_screen_buf = ScreenBuf("", colors="no_colors" not in self.term_opts)
+        self.note_exec_cache = OrderedDict() if "note_cache" in self.term_opts else None
+        self.note_exec_cache_bytes = 0
+        self.note_exec_session = None   # Foreground process group of interpreter for cached outputs
         self.reset_note()
 
         self.init()
@@ -932,6 +953,7 @@ class Terminal(object):
         self.note_params = {}
         self.note_cells = None
         self.note_input = []
+        self.note_cache_pending = None
         self.note_start = None
         self.note_slide = None
         self.note_share = ""
@@ -1977,6 +1999,10 @@ class Terminal(object):
         if cur_cell["cellType"] not in MARKUP_TYPES:
             cur_cell["cellOutput"] = strip_prompt_lines(self.note_screen_buf.scroll_lines, self.note_prompts)
             self.note_update_time = time.time()
+            if self.note_cache_pending and self.note_cache_pending[0] == cur_index and self.note_found_prompt:
+                # Execution completed; cache output
+                self.cache_cell_output(self.note_cache_pending[1], cur_cell["cellOutput"])
+        self.note_cache_pending = None
         self.note_screen_buf.clear_buf()
         self.note_cells["curIndex"] = 0
             
@@ -2287,6 +2313,19 @@ class Terminal(object):
             return
 
         cur_cell["cellParams"]["executed"] = True
+        self.note_cache_pending = None
+        if self.note_exec_cache is not None:
+            session = self.get_fg_process_group()
+            if session != self.note_exec_session:
+                # New (or restarted) interpreter; state created by previously executed cells is lost
+                self.note_exec_cache.clear()
+                self.note_exec_cache_bytes = 0
+                self.note_exec_session = session
+            cache_key = self.cell_cache_key(cur_loc, cell_lines)
+            if self.replay_cell_output(cache_key):
+                return
+            self.note_cache_pending = (cur_index, cache_key)
+
         input_lines = cell_lines[:]   # Must be a copy as it is modified later
 
         if "no_pyindent" not in self.term_opts and self.note_params["lang"] == "python":
@@ -2433,8 +2472,80 @@ class Terminal(object):
 
         return out_lines
 
+    def get_fg_process_group(self):
+        """Return foreground process group id for terminal (or None)"""
+        try:
+            return os.tcgetpgrp(self.fd)
+        except Exception:
+            return None
+
+    def cell_cache_key(self, cell_loc, cell_lines):
+        """Return hash of cell input lines, chained with the inputs of all preceding code cells"""
+        def encoded(lines):
+            text = "\n".join(lines)
+            return text.encode(ENCODING, "replace") if isinstance(text, unicode) else text
+
+        digest = hashlib.sha1(encoded([self.note_params["file"], self.note_params["command"], self.note_params["lang"]]))
+        for cindex in self.note_cells["cellIndices"][:cell_loc]:
+            cell = self.note_cells["cells"][cindex]
+            if cell["cellType"] not in MARKUP_TYPES:
+                digest = hashlib.sha1(digest.hexdigest() + encoded(cell["cellInput"]))
+        return hashlib.sha1(digest.hexdigest() + encoded(cell_lines)).hexdigest()
+
+    def cache_cell_output(self, cache_key, cell_output):
+        """Save copy of cell output (and any image blobs it displays) in execution cache"""
+        blobs = {}
+        cache_bytes = 0
+        for scroll_line in cell_output:
+            blob_id = urllib.unquote(scroll_line[JPARAMS][JOPTS].get("blob", ""))
+            if blob_id and blob_id in self.note_screen_buf.blobs:
+                blobs[blob_id] = self.note_screen_buf.blobs[blob_id]
+                cache_bytes += len(blobs[blob_id][1])
+            cache_bytes += len(scroll_line[JLINE] or "") + len(scroll_line[JMARKUP] or "")
+
+        if cache_bytes > MAX_NOTE_CACHE_BYTES:
+            return
+        if cache_key in self.note_exec_cache:
+            self.note_exec_cache_bytes -= self.note_exec_cache.pop(cache_key)[-1]
+        while self.note_exec_cache and self.note_exec_cache_bytes + cache_bytes > MAX_NOTE_CACHE_BYTES:
+            # Evict least recently used entries
+            self.note_exec_cache_bytes -= self.note_exec_cache.popitem(last=False)[1][-1]
+        self.note_exec_cache[cache_key] = (self.note_params["file"], copy.deepcopy(cell_output), blobs, cache_bytes)
+        self.note_exec_cache_bytes += cache_bytes
+
+    def replay_cell_output(self, cache_key):
+        """Display cached output for current cell, instead of executing it. Return True on cache hit.
+        Note: Replayed cells are not executed, i.e., any side effects (such as modified variables or files)
+        are skipped. Outputs are only cached within an interpreter session.
+        """
+        entry = self.note_exec_cache.pop(cache_key, None)
+        if not entry:
+            return False
+        self.note_exec_cache[cache_key] = entry   # Most recently used
+        filepath, cell_output, blobs, cache_bytes = entry
+        for blob_id, (content_type, content_b64) in blobs.iteritems():
+            # Re-create blobs, which may have been deleted since output was cached
+            self.note_screen_buf.add_blob(blob_id, content_type, content_b64)
+            self.screen_callback(self.term_name, "", "create_blob",
+                                 [blob_id, {"content_type": content_type,
+                                            "content_length": len(base64.b64decode(content_b64))}, content_b64])
+        self.note_input = []
+        self.note_screen_buf.clear_buf()
+        self.note_screen_buf.append_scroll(copy.deepcopy(cell_output))
+        self.zero_screen()
+        self.cursor_x = 0
+        self.note_expect_prompt = False
+        self.note_found_prompt = True
+        self.needs_updating = True
+        return True
+
     def erase_output(self, all_cells):
         cur_index = self.note_cells["curIndex"]
+        if all_cells and self.note_exec_cache:
+            # Force re-execution of notebook
+            for cache_key, entry in self.note_exec_cache.items():
+                if entry[0] == self.note_params["file"]:
+                    self.note_exec_cache_bytes -= self.note_exec_cache.pop(cache_key)[-1]
         for cell in self.note_cells["cells"].itervalues():
             if not all_cells and cell["cellIndex"] != cur_index:
                 continue
@@ -3696,8 +3807,10 @@ class Terminal(object):
 class Multiplex(object):
     def __init__(self, screen_callback, command=None, shared_secret="",
                  host="", server_url="", term_type="linux", api_version="",
-                 widget_port=0, prompt_list=[], blob_server="", term_params={}, logfile="", app_name="graphterm"):
+                 widget_port=0, prompt_list=[], blob_server="", term_params={}, logfile="", app_name="graphterm",
+                 bulk_socket=""):
         """ prompt_list = [prefix, suffix, format, remote_format]
+        bulk_socket: path of Unix socket for binary bulk transfers (see gtermhost.BulkStream)
         """
         ##signal.signal(signal.SIGCHLD, signal.SIG_IGN)
         self.screen_callback = screen_callback
@@ -3711,6 +3824,7 @@ class Multiplex(object):
         self.api_version = api_version
         self.term_params = term_params
         self.widget_port = widget_port
+        self.bulk_socket = bulk_socket
         self.blob_server = blob_server
         self.logfile = logfile
         self.app_name = app_name
@@ -3838,6 +3952,9 @@ class Multiplex(object):
         if self.widget_port:
             env.append( (GT_PREFIX+"SOCKET", "/dev/tcp/localhost/%d" % self.widget_port) )
 
+        if self.bulk_socket:
+            env.append( (GT_PREFIX+"BULK_SOCKET", self.bulk_socket) )
+
         if self.blob_server:
             env.append( (GT_PREFIX+"BLOB_SERVER", self.blob_server) )
 
@@ -3977,6 +4094,7 @@ class Multiplex(object):
                     self.term_update(term_name)
                     self.kill_term(term_name)
                     return
+                Pty_bytes_read.inc(len(data))
                 term.pty_read(data)
             except (KeyError, IOError, OSError):
                 print >> sys.stderr, "lineterm: Error in reading from %s; closing it" % term_name
@@ -4016,6 +4134,17 @@ class Multiplex(object):
                 return
             term.save_data(save_params, filedata)
 
+    def create_blob(self, term_name, blob_id, headers, content_b64):
+        """Create blob from base64 encoded content (e.g., received over the bulk transfer socket),
+        with the same bookkeeping as blobs created via escape sequences. Returns blob_id, or null string on error.
+        """
+        with self.lock:
+            term = self.proc.get(term_name)
+            if not term:
+                return ""
+            headers = dict(headers, x_gterm_encoding="base64")
+            return term.create_blob(content_b64, blob_id, headers=headers)
+
     def get_finder(self, term_name, kind, directory=""):
         with self.lock:
             term = self.proc.get(term_name)
@@ -4157,6 +4286,7 @@ class Multiplex(object):
                     time.sleep(0.02)
                     continue
                 inputs, outputs, errors = select.select(fd_dict.keys(), [], [], 0.02)
+                start_time = time.time()
                 for fd in inputs:
                     try:
                         self.term_read(fd_dict[fd])
@@ -4180,6 +4310,7 @@ class Multiplex(object):
                     self.check_kill_idle = False
                     self.kill_idle()
 
+                Loop_iteration_seconds.observe(time.time()-start_time)
                 if len(inputs):
                     time.sleep(0.002)
             except Exception, excp:
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+#
+
+"""
+metrics: Counters and latency histograms for hot paths, exported in Prometheus text format
+
+Metrics are registered once, at module level, by the modules that update them:
+
+    Packets_received = metrics.counter("gterm_packets_received_total", "Packets received", ["connector"])
+    Packets_received.inc(labels=("TerminalClient",))
+
+    Update_seconds = metrics.histogram("gterm_screen_update_seconds", "ScreenBuf.update duration")
+    Update_seconds.observe(elapsed)
+
+Updates are thread-safe (the lineterm multiplexing loop runs in its own thread).
+"""
+
+from __future__ import with_statement
+
+import bisect
+import threading
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+BYTE_BUCKETS = (0, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+Registry = OrderedDict()
+Registry_lock = threading.Lock()
+
+def format_labels(labelnames, labels, extra=""):
+    comps = ['%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+             for name, value in zip(labelnames, labels)]
+    if extra:
+        comps.append(extra)
+    return "{%s}" % ",".join(comps) if comps else ""
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value) if value != float("inf") else "+Inf"
+    return str(value)
+
+class Metric(object):
+    metric_type = ""
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def reset(self):
+        with self.lock:
+            self.values = {}
+
+    def export(self):
+        """Returns list of lines in Prometheus text format"""
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.metric_type)]
+        with self.lock:
+            items = sorted(self.values.items())
+        for labels, value in items:
+            lines += self.export_value(labels, value)
+        return lines
+
+    def export_value(self, labels, value):
+        return ["%s%s %s" % (self.name, format_labels(self.labelnames, labels), format_value(value))]
+
+class Counter(Metric):
+    metric_type = "counter"
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    metric_type = "gauge"
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+class Histogram(Metric):
+    metric_type = "histogram"
+    def __init__(self, name, help, labelnames=(), buckets=TIME_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames=labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                # [bucket_counts (last is +Inf), sum, count]
+                entry = [[0]*(len(self.buckets)+1), 0, 0]
+                self.values[labels] = entry
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def export_value(self, labels, value):
+        bucket_counts, total, count = value[0][:], value[1], value[2]
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets+(float("inf"),), bucket_counts):
+            cumulative += bucket_count
+            lines.append("%s_bucket%s %d" % (self.name, format_labels(self.labelnames, labels, 'le="%s"' % format_value(float(bound))), cumulative))
+        lines.append("%s_sum%s %s" % (self.name, format_labels(self.labelnames, labels), format_value(total)))
+        lines.append("%s_count%s %d" % (self.name, format_labels(self.labelnames, labels), count))
+        return lines
+
+def register(metric_class, name, *args, **kwargs):
+    """Returns registered metric with name, creating it if need be"""
+    with Registry_lock:
+        if name not in Registry:
+            Registry[name] = metric_class(name, *args, **kwargs)
+        elif not isinstance(Registry[name], metric_class):
+            raise Exception("Metric %s already registered with type %s" % (name, Registry[name].metric_type))
+        return Registry[name]
+
+def counter(name, help, labelnames=()):
+    return register(Counter, name, help, labelnames=labelnames)
+
+def gauge(name, help, labelnames=()):
+    return register(Gauge, name, help, labelnames=labelnames)
+
+def histogram(name, help, labelnames=(), buckets=TIME_BUCKETS):
+    return register(Histogram, name, help, labelnames=labelnames, buckets=buckets)
+
+def export_text():
+    """Returns all registered metrics in Prometheus text exposition format"""
+    with Registry_lock:
+        metrics = Registry.values()
+    lines = []
+    for metric in metrics:
+        lines += metric.export()
+    return "\n".join(lines) + "\n"
+
+def reset_all():
+    with Registry_lock:
+        metrics = Registry.values()
+    for metric in metrics:
+        metric.reset()
@@ -166,6 +166,7 @@ License
 
 from __future__ import with_statement
 
+import bisect
 import cgi
 import cgitb
 import codeop
@@ -173,12 +174,15 @@ import collections
 import copy
 import cPickle
 import datetime
+import fnmatch
 import functools
 import hashlib
 import hmac
 import inspect
 import logging
 import logging.handlers
+import marshal
+import operator
 import os
 import os.path
 import pprint
@@ -187,6 +191,7 @@ import random
 import re
 import select
 import shlex
+import socket
 import sqlite3
 import StringIO
 import struct
@@ -229,6 +234,10 @@ try:
     from collections import MutableMapping
 except ImportError:
     from UserDict import DictMixin as MutableMapping
+try:
+    import reprlib
+except ImportError:
+    import repr as reprlib
 
 
 OTRACE_VERSION = "0.30.9"
@@ -254,6 +263,24 @@ TRACE_OFFSET = 6
 
 MAX_PICKLE_CHECK_DEPTH = 3      # Max depth to check for pickleability
 MAX_PICKLE_DATA_LENGTH = 10000  # Max length for individual pickled component data length
+MAX_SNAPSHOT_REPR = 200         # Max length of object repr saved in snapshot (when snapshot parameter is set)
+MAX_SIZE_DEPTH = 4              # Max depth of containers/attributes traversed to estimate context memory size
+MAX_SIZE_ITEMS = 1000           # Max items traversed per container to estimate size (remainder is extrapolated)
+MAX_PICKLE_QUEUE = 1000         # Max contexts queued for writing to pickle database (excess contexts are dropped)
+MAX_PICKLE_BATCH = 100          # Max contexts written to pickle database in a single transaction
+PICKLE_PAGE_SIZE = 1000         # Records fetched per query when iterating over pickle database
+MAX_UNPICKLE_KEYS = 100000      # Default max keys loaded by unpickle command
+MAX_EXPORT_QUEUE = 10000        # Max trace events queued for export (excess events are dropped)
+MAX_EXPORT_BATCH = 500          # Max trace events written to export destination in a single write
+MAX_EXPORT_DETAIL = 200         # Max length of return value/exception repr in exported events
+EXPORT_MAX_BYTES = 10*1024*1024 # Export log file size at which it is rotated
+EXPORT_BACKUP_COUNT = 5         # No. of rotated export log files kept (file.1, file.2, ...)
+EXPORT_RECONNECT_SEC = 5        # Delay before reconnecting to export socket after error (events are dropped meanwhile)
+EXPORT_MAGIC = "OTX1"           # Start of each export stream (log file or socket connection)
+EXPORT_SOCKET_PREFIX = "unix:"  # Export destination prefix for Unix domain socket
+
+PROFILE_BUCKETS = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)   # Profile latency histogram bucket bounds (sec)
+PROFILE_TOP = 20                # Default number of functions listed by profile command
 
 ALL_DIR = "all"
 BROWSER_DIR = "browser"
@@ -275,7 +302,7 @@ OT_DIRS = set(DIR_LIST)
 DIR_PREFIX = dict((dir_name, PATH_SEP + BASE_DIR + PATH_SEP + dir_name + PATH_SEP) for dir_name in DIR_LIST)
 
 BREAK_ACTIONS = ["break", "ipdb", "pdb"]
-TRACE_ACTIONS = BREAK_ACTIONS + ["hold", "tag"]
+TRACE_ACTIONS = BREAK_ACTIONS + ["hold", "park", "tag"]
 
 TRACE_INFO = "__trc"
 DOWN_STACK = "__down"
@@ -314,13 +341,16 @@ Help_params["allow_xml"]     = "Allow output markup for display in browser (if s
 Help_params["append_traceback"] = "Append traceback information to exceptions"
 Help_params["assert_context"]= "No. of lines of context retrieved for traceassert (0 for efficiency)"
 Help_params["auto_lock"]     = "Automatically lock after specified idle time (in seconds), if password is set"
+Help_params["copy_types"]    = "Comma-separated type names of objects to copy in full, when snapshot is set"
 Help_params["deep_copy"]     = "Create deep copies of arguments and local variables for 'snapshots'"
 Help_params["editor"]        = "Editor to use for editing patches or viewing source"
 Help_params["exec_lock"]     = "Execute code within re-entrant lock"
+Help_params["export_to"]     = "Stream trace events to unix:socket_path, or to a rotating binary log file (read using otracecat)"
 Help_params["log_format"]    = "Format for log messages"
 Help_params["log_level"]     = "Logging level (10=>DEBUG, 20=>INFO, 30=>WARNING ...; see logging module)"
 Help_params["log_remote"]    = "IP address or domain (:port) for remote logging (default port: 9020)"
 Help_params["log_truncate"]  = "No. of characters to display for log messages (default: 72)"
+Help_params["max_context_bytes"] = "Maximum estimated memory (bytes) for contexts in /osh/recent and /osh/saved (least recently used are evicted; 0 for no limit)"
 Help_params["max_recent"]    = "Maximum number of entries to keep in /osh/recent"
 Help_params["osh_bin"]       = "Path to prepend to $PATH to use custom commands"
 Help_params["password"]      = "Encrypted access password (use otrace.encrypt_password to create it)"
@@ -329,6 +359,8 @@ Help_params["pretty_print"]  = "Use pprint.pformat rather than print to display
 Help_params["repeat_interval"] = "Command repeat interval (sec)"
 Help_params["safe_mode"]     = "Safe mode (disable code modification and execution)"
 Help_params["save_tags"]     = "Automatically save all tag contexts"
+Help_params["spill_evicted"] = "Write contexts to pickle_file only when evicted from memory (rather than when created)"
+Help_params["snapshot"]      = "Save lightweight snapshots (type, size, repr) of arguments and local variables, rather than references or copies"
 Help_params["trace_active"]  = "Activate tracing (can be used to force/suppress tracing)"
 Help_params["trace_related"] = "Automatically trace calls related to tagged objects"
 Help_params["unpickle_file"] = "Name of file to read pickled trace contexts from"
@@ -338,13 +370,16 @@ Set_params["allow_xml"]    = True
 Set_params["append_traceback"] = False
 Set_params["assert_context"]   = 0
 Set_params["auto_lock"]    = 0
+Set_params["copy_types"]   = ""
 Set_params["deep_copy"]    = False
 Set_params["editor"]       = ""
 Set_params["exec_lock"]    = False
+Set_params["export_to"]    = None # placeholder
 Set_params["log_format"]   = None # placeholder
 Set_params["log_level"]    = None # placeholder
 Set_params["log_remote"]   = None # placeholder
 Set_params["log_truncate"] = None # placeholder
+Set_params["max_context_bytes"] = 0
 Set_params["max_recent"]   = 10
 Set_params["osh_bin"]      = ""
 Set_params["password"]     = ""
@@ -353,6 +388,8 @@ Set_params["pretty_print"] = False
 Set_params["repeat_interval"] = 0.2
 Set_params["safe_mode"]    = True
 Set_params["save_tags"]    = False
+Set_params["snapshot"]     = False
+Set_params["spill_evicted"] = False
 Set_params["trace_active"] = None # placeholder
 Set_params["trace_related"]= False
 Set_params["unpickle_file"]= None # placeholder
@@ -360,6 +397,8 @@ Set_params["unpickle_file"]= None # placeholder
 Trace_rlock = threading.RLock()
 Pickle_rlock = threading.RLock()
 
+Profile_local = threading.local()   # Per-thread stack of child call times for profiling
+
 if sys.version_info[0] < 3:
     def encode(s):
         return s
@@ -489,14 +528,13 @@ def strip_compare_op(prop_name):
 
     return (prop_name.strip(), cmp_op)
 
+COMPARE_OPS = {"==": operator.eq, "!=": operator.ne, "<=": operator.le,
+               ">=": operator.ge, "<": operator.lt, ">": operator.gt}
+
 def compare(value1, op_str, value2):
     """Return True or False for comparison using operator."""
-    return ( (op_str == "==" and value1 == value2) or
-             (op_str == "!=" and value1 != value2) or
-             (op_str == "<=" and value1 <= value2) or
-             (op_str == ">=" and value1 >= value2) or
-             (op_str == "<"  and value1 <  value2) or
-             (op_str == ">"  and value1 >  value2) )
+    cmp_func = COMPARE_OPS.get(op_str)
+    return bool(cmp_func and cmp_func(value1, value2))
 
 def match_parse(match_str, delimiter=","):
     """Parse match dict components of the form: var1.comp1==value1,var2!=value2,... where values with commas/spaces must be quoted."""
@@ -537,6 +575,100 @@ def match_parse(match_str, delimiter=","):
 
     return match_dict
 
+class ArgMatcher(object):
+    """Argument match conditions (from match_parse) and tag check, compiled once when a trace is added.
+    Each condition "argname.comp1.comp2<op>" is split into the argument name, attribute path and
+    comparison function, and its trace label is pre-formatted, so that matching a call does not
+    re-parse any strings.
+    """
+    __slots__ = ("trace_dict", "match_tag", "conditions", "return_only")
+    missing = object()
+
+    def __init__(self, trace_dict, match_tag=""):
+        self.trace_dict = trace_dict
+        self.match_tag = match_tag
+        self.conditions = []
+        for key, value in trace_dict.items():
+            trace_name, cmp_op = strip_compare_op(key)
+            arg_name, sep, prop_name = trace_name.partition(".")
+            prop_names = tuple(prop_name.split(".")) if prop_name else ()
+            if isinstance(value, dict):
+                inner_labels = [("%s.%s%s%s" % (trace_name, inner_key, cmp_op, inner_value), inner_key, inner_value)
+                                for inner_key, inner_value in value.items()]
+            else:
+                inner_labels = None
+            self.conditions.append( (arg_name, prop_names, COMPARE_OPS[cmp_op], value,
+                                     "%s%s%s" % (trace_name, cmp_op, value), inner_labels) )
+        self.return_only = bool(trace_dict) and all(key == "return" or key.startswith("return.") for key in trace_dict)
+
+    def __len__(self):
+        return len(self.conditions)
+
+    def get_value(self, value, prop_names):
+        for prop_name in prop_names:
+            value = getattr(value, prop_name, self.missing)
+            if value is self.missing:
+                break
+        return value
+
+    def match(self, arg_dict, on_return=False, return_value=None):
+        """Returns list of matched condition labels, or None if match fails"""
+        if self.match_tag:
+            if self.match_tag == "*":
+                # Check all arguments for tags
+                check_args = arg_dict.iteritems()
+            elif self.match_tag in arg_dict:
+                # Check single argument for tag
+                check_args = [(self.match_tag, arg_dict[self.match_tag])]
+            else:
+                return None
+            for arg_name, arg_value in check_args:
+                trace_tag = getattr(arg_value, OTrace.trace_tag_attr, None)
+                if trace_tag:
+                    # Argument is tagged; matched
+                    return ["tagged%s;%s" % (arg_name, trace_tag.split(":")[1])]
+            return None
+
+        matched_list = []
+        for arg_name, prop_names, cmp_func, trace_value, label, inner_labels in self.conditions:
+            if arg_name == "return":
+                if not on_return:
+                    # Skip return value matching if not returning from function
+                    continue
+                actual_value = return_value
+            elif arg_name in arg_dict:
+                actual_value = arg_dict[arg_name]
+            else:
+                continue
+
+            if prop_names:
+                # Match argument (or return value) properties
+                actual_value = self.get_value(actual_value, prop_names)
+                if actual_value is self.missing:
+                    continue
+
+            if inner_labels is not None and isinstance(actual_value, dict):
+                # Dict value; match each trace dict entry with actual dict entry
+                for inner_label, inner_key, inner_value in inner_labels:
+                    if inner_key in actual_value:
+                        if not cmp_func(actual_value[inner_key], inner_value):
+                            return None
+                        matched_list.append(inner_label)
+            elif cmp_func(actual_value, trace_value):
+                # Match "scalar" actual value with trace value
+                matched_list.append(label)
+            else:
+                return None
+        return matched_list
+
+    def match_object(self, obj):
+        """Returns True if all conditions match attributes of obj (missing attributes are treated as None)"""
+        for arg_name, prop_names, cmp_func, trace_value, label, inner_labels in self.conditions:
+            value = self.get_value(obj, (arg_name,)+prop_names)
+            if not cmp_func(None if value is self.missing else value, trace_value):
+                return False
+        return True
+
 
 def get_obj_properties(value, full_path=None):
     """Return (python_mime_type, command) for object value"""
@@ -692,6 +824,94 @@ class ListDict(MappingDict):
             raise KeyError(key)
         del self._lst[int(key)]
 
+class ObjectSnapshot(object):
+    """Lightweight snapshot of an object: type name, size (in bytes, and length for sequences) and
+    repr, truncated to bounded length (without rendering the full repr of large containers)
+    """
+    __slots__ = ("typename", "size", "length", "text")
+    reprer = reprlib.Repr()
+    reprer.maxstring = reprer.maxother = MAX_SNAPSHOT_REPR
+    scalar_types = (type(None), bool, int, long, float, complex)
+
+    @classmethod
+    def capture(cls, obj):
+        """Returns obj itself, if it is a scalar or a short string, else snapshot of obj"""
+        if isinstance(obj, cls.scalar_types) or (isinstance(obj, basestring) and len(obj) <= MAX_SNAPSHOT_REPR):
+            return obj
+        return cls(obj)
+
+    def __init__(self, obj):
+        self.typename = type(obj).__name__
+        try:
+            self.size = sys.getsizeof(obj)
+        except Exception:
+            self.size = 0
+        try:
+            self.length = len(obj)
+        except Exception:
+            self.length = None
+        try:
+            self.text = self.reprer.repr(obj)[:MAX_SNAPSHOT_REPR]
+        except Exception, excp:
+            self.text = "<repr error: %s>" % excp
+
+    def __getstate__(self):
+        return (self.typename, self.size, self.length, self.text)
+
+    def __setstate__(self, state):
+        self.typename, self.size, self.length, self.text = state
+
+    def __repr__(self):
+        length = "" if self.length is None else "len=%d, " % self.length
+        return "%s  #snapshot(%s, %s%d bytes)" % (self.text, self.typename, length, self.size)
+
+def estimate_size(obj, depth=0, seen=None):
+    """Returns estimated memory size of object in bytes, including contained objects and
+    attributes upto MAX_SIZE_DEPTH (objects are counted only once)
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    try:
+        size = sys.getsizeof(obj)
+    except Exception:
+        size = 0
+    if depth >= MAX_SIZE_DEPTH:
+        return size
+
+    try:
+        if isinstance(obj, dict):
+            items = obj.items()
+            values = [x for item in items[:MAX_SIZE_ITEMS] for x in item]
+            count = len(items)
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            values = list(obj)[:MAX_SIZE_ITEMS] if not isinstance(obj, (list, tuple)) else obj[:MAX_SIZE_ITEMS]
+            count = len(obj)
+        elif hasattr(obj, "__dict__") and not isinstance(obj, (type, types.ModuleType, types.FunctionType)):
+            return size + estimate_size(obj.__dict__, depth=depth+1, seen=seen)
+        else:
+            return size
+    except Exception:
+        return size
+
+    contained = sum(estimate_size(x, depth=depth+1, seen=seen) for x in values)
+    if count > MAX_SIZE_ITEMS:
+        contained = (contained * count) // MAX_SIZE_ITEMS
+    return size + contained
+
+class PickledData(object):
+    """Wrapper for data that has already been pickled, which is unpickled transparently
+    (allows nested components to be pickled only once)
+    """
+    __slots__ = ("data",)
+    def __init__(self, data):
+        self.data = data
+
+    def __reduce__(self):
+        return (cPickle.loads, (self.data,))
+
 class LineList(list):
     def __str__(self):
         s = [str(x) for x in self]
@@ -1326,7 +1546,7 @@ The command prefix "pr" may be omitted, and is assumed by default.
 """repeat command            # Repeat command till new user input is received""",
 
 "resume":
-"""resume [trace_id1..]      # Resume from breakpoint""",
+"""resume [trace_id1..]      # Resume from breakpoint, hold or parked call""",
 
 "rm":
 """rm [-r] [pathname1..]     # Delete entities corresponding to pathnames (if supported)
@@ -1359,17 +1579,32 @@ PARAMETERS""",
 "swapd":
 """swapd                     # Swap current work dir with top of directory stack""",
 
+"profile":
+"""profile [on|off|reset] [-n count] [-s calls|cum|self|max] [name_pattern]   # Profile calls to wrapped functions/methods; display top hotspots
+
+Functions are wrapped for profiling by the trace command (e.g., "trace MyClass" wraps all methods of MyClass;
+with no -c condition, only exceptions are traced). Use "repeat profile" for a live display.
+-n count   Number of functions to display (default: %d; 0 for all)
+-s key     Sort by number of calls, cumulative time, self time (default) or max time
+Histogram columns count calls with latency <= 10us/100us/1ms/10ms/100ms/1s/10s/longer
+""" % PROFILE_TOP,
+
+"stats":
+"""stats                     # Display memory usage of trace contexts and pickle database write statistics""",
+
 "tag":
 """tag [(object|.) [tag_str|id|time]]    # Tag object for tracing (default tag: id(object))""",
 
 "trace":
-"""trace [-a (break|ipdb|pdb|hold|tag)] [-c call|return|all|tag|comma_sep_arg_match_conditions] [-n +/-count] ([class.][method]|db_key|*)   # Enable tracing for class/method/key on matching condition
+"""trace [-a (break|ipdb|pdb|hold|park|tag)] [-c call|return|all|tag|comma_sep_arg_match_conditions] [-n +/-count] [-p probability] [-f count[/seconds]] [-r max_per_sec] ([class.][method]|db_key|*)   # Enable tracing for class/method/key on matching condition
 
--a break|ipdb|pdb|hold|tag   Action to be taken when trace condition is satisfied:
+-a break|ipdb|pdb|hold|park|tag   Action to be taken when trace condition is satisfied:
      break => stop until resume command
      ipdb => start ipdb
      pdb => start pdb
      hold => asynchronously hold this request (if supported)
+     park => for calls returning a Future (e.g., coroutines), hold delivery of the result until resume command,
+             without blocking the calling thread or event loop
      tag => tag self argument on method return using a string describing matched trace conditions
 -c call|return|all|tag|comma_sep_arg_match_conditions   Condition to match for tracing:
      call => before function call,
@@ -1378,6 +1613,10 @@ PARAMETERS""",
      tagged[argname] => match if any (or argname) argument has a tag
      argname1.comp1==value1,argname2!=value2,... => on argument value match (values with commas/spaces must be quoted; the special argument name 'return' may also be used)
 -n +/-count   If count > 0, stop tracing after count matches; if count > 0, start tracing after -count matches
+-p probability   Sample calls at random with this probability (0.0 to 1.0)
+-f count[/seconds]   Sample only the first count calls in each interval (default: 1 second)
+-r max_per_sec   Sample at most max_per_sec calls per second for each method (useful with class tracing)
+(Sampling is checked before argument matching or context copying, to limit tracing overhead under load)
 """,
 
 "unpatch":
@@ -1387,7 +1626,12 @@ In directory /osh/patches, "unpatch *" will unpatch all currently patched method
 """,
 
 "unpickle":
-"""unpickle filename [field=value]        # Read pickled trace contexts from file """,
+"""unpickle filename [field=value ...] [start_time=timestamp] [end_time=timestamp] [limit=count] [after=recnum]   # Read pickled trace contexts from file
+
+field = key|methodname|context_id|timestamp (all fields must match; values with * are glob patterns)
+Contexts with start_time <= timestamp < end_time are read (timestamp format is yymmdd-HH-MM-SS)
+At most limit (default: %d) contexts are read; to read more, specify the after value displayed
+""" % MAX_UNPICKLE_KEYS,
 
 "untag":
 """untag [object|.]          # Untag object""",
@@ -1998,6 +2242,8 @@ In directory /osh/patches, "unpatch *" will unpatch all currently patched method
         # Resume break point events on shutdown
         for event in self.break_events.values():
             event.set()
+        PickleInterface.close_pickle_db()
+        TraceExporter.stop()
         super(OShell, self).shutdown()
 
     def line_wrap(self, str_list, html_attrs=None, pre_count=0):
@@ -2405,6 +2651,12 @@ In directory /osh/patches, "unpatch *" will unpatch all currently patched method
             # Read and unpickle trace contexts
             return self.cmd_unpickle(cmd, comps, line, rem_line)
 
+        elif cmd == "stats":
+            return self.cmd_stats(cmd, comps, line, rem_line)
+
+        elif cmd == "profile":
+            return self.cmd_profile(cmd, comps, line, rem_line)
+
         elif cmd == "pr":
             # Evaluate expression and print it
             return self.cmd_pr(cmd, comps, line, rem_line, cmd_opts)
@@ -2763,9 +3015,10 @@ In directory /osh/patches, "unpatch *" will unpatch all currently patched method
         trace_condition = None
         break_action = None
         break_count = 0
+        sample_opts = {}
         while comps and comps[0].startswith("-"):
             comp = comps.pop(0)
-            if comp in ("-a", "-c", "-n") and not comps:
+            if comp in ("-a", "-c", "-n", "-p", "-f", "-r") and not comps:
                 return (out_str, "Missing argument for option %s" % comp)
             if comp == "-a":
                 if comps[0] in TRACE_ACTIONS:
@@ -2779,6 +3032,25 @@ In directory /osh/patches, "unpatch *" will unpatch all currently patched method
                     break_count = int(comps.pop(0))
                 else:
                     return (out_str, "Expected integer argument for option %s" % comp)
+            elif comp == "-p":
+                try:
+                    sample_opts["probability"] = float(comps.pop(0))
+                    assert 0.0 <= sample_opts["probability"] <= 1.0
+                except Exception:
+                    return (out_str, "Expected probability between 0 and 1 for option %s" % comp)
+            elif comp == "-f":
+                count, sep, interval = comps.pop(0).partition("/")
+                try:
+                    sample_opts["first_count"] = int(count)
+                    sample_opts["interval"] = float(interval) if interval else 1.0
+                    assert sample_opts["first_count"] > 0 and sample_opts["interval"] > 0
+                except Exception:
+                    return (out_str, "Expected count[/seconds] for option %s" % comp)
+            elif comp == "-r":
+                if comps[0].isdigit() and int(comps[0]) > 0:
+                    sample_opts["rate_cap"] = int(comps.pop(0))
+                else:
+                    return (out_str, "Expected positive integer argument for option %s" % comp)
             else:
                 return (out_str, "Invalid option %s" % comp)
 
@@ -2896,7 +3168,8 @@ In directory /osh/patches, "unpatch *" will unpatch all currently patched method
                 fullname = OTrace.add_trace(trace_value, parent=parent_obj, argmatch=argmatch,
                                             trace_call=trace_call, trace_return=trace_return,
                                             break_count=break_count, break_action=break_action,
-                                            match_tag=match_tag, access_type=access_type)
+                                            match_tag=match_tag, access_type=access_type,
+                                            sampler=TraceSampler(**sample_opts) if sample_opts else None)
                 out_str = "Tracing " + str(OTrace.trace_names[fullname])
 
         return (out_str, err_str)
@@ -2926,6 +3199,8 @@ In directory /osh/patches, "unpatch *" will unpatch all currently patched method
                         del self.break_events[trace_id]
                         out_str = "Resuming " + trace_id
                         OTrace.remove_break_point(trace_id)
+                    elif OTrace.resume_parked(trace_id):
+                        out_str = "Resuming " + trace_id
                     else:
                         context = OTrace.base_context[ALL_DIR].get(trace_id)
                         if context and context.get_trc("context") == "holds":
@@ -3237,11 +3512,13 @@ In directory /osh/patches, "unpatch *" will unpatch all currently patched method
                 elif name == "log_truncate":
                     OTrace.callback_handler.tracelen(int(value))
                 elif name == "pickle_file":
-                    if PickleInterface.write_connection:
-                        PickleInterface.write_connection.close()
-                        PickleInterface.write_connection = None
+                    PickleInterface.close_pickle_db()
                     if value:
                         PickleInterface.create_pickle_db(expandpath(value))
+                elif name == "export_to":
+                    TraceExporter.stop()
+                    if value:
+                        TraceExporter.start(value if value.startswith(EXPORT_SOCKET_PREFIX) else expandpath(value))
                 elif name == "unpickle_file":
                     pass
                 elif name == "trace_active":
@@ -3278,6 +3555,8 @@ In directory /osh/patches, "unpatch *" will unpatch all currently patched method
                     value = OTrace.callback_handler.tracelen()
                 elif name == "pickle_file":
                     value = PickleInterface.write_file
+                elif name == "export_to":
+                    value = TraceExporter.dest
                 elif name == "unpickle_file":
                     value = PickleInterface.read_file
                 elif name == "trace_active":
@@ -3357,6 +3636,8 @@ In directory /osh/patches, "unpatch *" will unpatch all currently patched method
             err_str = self.change_workdir(new_dir)
             if err_str:
                 return (out_str, err_str)
+            if self.has_trc("id"):
+                ContextDict.touch_context(self.get_trc("id"))
 
         return (out_str, err_str)
 
@@ -3392,22 +3673,89 @@ In directory /osh/patches, "unpatch *" will unpatch all currently patched method
             return (out_str, "Error in %s: %s" % (cmd, excp))
         return (out_str, err_str)
 
+    def cmd_profile(self, cmd, comps, line, rem_line):
+        """Enable/disable profiling, or display profile, returning (out_str, err_str)"""
+        out_str, err_str = "", ""
+        sort_keys = {"calls": "calls", "cum": "cum_time", "self": "self_time", "max": "max_time"}
+        sort_key = "self_time"
+        count = PROFILE_TOP
+        while comps and comps[0].startswith("-"):
+            comp = comps.pop(0)
+            if not comps:
+                return (out_str, "Missing argument for option %s" % comp)
+            if comp == "-n":
+                if not comps[0].isdigit():
+                    return (out_str, "Expected integer argument for option %s" % comp)
+                count = int(comps.pop(0))
+            elif comp == "-s":
+                if comps[0] not in sort_keys:
+                    return (out_str, "Expected one of %s for option %s" % (sort_keys.keys(), comp))
+                sort_key = sort_keys[comps.pop(0)]
+            else:
+                return (out_str, "Invalid option %s" % comp)
+
+        if comps and comps[0] in ("on", "off", "reset"):
+            action = comps.pop(0)
+            if action == "reset":
+                OTrace.profile_reset()
+            else:
+                OTrace.profile_active = (action == "on")
+            return ("Profiling %s (%d wrapped functions)" % ("active" if OTrace.profile_active else "inactive",
+                                                              len(OTrace.profile_infos)), err_str)
+
+        stats = OTrace.profile_stats(sort_key=sort_key, count=count, pattern=comps[0] if comps else "")
+        lines = ["%8s %10s %10s %10s %10s  %-40s %s" % ("calls", "cum_s", "self_s", "avg_ms", "max_ms", "function", "histogram")]
+        for fullname, profile in stats:
+            lines.append("%8d %10.4f %10.4f %10.3f %10.3f  %-40s %s" % (profile.calls, profile.cum_time, profile.self_time,
+                                                                        1000*profile.cum_time/profile.calls, 1000*profile.max_time,
+                                                                        fullname, "/".join(str(x) for x in profile.histogram)))
+        if not OTrace.profile_active:
+            lines.append("(Profiling inactive; use 'profile on' to activate)")
+        return ("\n".join(lines), err_str)
+
+    def cmd_stats(self, cmd, comps, line, rem_line):
+        """Display trace statistics, returning (out_str, err_str)"""
+        with Trace_rlock:
+            stats = ContextDict.stats.copy()
+        max_bytes = Set_params["max_context_bytes"]
+        out_str = "contexts: %d held, %s estimated bytes (limit: %s), %d evicted, %d spilled to pickle_file\n" % (
+                   stats["contexts"], stats["bytes"] if max_bytes else "-", max_bytes or "none",
+                   stats["evictions"], stats["spilled"])
+        if PickleInterface.write_file:
+            write_stats = PickleInterface.write_stats
+            out_str += "pickle_file %s: %d written in %d batches, %d dropped, %d queued\n" % (
+                        PickleInterface.write_file, write_stats["written"], write_stats["batches"],
+                        write_stats["dropped"], PickleInterface.write_queue.qsize() if PickleInterface.write_queue else 0)
+        if TraceExporter.dest:
+            export_stats = TraceExporter.stats
+            out_str += "export_to %s: %d exported, %d dropped, %d write errors, %d queued\n" % (
+                        TraceExporter.dest, export_stats["exported"], export_stats["dropped"], export_stats["errors"],
+                        TraceExporter.write_queue.qsize() if TraceExporter.write_queue else 0)
+        return (out_str, "")
+
     def cmd_unpickle(self, cmd, comps, line, rem_line):
         """Unpickle file, returning (out_str, err_str)"""
         out_str, err_str = "", ""
         if not comps:
             return (out_str, "Please specify filename")
         filename = expandpath(comps.pop(0))
-        filters = {}
+        filters = {"limit": MAX_UNPICKLE_KEYS}
         while comps:
             comp = comps.pop(0)
             field, sep, value = comp.partition("=")
             if sep:
+                if field in ("limit", "after"):
+                    if not value.isdigit():
+                        return (out_str, "Expected integer value for %s" % field)
+                    value = int(value)
                 filters[str(field)] = value
         try:
+            PickleInterface.flush_pickle_db()
             PickleInterface.open_pickle_db(filename)
-            keys = PickleInterface.read_keys_pickle_db(**filters)
-            for key in keys:
+            count = 0
+            last_recnum = 0
+            for last_recnum, key in PickleInterface.iter_keys_pickle_db(**filters):
+                count += 1
                 dirs = ContextDict.split_trace_id(key)
                 context = OTrace.base_context[PICKLED_DIR]
                 for cdir in dirs:
@@ -3415,6 +3763,9 @@ In directory /osh/patches, "unpatch *" will unpatch all currently patched method
                         context[cdir] = {}
                     context = context[cdir]
                 context[ENTITY_CHAR] = None
+            out_str = "Read %d contexts" % count
+            if filters["limit"] and count >= filters["limit"]:
+                out_str += "; to read more, use after=%d" % last_recnum
         except Exception, excp:
             err_str = "Error in unpickling from %s: %s" % (filename, excp)
             raise # ABC
@@ -3543,19 +3894,88 @@ In directory /osh/patches, "unpatch *" will unpatch all currently patched method
             return (out_str, "Error in saving file '%s': %s" % (filepath, excp))
         return ("", "")
 
+class TraceSampler(object):
+    """Sampling controls for tracing, checked before argument matching or context copying.
+    probability: fraction of calls sampled at random
+    first_count: sample only the first first_count calls in each interval (seconds)
+    rate_cap: maximum calls sampled per second, for each method
+    (Counts are updated without locking, and may be approximate for multi-threaded calls)
+    """
+    def __init__(self, probability=1.0, first_count=0, interval=1.0, rate_cap=0):
+        self.probability = probability
+        self.first_count = first_count
+        self.interval = interval
+        self.rate_cap = rate_cap
+        self.window_start = 0.0
+        self.window_count = 0
+        self.method_counts = {}     # fullname -> [second, count]
+        self.sampled = 0
+        self.skipped = 0
+
+    def sample(self, fullname):
+        """Returns True if call to method fullname should be traced"""
+        if self.probability < 1.0 and random.random() >= self.probability:
+            self.skipped += 1
+            return False
+
+        if self.first_count or self.rate_cap:
+            cur_time = time.time()
+            if self.first_count:
+                if cur_time - self.window_start >= self.interval:
+                    self.window_start = cur_time
+                    self.window_count = 0
+                if self.window_count >= self.first_count:
+                    self.skipped += 1
+                    return False
+
+            if self.rate_cap:
+                cur_sec = int(cur_time)
+                method_count = self.method_counts.get(fullname)
+                if not method_count or method_count[0] != cur_sec:
+                    method_count = [cur_sec, 0]
+                    self.method_counts[fullname] = method_count
+                if method_count[1] >= self.rate_cap:
+                    self.skipped += 1
+                    return False
+                method_count[1] += 1
+
+            self.window_count += 1
+
+        self.sampled += 1
+        return True
+
+    def __str__(self):
+        options = ""
+        if self.probability < 1.0:
+            options += "-p %s " % self.probability
+        if self.first_count:
+            options += "-f %d/%s " % (self.first_count, self.interval)
+        if self.rate_cap:
+            options += "-r %d " % self.rate_cap
+        return options
+
 class TraceOpts(object):
     """Trace match options
     """
     def __init__(self, trace_name, argmatch={}, break_count=-1, trace_call=False, trace_return=False,
-                 break_action=None, match_tag="", access_type=""):
+                 break_action=None, match_tag="", access_type="", sampler=None):
         self.trace_name = trace_name
         self.argmatch = argmatch
+        self.matcher = None
+        self.return_matcher = None
+        if isinstance(argmatch, dict):
+            # Compile match conditions
+            self.matcher = ArgMatcher(argmatch, match_tag)
+            ret_argmatch = dict((key, value) for key, value in argmatch.items() if key == "return" or key.startswith("return."))
+            if ret_argmatch:
+                self.return_matcher = ArgMatcher(ret_argmatch)
         self.break_count = break_count
         self.trace_call = trace_call
         self.trace_return = trace_return
         self.break_action = break_action
         self.match_tag = match_tag
         self.access_type = access_type
+        self.sampler = sampler
 
     def __str__(self):
         if self.match_tag:
@@ -3576,6 +3996,9 @@ class TraceOpts(object):
         if self.break_count:
              options = options + "-n %d " % self.break_count
 
+        if self.sampler:
+             options = options + str(self.sampler)
+
         return "%s%s" % (options, self.trace_name)
 
 class ContextDict(dict):
@@ -3583,11 +4006,55 @@ class ContextDict(dict):
     """
     context_types = {"as": "asserts", "br": "breaks", "db": "dbaccess", "ex": "exceptions", "hd": "holds", "tg": "tags", "tr": "traces"}
 
+    # Memory budget (max_context_bytes) is shared by all instances
+    lru_contexts = OrderedDict()   # (dirname, trace_id) -> (context_dict, estimated_size), least recently used first
+    stats = {"contexts": 0, "bytes": 0, "evictions": 0, "spilled": 0}
+
     def __init__(self, dirname=""):
         super(ContextDict, self).__init__()
         self.dirname = dirname
         self.trace_ids = collections.defaultdict(list)
 
+    @classmethod
+    def touch_context(cls, trace_id):
+        """Mark context as recently used"""
+        with Trace_rlock:
+            for lru_key in [key for key in cls.lru_contexts if key[1] == trace_id]:
+                cls.lru_contexts[lru_key] = cls.lru_contexts.pop(lru_key)
+
+    @classmethod
+    def evict_contexts(cls):
+        """Evict least recently used contexts until memory budget is satisfied
+        (breaks and holds are never evicted)
+        """
+        with Trace_rlock:
+            max_bytes = Set_params["max_context_bytes"]
+            if not max_bytes or cls.stats["bytes"] <= max_bytes:
+                return
+            for (dirname, trace_id), (context_dict, size) in cls.lru_contexts.items():
+                if cls.stats["bytes"] <= max_bytes:
+                    break
+                if cls.split_trace_id(trace_id)[0] in ("breaks", "holds"):
+                    continue
+                context_dict.spill_context(trace_id)
+                context_dict.remove_context(trace_id)
+                cls.stats["evictions"] += 1
+
+    def get_context(self, trace_id):
+        context_type, fullmethodname, context_id, trace_timestamp = self.split_trace_id(trace_id)
+        try:
+            return self[context_type][fullmethodname][context_id][trace_timestamp]
+        except KeyError:
+            return None
+
+    def spill_context(self, trace_id):
+        """Write context being removed from memory to pickle database, if spill_evicted"""
+        if Set_params["spill_evicted"] and PickleInterface.write_connection:
+            context = self.get_context(trace_id)
+            if context is not None:
+                PickleInterface.write_pickle_db(trace_id, context)
+                self.stats["spilled"] += 1
+
     @classmethod
     def make_trace_id(cls, context_type, fullmethodname, id_label, trace_timestamp):
         """Creates trace_id, and return (trace_id, context_id)
@@ -3626,7 +4093,11 @@ class ContextDict(dict):
         """
         with Trace_rlock:
             context_type, fullmethodname, context_id, trace_timestamp = self.split_trace_id(trace_id)
-            if context_type == "holds":
+            if context_type == "holds" and trace_id in OTrace.parked:
+                if keep_holds:
+                    return
+                OTrace.resume_parked(trace_id)
+            elif context_type == "holds":
                 try:
                     context = self[context_type][fullmethodname][context_id][trace_timestamp]
                     self_arg = context["self"]
@@ -3650,6 +4121,11 @@ class ContextDict(dict):
             except Exception:
                 pass
 
+            lru_entry = self.lru_contexts.pop((self.dirname, trace_id), None)
+            if lru_entry:
+                self.stats["contexts"] -= 1
+                self.stats["bytes"] -= lru_entry[1]
+
             # Remove context from dictionary
             try:
                 del self[context_type][fullmethodname][context_id][trace_timestamp]
@@ -3673,6 +4149,7 @@ class ContextDict(dict):
             if Set_params.get(maxdir) and len(context_trace_ids) > Set_params[maxdir]:
                 # Remove oldest entry of this type
                 if context_type != "breaks": # Breakpoints are removed when resuming
+                    self.spill_context(context_trace_ids[0])
                     self.remove_context(context_trace_ids[0])
 
             # Add new entry
@@ -3687,6 +4164,19 @@ class ContextDict(dict):
 
             self[context_type][fullmethodname][context_id][trace_timestamp] = new_context  # Strong reference
 
+            if Set_params["max_context_bytes"]:
+                size = estimate_size(new_context)
+            else:
+                size = 0
+            old_entry = self.lru_contexts.pop((self.dirname, trace_id), None)
+            if old_entry:
+                self.stats["contexts"] -= 1
+                self.stats["bytes"] -= old_entry[1]
+            self.lru_contexts[(self.dirname, trace_id)] = (self, size)
+            self.stats["contexts"] += 1
+            self.stats["bytes"] += size
+            self.evict_contexts()
+
             return trace_id
 
 
@@ -3927,6 +4417,29 @@ class HtmlWrapper(object):
     def wrap(self, html, msg_type=""):
         return html
             
+class FunctionProfile(object):
+    """Compact per-function profiling counters
+    (Updated without locking; counts may be approximate for multi-threaded calls)
+    """
+    __slots__ = ("calls", "cum_time", "self_time", "max_time", "histogram")
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.cum_time = 0.0
+        self.self_time = 0.0
+        self.max_time = 0.0
+        self.histogram = [0]*(len(PROFILE_BUCKETS)+1)
+
+    def record(self, elapsed, self_elapsed):
+        self.calls += 1
+        self.cum_time += elapsed
+        self.self_time += self_elapsed
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+        self.histogram[bisect.bisect_left(PROFILE_BUCKETS, elapsed)] += 1
+
 class FunctionInfo(object):
     """ Return object containing information about a function"""
     def __init__(self, function, classname="", modulename="", methodtype=""):
@@ -3934,6 +4447,14 @@ class FunctionInfo(object):
         self.classname = classname
         self.modulename = modulename
         self.methodtype = methodtype
+        self.fullname = function.__name__ if not classname else classname+"."+function.__name__
+
+        self.profile = FunctionProfile()
+
+        # Precompiled trace dispatch (recomputed when trace_generation changes)
+        self.trace_generation = None
+        self.trace_opts = None
+        self.class_match = False
 
         func_code = function.func_code
         func_defaults = function.func_defaults
@@ -3965,6 +4486,8 @@ class OTrace(object):
     eventloop_callback = None
     html_wrapper = None
 
+    parked = {}   # trace_id -> HoldHandler, for parked calls awaiting resume
+
     default_context = {"__name__": "__otrace__", "__doc__": None,
                        "_trace_id": None, "_trace_related": {}}
 
@@ -3990,9 +4513,13 @@ class OTrace(object):
     trace_log_set = set()
     trace_names = {}
     trace_keys = {}
+    trace_generation = [0]   # Incremented whenever trace_names changes
+    copy_types = ["", set()]  # [copy_types parameter value, set of type names]
 
     trace_all = False
     trace_active = False
+    profile_active = False
+    profile_infos = weakref.WeakSet()   # FunctionInfo for all wrapped functions
 
     def __new__(cls, *args, **kwargs):
         raise OTraceException("Class cannot be instantiated")
@@ -4054,7 +4581,7 @@ class OTrace(object):
 
     @classmethod
     def add_trace(cls, method=None, parent=None, argmatch={}, break_count=-1, trace_call=False,
-                  trace_return=False, break_action=None, match_tag="", access_type=""):
+                  trace_return=False, break_action=None, match_tag="", access_type="", sampler=None):
         """To trace all, method = "*"
         To list all methods traced, method = None
         To trace class, method="classname." or classname
@@ -4065,6 +4592,7 @@ class OTrace(object):
         "arg4!=": "value4", "return": "retvalue"}
         Returns full name of method traced, or null string
         If neither trace_call nor trace_return are specified, only exceptions are traced.
+        sampler = TraceSampler(...) to trace only a sample of calls
         To trace entity keys, trace /kind:name/... get/put/delete/modify/all
         """
         with Trace_rlock:
@@ -4107,9 +4635,11 @@ class OTrace(object):
                 fullname = methodname if not classname else classname+"."+methodname
 
             trace_opts = TraceOpts(fullname, argmatch=argmatch, break_count=break_count, trace_call=trace_call,
-                                   trace_return=trace_return, break_action=break_action, match_tag=match_tag)
+                                   trace_return=trace_return, break_action=break_action, match_tag=match_tag,
+                                   sampler=sampler)
 
             cls.trace_names[fullname] = trace_opts
+            cls.trace_generation[0] += 1
 
         return fullname
 
@@ -4156,6 +4686,7 @@ class OTrace(object):
             if untrace_name:
                 try:
                     del cls.trace_names[untrace_name]
+                    cls.trace_generation[0] += 1
                 except Exception:
                     pass
 
@@ -4212,6 +4743,7 @@ class OTrace(object):
             cls.trace_id_set.clear()
             cls.trace_names.clear()
             cls.trace_keys.clear()
+            cls.trace_generation[0] += 1
 
     @classmethod
     def break_flow(cls, trace_id, action="break"):
@@ -4310,6 +4842,8 @@ class OTrace(object):
             trace_context, trace_id = cls.create_context(fullmethodname, self_arg, locals_dict,
                                                          id_label=label, context_type=context_type)
             cls.callback_handler.callback(trace_id, methodtype, modulename, classname, funcname)
+            if TraceExporter.write_queue:
+                TraceExporter.export("assert", trace_id, fullmethodname, label)
 
             if action == "hold":
                 return check_for_hold(self_arg)
@@ -4397,13 +4931,13 @@ class OTrace(object):
         
     @classmethod
     def create_context(cls, fullmethodname, self_arg, locals_dict, id_label="",
-                       context_type="traces", excp=None, exc_info=None):
+                       context_type="traces", excp=None, exc_info=None, set_hold=True):
         """Creates new context (locals_dict) and returns (trace_id, trace_context)
         """
         trace_id, context_id = ContextDict.make_trace_id(context_type, fullmethodname, id_label, cls.get_timestamp())
         new_context_path = [BASE_DIR, RECENT_DIR] + ContextDict.split_trace_id(trace_id)
         if self_arg is not None:
-            if context_type == "holds" and cls.hold_wrapper:
+            if context_type == "holds" and set_hold and cls.hold_wrapper:
                 # Set hold callback attribute
                 # Hold handler should return a callable entity (for use by trampoline)
                 # When called, the callable should accept a callback function as the argument
@@ -4468,7 +5002,7 @@ class OTrace(object):
             cls.recent_trace_id[0] = trace_id
             cls.recent_trace_context[0] = new_context
 
-            if PickleInterface.write_connection:
+            if PickleInterface.write_connection and not Set_params["spill_evicted"]:
                 PickleInterface.write_pickle_db(trace_id, new_context)
             return (new_context, trace_id)
 
@@ -4557,7 +5091,7 @@ class OTrace(object):
     @classmethod
     def check_trace_match(cls, fn, fullmethodname, self_arg, arg_dict, trace_dict=None,
                           break_action=None, on_return=False, return_value=None, match_tag=""):
-        """ Trace dict example:
+        """ Trace dict example (or ArgMatcher compiled from it):
         {"arg1": "value1", "self.arg2": "value2", "arg3":{"entry31": "value31", "entry32","value32"},
         "arg4!=": "value4", "return": "retvalue"}
         Returns triplet tuple (trace_context, trace_id, related_id)
@@ -4569,71 +5103,16 @@ class OTrace(object):
         no new context id is created.
         """
         if isinstance(trace_dict, dict):
-            if not on_return and trace_dict and all(key == "return" or key.startswith("return.") for key in trace_dict):
+            # Uncompiled match conditions
+            trace_dict = ArgMatcher(trace_dict, match_tag)
+
+        if isinstance(trace_dict, ArgMatcher):
+            if not on_return and trace_dict.return_only:
                 # No match (match only on return)
                 return (None, "", "")
 
-            trace_matched = True     # Assume match unless it turns out otherwise
-            matched_list = []
-            if match_tag:
-                if match_tag == "*":
-                    # Check all arguments for tags
-                    check_args = arg_dict.items()
-                else:
-                    # Check single argument for tag
-                    check_args = [(match_tag, arg_dict[match_tag])] if match_tag in arg_dict else []
-
-                trace_matched = False
-                for arg_name, arg_value in check_args:
-                    trace_tag = getattr(arg_value, cls.trace_tag_attr, None)
-                    if trace_tag:
-                        # Argument is tagged; matched
-                        trace_matched = True
-                        matched_list = ["tagged%s;%s" % (arg_name, trace_tag.split(":")[1])]
-                        break
-            elif not trace_dict:
-                # Default match (no matching attributes specified)
-                pass
-            else:
-                for trace_name, trace_value in trace_dict.items():
-                    # For each traced attribute or argument
-                    trace_name, cmp_op = strip_compare_op(trace_name)
-                    arg_name, sep, prop_name = trace_name.partition(".")
-                    if arg_name == "return":
-                        # Trace match on returned value
-                        if on_return:
-                            actual_value = return_value
-                        else:
-                            # Skip return value matching if not returning from function
-                            continue
-                    else:
-                        # Match argument value
-                        if arg_name not in arg_dict:
-                            continue
-                        actual_value = arg_dict[arg_name]
-                        if prop_name:
-                            # Match argument properties
-                            if not hasattr(actual_value, prop_name):
-                                continue
-                            actual_value = getattr(actual_value, prop_name)
-
-                    if isinstance(actual_value, dict) and isinstance(trace_value, dict):
-                        # Dict value; match each trace dict entry with actual dict entry
-                        for inner_key, inner_value in trace_value:
-                            if inner_key in actual_value:
-                                if compare(actual_value[inner_key], cmp_op, inner_value):
-                                    matched_list.append("%s.%s%s%s" % (trace_name, inner_key, cmp_op, inner_value))
-                                else:
-                                    trace_matched = False
-                                    break
-                        if not trace_matched:
-                            break
-                    elif compare(actual_value, cmp_op, trace_value):
-                        # Match "scalar" actual value with trace value
-                        matched_list.append("%s%s%s" % (trace_name, cmp_op, trace_value))
-                    else:
-                        trace_matched = False
-                        break
+            matched_list = trace_dict.match(arg_dict, on_return=on_return, return_value=return_value)
+            trace_matched = matched_list is not None
 
             if trace_matched:
                 # Trace match succeeded
@@ -4649,7 +5128,7 @@ class OTrace(object):
                     id_label = "return" if on_return else "call"
                 if break_action == "break":
                     context_type = "breaks"
-                elif break_action == "hold":
+                elif break_action in ("hold", "park"):
                     context_type = "holds"
                 else:
                     context_type = "traces"
@@ -4659,7 +5138,8 @@ class OTrace(object):
                 locals_dict.set_trc("stack", LineList(traceback.format_stack()[:-3]))
                 locals_dict.set_trc("func", fn)
                 trace_context, trace_id = cls.create_context(fullmethodname, self_arg, locals_dict,
-                                                             id_label=id_label, context_type=context_type)
+                                                             id_label=id_label, context_type=context_type,
+                                                             set_hold=(break_action != "park"))
                 return (trace_context, trace_id, "")
 
         # No trace match requested, or trace match failed; check for any related trace_id
@@ -4683,6 +5163,14 @@ class OTrace(object):
 
         return (None, "", related_id)
 
+    @classmethod
+    def get_copy_types(cls):
+        """Returns set of type names (from copy_types parameter) of objects to be copied in full"""
+        if cls.copy_types[0] != Set_params["copy_types"]:
+            cls.copy_types[:] = [Set_params["copy_types"],
+                                 set(x.strip() for x in Set_params["copy_types"].split(",") if x.strip())]
+        return cls.copy_types[1]
+
     @classmethod
     def copy_or_not(cls, obj, split=False, keep_self=True):
         """Return deepcopy of obj if deep_copy parameter is set and obj has attribute
@@ -4690,11 +5178,19 @@ class OTrace(object):
         If split, process list or dict values individually and re-group them,
         creating at atleast a shallow copy of the list/dict in the process.
         If keep_self (default), keep original self, and store copy as self_copy
+        If snapshot parameter is set, return ObjectSnapshot of obj, unless its type is in copy_types.
         """
-        if not Set_params["deep_copy"]:
+        if not Set_params["deep_copy"] and not Set_params["snapshot"]:
             return obj
 
         if not split:
+            if Set_params["snapshot"]:
+                if type(obj).__name__ not in cls.get_copy_types():
+                    return ObjectSnapshot.capture(obj)
+                try:
+                    return copy.deepcopy(obj)
+                except Exception:
+                    return ObjectSnapshot(obj)
             if hasattr(obj, "__deepcopy__") or isinstance(obj, (dict,list,set,tuple)):
                 return copy.deepcopy(obj)
             else:
@@ -4713,6 +5209,21 @@ class OTrace(object):
 
         raise Exception("Unable to split %s" % type(obj))
 
+    @classmethod
+    def update_dispatch(cls, info):
+        """Recomputes precompiled trace options for function, after trace_names has changed
+        """
+        with Trace_rlock:
+            info.trace_generation = cls.trace_generation[0]
+            info.class_match = False
+            info.trace_opts = cls.trace_names.get(info.fullname)   # Full name match (most specific)
+            if not info.trace_opts and info.classname:
+                info.trace_opts = cls.trace_names.get("."+info.fn.__name__) # Method name match
+                if not info.trace_opts:
+                    info.trace_opts = cls.trace_names.get(info.classname+".") # Class name match (least specific)
+                    if info.trace_opts:
+                        info.class_match = True
+
     @classmethod
     def otrace_function_call(cls, info, *args, **kwargs):
         """Auxiliary method used by wrapper in trace_function
@@ -4720,6 +5231,20 @@ class OTrace(object):
         if not cls.trace_active:
             return info.fn(*args, **kwargs)
 
+        if info.trace_generation != cls.trace_generation[0]:
+            cls.update_dispatch(info)
+
+        # Check for full-name/function-name/class-name trace match
+        trace_opts = info.trace_opts
+        class_match = info.class_match
+        if not trace_opts:
+            # No name match; call cannot be traced
+            return info.fn(*args, **kwargs)
+
+        if trace_opts.sampler and not trace_opts.sampler.sample(info.fullname):
+            # Call not sampled; skip argument matching and context copying
+            return info.fn(*args, **kwargs)
+
         # Collect arguments
         argcount = len(info.argnames)
         args_pairs = zip(info.argnames, args)
@@ -4739,20 +5264,6 @@ class OTrace(object):
         else:
             info.self_arg = None
 
-        # Check for full-name/function-name/class-name trace match
-        info.fullname = info.fn.__name__ if not info.classname else info.classname+"."+info.fn.__name__
-
-        with Trace_rlock:
-            trace_opts = cls.trace_names.get(info.fullname)   # Full name match (most specific)
-            class_match = False
-            if not trace_opts:
-                if info.classname:
-                    trace_opts = cls.trace_names.get("."+info.fn.__name__) # Method name match
-                    if not trace_opts:
-                        trace_opts = cls.trace_names.get(info.classname+".") # Class name match (least specific)
-                        if trace_opts:
-                            class_match = True
-
         info.name_matched = False
         info.return_match_dict = None
 
@@ -4776,19 +5287,17 @@ class OTrace(object):
             if trace_opts.trace_return:
                 if break_action == "tag":
                     # Tag operation; check match only upon return
-                    info.return_match_dict = trace_opts.argmatch
+                    info.return_match_dict = trace_opts.matcher
                 elif class_match:
                     # Class name match; check for trace id match only upon return
-                    info.return_match_dict = trace_opts.argmatch
-                elif trace_opts.argmatch:
+                    info.return_match_dict = trace_opts.matcher
+                elif trace_opts.return_matcher:
                     # Check for return value match, if requested
-                    ret_argmatch = [(key, value) for key, value in trace_opts.argmatch.items() if key == "return" or key.startswith("return.")]
-                    if ret_argmatch:
-                        info.return_match_dict = dict(ret_argmatch)
+                    info.return_match_dict = trace_opts.return_matcher
             
             if match_tag or (not class_match and trace_opts.trace_call):
                 # Check for trace_id or related_id match on argument values
-                info.trace_context, info.trace_id, info.related_id = cls.check_trace_match(info.fn, info.fullname, info.self_arg, info.arg_dict, trace_dict=trace_opts.argmatch, break_action=break_action, match_tag=match_tag)
+                info.trace_context, info.trace_id, info.related_id = cls.check_trace_match(info.fn, info.fullname, info.self_arg, info.arg_dict, trace_dict=trace_opts.matcher, break_action=break_action, match_tag=match_tag)
 
                 if info.trace_context:
                     with Trace_rlock:
@@ -4810,6 +5319,8 @@ class OTrace(object):
         if info.call_display:
             # Display call name trace
             cls.callback_handler.callback(info.trace_id, info.methodtype, info.modulename, info.classname, info.fn.__name__, info.arg_val_pairs, info.nameless_args_list)
+            if TraceExporter.write_queue:
+                TraceExporter.export("call", info.trace_id, info.fullname)
             if break_action in BREAK_ACTIONS:
                 cls.break_flow(info.trace_id, action=break_action)
 
@@ -4879,6 +5390,8 @@ class OTrace(object):
                                                                      excp=excp, exc_info=exc_info)
 
                         cls.callback_handler.callback(trace_id, info.methodtype, info.modulename, info.classname, info.fn.__name__)
+                        if TraceExporter.write_queue:
+                            TraceExporter.export("exception", trace_id, info.fullname, excp)
                     except Exception:
                         pass
                     finally:
@@ -4919,6 +5432,8 @@ class OTrace(object):
             if not info.call_display:
                 # Display call name trace retroactively
                 cls.callback_handler.callback(info.trace_id, info.methodtype, info.modulename, info.classname, info.fn.__name__, info.arg_val_pairs, info.nameless_args_list, retro=True)
+                if TraceExporter.write_queue:
+                    TraceExporter.export("call", info.trace_id, info.fullname)
 
                 if info.trace_context:
                     # Update return trace count (only if not already updated during call)
@@ -4939,6 +5454,8 @@ class OTrace(object):
 
             # Display return name trace
             cls.callback_handler.returnback(info.trace_id, info.methodtype, info.modulename, info.classname, info.fn.__name__, return_value)
+            if TraceExporter.write_queue:
+                TraceExporter.export("return", info.trace_id, info.fullname, return_value)
             if break_action in BREAK_ACTIONS:
                 cls.break_flow(info.trace_id, action=break_action)
 
@@ -4952,8 +5469,50 @@ class OTrace(object):
                 except Exception:
                     pass
 
+        if break_action == "park" and not trampoline_return and (info.call_display or return_display):
+            if not info.trace_id and callable(getattr(return_value, "add_done_callback", None)):
+                # Name match only; create hold context for parked call
+                locals_dict = TraceDict(cls.copy_or_not(info.arg_dict, split=True))
+                locals_dict.set_trc("return_value", return_value)
+                info.trace_context, info.trace_id = cls.create_context(info.fullname, info.self_arg, locals_dict,
+                                                                       id_label="park", context_type="holds",
+                                                                       set_hold=False)
+            return cls.park_flow(info.trace_id, return_value)
+
         return return_value
 
+    @classmethod
+    def park_flow(cls, trace_id, future):
+        """Parks a Future-like return value, returning a new future that completes only after "resume".
+        The calling thread (or event loop) is not blocked; the continuation of the caller is held instead.
+        Other return values are passed through unchanged.
+        """
+        if not trace_id or not callable(getattr(future, "add_done_callback", None)):
+            return future
+        try:
+            parked_future = future.__class__()
+        except Exception:
+            return future
+
+        context_path = [BASE_DIR, RECENT_DIR] + ContextDict.split_trace_id(trace_id)
+        handler = HoldHandler(None, PATH_SEP+PATH_SEP.join(context_path), resume_value=future)
+        handler(functools.partial(chain_future, parked_future))
+        with Trace_rlock:
+            cls.parked[trace_id] = handler
+        return parked_future
+
+    @classmethod
+    def resume_parked(cls, trace_id):
+        """Resumes parked call (executed in otrace thread; result is delivered via the event loop)
+        Returns True if call was parked.
+        """
+        with Trace_rlock:
+            handler = cls.parked.pop(trace_id, None)
+        if not handler:
+            return False
+        handler.resume()
+        return True
+
     @classmethod
     def trace_generator(cls, info, trace_opts, gen):
         send_value = None
@@ -4997,6 +5556,8 @@ class OTrace(object):
                                                                      excp=excp, exc_info=exc_info)
 
                         cls.callback_handler.callback(trace_id, info.methodtype, info.modulename, info.classname, info.fn.__name__)
+                        if TraceExporter.write_queue:
+                            TraceExporter.export("exception", trace_id, info.fullname, excp)
                     except Exception, excp:
                         pass
                     finally:
@@ -5045,9 +5606,12 @@ class OTrace(object):
             return function
 
         func_info = FunctionInfo(function, classname=classname, modulename=modulename, methodtype=methodtype)
+        cls.profile_infos.add(func_info)
         @functools.wraps(function)
         def otrace_wrapped(*args, **kwargs):
-            if not cls.trace_active:
+            if cls.profile_active:
+                return cls.profile_function_call(func_info, *args, **kwargs)
+            if not cls.trace_active or (func_info.trace_generation == cls.trace_generation[0] and not func_info.trace_opts):
                 return function(*args, **kwargs)
             return cls.otrace_function_call(func_info, *args, **kwargs)
 
@@ -5055,6 +5619,42 @@ class OTrace(object):
         setattr(otrace_wrapped, cls.orig_function_attr, function)
         return otrace_wrapped
 
+    @classmethod
+    def profile_function_call(cls, info, *args, **kwargs):
+        """Auxiliary method used by wrapper in trace_function, when profiling
+        """
+        child_times = getattr(Profile_local, "child_times", None)
+        if child_times is None:
+            child_times = []
+            Profile_local.child_times = child_times
+        child_times.append(0.0)
+        start_time = time.time()
+        try:
+            if cls.trace_active:
+                return cls.otrace_function_call(info, *args, **kwargs)
+            return info.fn(*args, **kwargs)
+        finally:
+            elapsed = time.time() - start_time
+            child_time = child_times.pop()
+            if child_times:
+                child_times[-1] += elapsed
+            info.profile.record(elapsed, elapsed-child_time)
+
+    @classmethod
+    def profile_stats(cls, sort_key="self_time", count=PROFILE_TOP, pattern=""):
+        """Returns list of (fullname, FunctionProfile) for the top count profiled functions,
+        sorted by sort_key (calls/cum_time/self_time/max_time), with names optionally matching glob pattern
+        """
+        stats = [(info.fullname, info.profile) for info in list(cls.profile_infos)
+                 if info.profile.calls and (not pattern or fnmatch.fnmatchcase(info.fullname, pattern))]
+        stats.sort(key=lambda x: getattr(x[1], sort_key), reverse=True)
+        return stats[:count] if count else stats
+
+    @classmethod
+    def profile_reset(cls):
+        for info in list(cls.profile_infos):
+            info.profile.reset()
+
     @classmethod
     def trace_method(cls, parent_cls, method, modulename="", unwrap=False):
         """Trace a method in a class"""
@@ -5201,11 +5801,9 @@ class OTrace(object):
             if not entity_cache:
                 return
             entity = entity_cache.unpack()
-            for attr, value in trace_opts.argmatch.iteritems():
-                attr, cmp_op = strip_compare_op(attr)
-                if not compare(getattr(entity, attr, None), cmp_op, value):
-                    # Match failed; no trace
-                    return
+            if not trace_opts.matcher.match_object(entity):
+                # Match failed; no trace
+                return
             trace_matched = True
 
         if not trace_matched:
@@ -5234,6 +5832,8 @@ class OTrace(object):
                                                      context_type="dbaccess", id_label=op_type)
 
         cls.callback_handler.accessback(trace_id, op_type, key_str, entity)
+        if TraceExporter.write_queue:
+            TraceExporter.export("dbaccess", trace_id, name_str, op_type)
         if trace_opts.break_action in BREAK_ACTIONS:
             cls.break_flow(trace_id, action=trace_opts.break_action)
 
@@ -5379,6 +5979,20 @@ def schedule_callback(callback=None):
         # Direct callback; may be unsafe!
         callback()
 
+def chain_future(dest_future, future):
+    """Copies result (or exception) of future to dest_future, when future is done"""
+    def copy_result(future):
+        try:
+            result = future.result()
+        except Exception, excp:
+            if hasattr(dest_future, "set_exc_info"):
+                dest_future.set_exc_info(sys.exc_info())
+            else:
+                dest_future.set_exception(excp)
+        else:
+            dest_future.set_result(result)
+    future.add_done_callback(copy_result)
+
 class HoldHandler(object):
     """ Hold handler for use with otrace (callable instance)
     """
@@ -5391,6 +6005,9 @@ class HoldHandler(object):
     def __call__(self, callback=None):
         # Save callback for use on request completion
         self.callback = callback
+        if self.self_arg is None:
+            # Parked call; resumed using trace_id
+            return
         if hasattr(self.self_arg, OTrace.hold_attr):
             delattr(self.self_arg, OTrace.hold_attr)
         setattr(self.self_arg, OTrace.resume_attr, self.resume)
@@ -5416,6 +6033,18 @@ class PickleInterface(object):
     write_file = ""
     read_file = ""
 
+    pickle_names = ["otrace_context", "recnum", "key", "methodname", "context_id", "timestamp", "pickled_object"]
+    pickle_create_sql = "CREATE TABLE IF NOT EXISTS %s (%s INTEGER PRIMARY KEY AUTOINCREMENT, %s TEXT UNIQUE, %s TEXT, %s TEXT, %s TEXT, %s TEXT)" % tuple(pickle_names[:])
+    pickle_index_sql = ["CREATE INDEX IF NOT EXISTS %s_%s ON %s (%s)" % (pickle_names[0], column, pickle_names[0], column)
+                        for column in pickle_names[3:6]]
+    pickle_insert_sql = "INSERT INTO %s VALUES (null, :%s, :%s, :%s, :%s, :%s)" % tuple(pickle_names[:1] + pickle_names[2:])
+    pickle_filter_names = pickle_names[2:6]
+
+    # Contexts are pickled when traced, and written by a background thread, in batched transactions
+    write_queue = None
+    write_thread = None
+    write_stats = {"written": 0, "dropped": 0, "batches": 0}
+
     @classmethod
     def set_monitor(cls, monitor):
         pass
@@ -5513,23 +6142,101 @@ class PickleInterface(object):
         try:
             cls.write_connection = sqlite3.connect(filename, check_same_thread=False)
             cls.write_file = filename
-            cls.pickle_names = ["otrace_context", "recnum", "key", "methodname", "context_id", "timestamp", "pickled_object"]
-
-            cls.pickle_create_sql = "CREATE TABLE IF NOT EXISTS %s (%s INTEGER PRIMARY KEY AUTOINCREMENT, %s TEXT UNIQUE, %s TEXT, %s TEXT, %s TEXT, %s TEXT)" % tuple(cls.pickle_names[:])
-            cls.pickle_insert_sql = "INSERT INTO %s VALUES (null, :%s, :%s, :%s, :%s, :%s)" % tuple(cls.pickle_names[:1] + cls.pickle_names[2:])
-
-            cls.pickle_select_key_sql = "SELECT %s FROM %s" % (cls.pickle_names[2], cls.pickle_names[0])
-            cls.pickle_select_record_sql = "SELECT * FROM %s" % (cls.pickle_names[0],)
+            # Write-ahead logging allows reads during writes, and makes commits cheaper
+            cls.write_connection.execute("PRAGMA journal_mode=WAL")
+            cls.write_connection.execute("PRAGMA synchronous=NORMAL")
             cls.write_connection.execute(cls.pickle_create_sql)
+            for index_sql in cls.pickle_index_sql:
+                cls.write_connection.execute(index_sql)
             cls.write_connection.commit()
         except sqlite3.OperationalError, msg:
             logging.error("Error in creating pickle database %s: %s" % (cls.write_file, msg))
             raise
 
+        cls.write_stats.update(written=0, dropped=0, batches=0)
+        cls.write_queue = Queue.Queue(maxsize=MAX_PICKLE_QUEUE)
+        cls.write_thread = threading.Thread(target=cls.pickle_writer, args=(cls.write_queue, cls.write_connection),
+                                            name="otrace-pickle-writer")
+        cls.write_thread.setDaemon(True)
+        cls.write_thread.start()
+
+    @classmethod
+    def close_pickle_db(cls):
+        """Write any queued contexts and close pickle database file for writing
+        """
+        if cls.write_thread:
+            cls.write_queue.put(None)
+            cls.write_thread.join()
+            cls.write_thread = None
+            cls.write_queue = None
+        if cls.write_connection:
+            with Pickle_rlock:
+                if cls.read_connection is cls.write_connection:
+                    cls.read_connection = None
+                cls.write_connection.close()
+                cls.write_connection = None
+                cls.write_file = ""
+
+    @classmethod
+    def flush_pickle_db(cls):
+        """Wait until all queued contexts have been written
+        """
+        if cls.write_thread:
+            cls.write_queue.join()
+
+    @classmethod
+    def pickle_writer(cls, write_queue, write_connection):
+        """Background thread that writes queued pickled contexts in batches
+        """
+        while True:
+            batch = [write_queue.get()]
+            try:
+                while batch[-1] is not None and len(batch) < MAX_PICKLE_BATCH:
+                    try:
+                        batch.append(write_queue.get_nowait())
+                    except Queue.Empty:
+                        break
+
+                records = []
+                for entry in batch:
+                    if entry is None:
+                        continue
+                    try:
+                        trace_id, pickled = entry
+                        context_type, methodname, context_id, timestamp = ContextDict.split_trace_id(trace_id)
+                        records.append({"key": trace_id, "timestamp": timestamp, "methodname": methodname,
+                                        "context_id": context_id, "pickled_object": sqlite3.Binary(pickled)})
+                    except Exception, excp:
+                        logging.error("Error in processing entry %.100r for pickle_db %s: %s", entry, cls.write_file, excp)
+
+                if records:
+                    with Pickle_rlock:
+                        for record in records:
+                            try:
+                                write_connection.execute(cls.pickle_insert_sql, record)
+                                cls.write_stats["written"] += 1
+                            except Exception, excp:
+                                logging.error("Error in adding entry to pickle_db %s: %s", cls.write_file, excp)
+                        try:
+                            write_connection.commit()
+                            cls.write_stats["batches"] += 1
+                        except Exception, excp:
+                            logging.error("Error in committing entries to pickle_db %s: %s", cls.write_file, excp)
+            except Exception, excp:
+                logging.error("Error in writing batch to pickle_db %s: %s", cls.write_file, excp)
+            finally:
+                # Mark every dequeued entry as done, so that flush/close do not block
+                for entry in batch:
+                    write_queue.task_done()
+
+            if batch[-1] is None:
+                break
+
     @classmethod
     def pickle_check(cls, obj, depth=0):
         """Return copy of object to be pickled, replacing non-pickleable components with string
-        representations
+        representations. Pickleable components are returned as PickledData, so that they are
+        pickled only once.
         """
         # PRELIMINARY IMPLEMENTATION
         # (Until we develop "failsafe" pickling, this will only pickle pickleable objects
@@ -5542,11 +6249,14 @@ class PickleInterface(object):
             if isinstance(obj, dict):
                 return dict((key, cls.pickle_check(value, depth=depth+1)) for key, value in obj.iteritems())
 
+        if isinstance(obj, ObjectSnapshot.scalar_types):
+            return obj
+
         try:
             # Check if object is pickleable (and not too large when pickled)
-            pickled = cPickle.dumps(obj)
+            pickled = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
             if len(pickled) <= MAX_PICKLE_DATA_LENGTH:
-                 return obj
+                 return PickledData(pickled)
         except Exception:
             pass
 
@@ -5556,18 +6266,24 @@ class PickleInterface(object):
 
     @classmethod
     def write_pickle_db(cls, trace_id, obj):
-        """Write pickled context object corresponding to trace_id
+        """Pickle context object corresponding to trace_id and queue it for writing.
+        (Context is pickled immediately, because traced values may be modified after the call returns.)
+        If the write queue is full, the context is dropped.
         """
-        context_type, methodname, context_id, timestamp = ContextDict.split_trace_id(trace_id)
+        write_queue = cls.write_queue
+        if not write_queue:
+            return
         try:
             pickled = cPickle.dumps(cls.pickle_check(obj), cPickle.HIGHEST_PROTOCOL)
-            with Pickle_rlock:
-                cursor = cls.write_connection.execute(cls.pickle_insert_sql,
-                                {"key": trace_id, "timestamp": timestamp, "methodname": methodname,
-                                 "context_id": context_id, "pickled_object": sqlite3.Binary(pickled)})
-                cls.write_connection.commit()
         except Exception, excp:
-            logging.error("Error in adding entry to pickle_db %s: %s", cls.write_file, excp)
+            logging.error("Error in pickling entry %s for pickle_db %s: %s", trace_id, cls.write_file, excp)
+            return
+        try:
+            write_queue.put_nowait( (trace_id, pickled) )
+        except Queue.Full:
+            cls.write_stats["dropped"] += 1
+            if cls.write_stats["dropped"] == 1 or not (cls.write_stats["dropped"] % MAX_PICKLE_QUEUE):
+                logging.warning("Pickle_db %s write queue full; %d contexts dropped", cls.write_file, cls.write_stats["dropped"])
 
     @classmethod
     def open_pickle_db(cls, filename):
@@ -5582,49 +6298,298 @@ class PickleInterface(object):
                 if cls.read_connection and cls.read_connection is not cls.write_connection:
                     cls.read_connection.close()
                     cls.read_connection = None
-                cls.read_connection = sqlite3.connect(filename)
+                cls.read_connection = sqlite3.connect(filename, check_same_thread=False)
+                try:
+                    # Add indexes to databases created by older versions (if writable)
+                    for index_sql in cls.pickle_index_sql:
+                        cls.read_connection.execute(index_sql)
+                    cls.read_connection.commit()
+                except sqlite3.Error:
+                    pass
         except sqlite3.OperationalError, msg:
             logging.error("Error in reading pickle database %s: %s" % (cls.read_file, msg))
             raise
 
+    @classmethod
+    def select_pickle_sql(cls, columns, filters, start_time="", end_time="", after=0, limit=0):
+        """Returns (select_sql, select_vals) for query on pickle database.
+        filters is a dict with keys key/methodname/context_id/timestamp, all of which must match
+        (values containing "*" are matched as glob patterns).
+        start_time <= timestamp < end_time, if specified. Records are ordered by recnum,
+        starting after recnum value after (for cursor-based pagination)
+        """
+        conditions = []
+        select_vals = []
+        for arg_name, arg_value in sorted(filters.items()):
+            if arg_name not in cls.pickle_filter_names:
+                raise OTraceException("Invalid pickle_db filter name: %s" % arg_name)
+            conditions.append("%s %s ?" % (arg_name, "GLOB" if "*" in arg_value else "="))
+            select_vals.append(arg_value)
+        if start_time:
+            conditions.append("timestamp >= ?")
+            select_vals.append(start_time)
+        if end_time:
+            conditions.append("timestamp < ?")
+            select_vals.append(end_time)
+        if after:
+            conditions.append("recnum > ?")
+            select_vals.append(after)
+
+        select_sql = "SELECT %s FROM %s" % (", ".join(columns), cls.pickle_names[0])
+        if conditions:
+            select_sql += " WHERE " + " AND ".join(conditions)
+        select_sql += " ORDER BY recnum"
+        if limit:
+            select_sql += " LIMIT %d" % limit
+        return select_sql, select_vals
+
+    @classmethod
+    def iter_pickle_db(cls, columns, start_time="", end_time="", after=0, limit=0, page_size=PICKLE_PAGE_SIZE, **filters):
+        """Generator yielding (recnum, column_values...) rows matching filters (see select_pickle_sql),
+        fetching page_size rows at a time
+        """
+        count = 0
+        while not limit or count < limit:
+            page_limit = min(page_size, limit-count) if limit else page_size
+            select_sql, select_vals = cls.select_pickle_sql(["recnum"]+columns, filters, start_time=start_time, end_time=end_time,
+                                                            after=after, limit=page_limit)
+            with Pickle_rlock:
+                rows = cls.read_connection.execute(select_sql, select_vals).fetchall()
+            for row in rows:
+                yield row
+            if len(rows) < page_limit:
+                break
+            count += len(rows)
+            after = rows[-1][0]
+
+    @classmethod
+    def iter_keys_pickle_db(cls, **kwargs):
+        """Generator yielding (recnum, key) for keys matching kwargs (see iter_pickle_db)
+        """
+        for recnum, key in cls.iter_pickle_db(["key"], **kwargs):
+            yield recnum, str(key)
+
+    @classmethod
+    def iter_records_pickle_db(cls, **kwargs):
+        """Generator yielding (recnum, unpickled context object) for records matching kwargs (see iter_pickle_db)
+        """
+        for recnum, pickled in cls.iter_pickle_db(["pickled_object"], **kwargs):
+            yield recnum, cPickle.loads(str(pickled))
+
     @classmethod
     def read_keys_pickle_db(cls, **kwargs):
         """Read keys as filtered by kwargs
-        (key=..., methodname=..., context_id=...)
+        (key=..., methodname=..., context_id=..., start_time=..., end_time=..., after=recnum, limit=count)
         and return list of matching keys
         (If no filters, all keys are returned)
         """
         try:
-            with Pickle_rlock:
-                select_sql = cls.pickle_select_key_sql
-                select_vals = []
-                for arg_name, arg_value in kwargs.items():
-                    select_sql += " WHERE %s=?" % arg_name
-                    select_vals.append(arg_value)
-                cursor = cls.read_connection.execute(select_sql, select_vals)
-                return [str(x[0]) for x in cursor.fetchall()]
+            return [key for recnum, key in cls.iter_keys_pickle_db(**kwargs)]
         except Exception, excp:
-            logging.error("Error in retrieving key(s) from pickle_db: %s", kwargs, excp)
+            logging.error("Error in retrieving key(s) from pickle_db %s: %s", kwargs, excp)
 
     @classmethod
     def read_records_pickle_db(cls, **kwargs):
         """Read contexts as filtered by kwargs
-        (key=..., methodname=..., context_id=...)
+        (key=..., methodname=..., context_id=..., start_time=..., end_time=..., after=recnum, limit=count)
         and return list of unpickled context objects
         (If no filters, all records are returned)
         """
         try:
-            with Pickle_rlock:
-                select_sql = cls.pickle_select_record_sql
-                select_vals = []
-                for arg_name, arg_value in kwargs.items():
-                    select_sql += " WHERE %s=?" % arg_name
-                    select_vals.append(arg_value)
-                cursor = cls.read_connection.execute(select_sql, select_vals)
-                rows = cursor.fetchall()
-                return [cPickle.loads(str(row[-1])) for row in rows]
+            return [record for recnum, record in cls.iter_records_pickle_db(**kwargs)]
         except Exception, excp:
-            logging.error("Error in retrieving record(s) from pickle_db: %s", kwargs, excp)
+            logging.error("Error in retrieving record(s) from pickle_db %s: %s", kwargs, excp)
+
+class RotatingExportFile(object):
+    """Binary export log file, rotated (like logging.handlers.RotatingFileHandler) when it exceeds max_bytes
+    """
+    def __init__(self, filename, max_bytes=EXPORT_MAX_BYTES, backup_count=EXPORT_BACKUP_COUNT):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.file = None
+        self.open()
+
+    def open(self):
+        self.file = open(self.filename, "ab")
+        self.file.seek(0, os.SEEK_END)
+        if not self.file.tell():
+            self.file.write(EXPORT_MAGIC)
+
+    def rotate(self):
+        self.file.close()
+        for j in range(self.backup_count-1, 0, -1):
+            src = "%s.%d" % (self.filename, j)
+            if os.path.exists(src):
+                os.rename(src, "%s.%d" % (self.filename, j+1))
+        if self.backup_count:
+            os.rename(self.filename, self.filename+".1")
+        else:
+            os.remove(self.filename)
+        self.open()
+
+    def write(self, data):
+        if self.max_bytes and self.file.tell() > len(EXPORT_MAGIC) and self.file.tell() + len(data) > self.max_bytes:
+            self.rotate()
+        self.file.write(data)
+        self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+class ExportSocket(object):
+    """Connection to a Unix domain socket collector (see otracecat), reconnected as needed
+    """
+    def __init__(self, path, timeout=EXPORT_RECONNECT_SEC):
+        self.path = path
+        self.timeout = timeout
+        self.sock = None
+        self.retry_time = 0
+
+    def write(self, data):
+        if not self.sock:
+            if time.time() < self.retry_time:
+                raise socket.error("Not connected to %s" % self.path)
+            try:
+                self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                self.sock.settimeout(self.timeout)
+                self.sock.connect(self.path)
+                self.sock.sendall(EXPORT_MAGIC)
+            except socket.error:
+                self.close()
+                raise
+        try:
+            self.sock.sendall(data)
+        except socket.error:
+            self.close()
+            raise
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            except Exception:
+                pass
+            self.sock = None
+            self.retry_time = time.time() + EXPORT_RECONNECT_SEC
+
+class TraceExporter(object):
+    """Streams trace events to a local collector (unix:socket_path) or to a rotating binary log file.
+    Each event is a marshalled tuple (event, timestamp, pid, thread_name, trace_id, fullname, detail),
+    preceded by its length as a 4-byte unsigned int; each stream starts with EXPORT_MAGIC.
+    Events are queued and written by a background thread; events are dropped if the queue is full,
+    or if the collector is not reachable, so that traced code is never blocked.
+    """
+    dest = ""
+    write_queue = None
+    write_thread = None
+    stats = {"exported": 0, "dropped": 0, "errors": 0}
+
+    @classmethod
+    def start(cls, dest):
+        """Start exporting to dest ("unix:socket_path" or log file path)
+        """
+        cls.stop()
+        if dest.startswith(EXPORT_SOCKET_PREFIX):
+            writer = ExportSocket(dest[len(EXPORT_SOCKET_PREFIX):])
+        else:
+            writer = RotatingExportFile(dest)
+        cls.dest = dest
+        cls.stats.update(exported=0, dropped=0, errors=0)
+        cls.write_queue = Queue.Queue(maxsize=MAX_EXPORT_QUEUE)
+        cls.write_thread = threading.Thread(target=cls.exporter, args=(cls.write_queue, writer),
+                                            name="otrace-exporter")
+        cls.write_thread.setDaemon(True)
+        cls.write_thread.start()
+
+    @classmethod
+    def stop(cls):
+        """Write any queued events and stop exporting
+        """
+        write_queue, write_thread = cls.write_queue, cls.write_thread
+        cls.write_queue = None
+        cls.write_thread = None
+        cls.dest = ""
+        if write_thread:
+            write_queue.put(None)
+            write_thread.join()
+
+    @classmethod
+    def flush(cls):
+        """Wait until all queued events have been written
+        """
+        if cls.write_queue:
+            cls.write_queue.join()
+
+    @classmethod
+    def export(cls, event, trace_id, fullname, detail=None):
+        """Queue trace event for export (never blocks)
+        """
+        write_queue = cls.write_queue
+        if not write_queue:
+            return
+        if detail is None:
+            detail = ""
+        elif not isinstance(detail, str):
+            try:
+                detail = reprlib.repr(detail)
+            except Exception, excp:
+                detail = "<repr error: %s>" % excp
+        try:
+            write_queue.put_nowait( (event, time.time(), os.getpid(), threading.currentThread().getName(),
+                                     trace_id or "", fullname, detail[:MAX_EXPORT_DETAIL]) )
+        except Queue.Full:
+            cls.stats["dropped"] += 1
+
+    @classmethod
+    def encode(cls, record):
+        data = marshal.dumps(record, 2)
+        return struct.pack("!I", len(data)) + data
+
+    @classmethod
+    def decode(cls, buf, offset=0):
+        """Decode complete event records in buf, starting at offset.
+        Returns (records_list, offset_of_first_incomplete_record)
+        """
+        records = []
+        while len(buf) - offset >= 4:
+            length = struct.unpack("!I", buf[offset:offset+4])[0]
+            if len(buf) - offset - 4 < length:
+                break
+            records.append(marshal.loads(buf[offset+4:offset+4+length]))
+            offset += 4 + length
+        return records, offset
+
+    @classmethod
+    def exporter(cls, write_queue, writer):
+        """Background thread that writes queued events in batches
+        """
+        while True:
+            batch = [write_queue.get()]
+            while batch[-1] is not None and len(batch) < MAX_EXPORT_BATCH:
+                try:
+                    batch.append(write_queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            records = [record for record in batch if record is not None]
+            if records:
+                try:
+                    writer.write("".join(cls.encode(record) for record in records))
+                    cls.stats["exported"] += len(records)
+                except Exception, excp:
+                    if cls.stats["errors"] % 1000 == 0:
+                        logging.error("Error in exporting trace events to %s: %s", writer.__class__.__name__, excp)
+                    cls.stats["errors"] += 1
+                    cls.stats["dropped"] += len(records)
+
+            for entry in batch:
+                write_queue.task_done()
+            if batch[-1] is None:
+                writer.close()
+                break
 
 # Convenient aliases
 traceassert = OTrace.traceassert
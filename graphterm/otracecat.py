@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+"""otracecat: Read, tail or collect trace events exported by otrace (set export_to ...)
+
+Events are read from binary export log files, or received from many traced processes
+by listening on a Unix domain socket (as the collector). Events are listed one per line,
+or aggregated by function (call/return/exception counts and call durations).
+
+Usage:
+    otracecat trace.otx.1 trace.otx              # List events in log files
+    otracecat -f trace.otx                       # Tail log file (following rotation)
+    otracecat -s trace.otx                       # Summarize events by function
+    otracecat -o all.otx unix:/tmp/otrace.sock   # Collect events from processes into a log file
+    otracecat -s -i 10 unix:/tmp/otrace.sock     # Collect events, displaying summary every 10 sec
+"""
+
+import optparse
+import os
+import select
+import socket
+import sys
+import time
+
+import otrace
+
+READ_BYTES = 65536
+FOLLOW_INTERVAL = 0.5   # Interval (sec) for polling followed log files
+
+EVENT_FORMAT = "%s %6d %-12s %-9s %s %s %s"
+SUMMARY_FORMAT = "%-40s %8s %8s %8s %10s %10s"
+
+class Summary(object):
+    """Aggregates events by function name; call durations are matched by process and thread
+    """
+    def __init__(self):
+        self.counts = {}     # fullname -> {event: count}
+        self.durations = {}  # fullname -> [total_sec, max_sec, count]
+        self.pending = {}    # (pid, thread_name, fullname) -> list of call timestamps
+
+    def add(self, record):
+        event, timestamp, pid, thread_name, trace_id, fullname, detail = record
+        counts = self.counts.setdefault(fullname, {})
+        counts[event] = counts.get(event, 0) + 1
+        key = (pid, thread_name, fullname)
+        if event == "call":
+            self.pending.setdefault(key, []).append(timestamp)
+        elif event in ("return", "exception") and self.pending.get(key):
+            elapsed = timestamp - self.pending[key].pop()
+            duration = self.durations.setdefault(fullname, [0.0, 0.0, 0])
+            duration[0] += elapsed
+            duration[1] = max(duration[1], elapsed)
+            duration[2] += 1
+
+    def display(self, outfile=sys.stdout):
+        print >> outfile, SUMMARY_FORMAT % ("function", "calls", "returns", "excepts", "avg_ms", "max_ms")
+        for fullname in sorted(self.counts, key=lambda name: -sum(self.counts[name].values())):
+            counts = self.counts[fullname]
+            total, max_time, count = self.durations.get(fullname, [0.0, 0.0, 0])
+            print >> outfile, SUMMARY_FORMAT % (fullname, counts.get("call", 0), counts.get("return", 0),
+                                                counts.get("exception", 0),
+                                                "%.3f" % (1000*total/count) if count else "-",
+                                                "%.3f" % (1000*max_time) if count else "-")
+        outfile.flush()
+
+def format_record(record):
+    event, timestamp, pid, thread_name, trace_id, fullname, detail = record
+    return EVENT_FORMAT % (time.strftime("%H:%M:%S", time.localtime(timestamp)) + ("%.3f" % (timestamp % 1))[1:],
+                           pid, thread_name[:12], event, fullname, trace_id, detail)
+
+class LogReader(object):
+    """Reads events from an export log file, optionally following it across rotations
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+        self.inode = None
+        self.buf = ""
+
+    def open(self):
+        self.file = open(self.filename, "rb")
+        self.inode = os.fstat(self.file.fileno()).st_ino
+        self.buf = ""
+        magic = self.file.read(len(otrace.EXPORT_MAGIC))
+        if magic != otrace.EXPORT_MAGIC:
+            raise Exception("File %s is not an otrace export log" % self.filename)
+
+    def read(self):
+        """Returns list of events read (empty list at end of file)"""
+        if not self.file:
+            self.open()
+        data = self.file.read(READ_BYTES)
+        if not data:
+            return []
+        self.buf += data
+        records, offset = otrace.TraceExporter.decode(self.buf)
+        self.buf = self.buf[offset:]
+        return records
+
+    def rotated(self):
+        """Returns True if file has been rotated (and the current file has been completely read)"""
+        try:
+            return os.stat(self.filename).st_ino != self.inode
+        except OSError:
+            return False
+
+def collect(path, handle_records, interval=0):
+    """Listen on Unix domain socket path, handling records received from any number of processes
+    (handle_records(None) is also invoked every interval seconds, if interval is non-zero)
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(16)
+    buffers = {}   # socket -> buffered data (None until magic is received)
+    next_time = time.time() + interval if interval else None
+    try:
+        while True:
+            timeout = max(0, next_time - time.time()) if next_time else None
+            readable, writable, errors = select.select([server] + buffers.keys(), [], [], timeout)
+            for sock in readable:
+                if sock is server:
+                    conn, addr = server.accept()
+                    buffers[conn] = None
+                    continue
+                data = sock.recv(READ_BYTES)
+                if not data:
+                    del buffers[sock]
+                    sock.close()
+                    continue
+                buf = data if buffers[sock] is None else buffers[sock] + data
+                if buffers[sock] is None:
+                    if len(buf) < len(otrace.EXPORT_MAGIC):
+                        continue
+                    if not buf.startswith(otrace.EXPORT_MAGIC):
+                        print >> sys.stderr, "otracecat: Invalid export stream; closing connection"
+                        del buffers[sock]
+                        sock.close()
+                        continue
+                    buf = buf[len(otrace.EXPORT_MAGIC):]
+                records, offset = otrace.TraceExporter.decode(buf)
+                buffers[sock] = buf[offset:]
+                if records:
+                    handle_records(records)
+            if next_time and time.time() >= next_time:
+                handle_records(None)
+                next_time = time.time() + interval
+    finally:
+        server.close()
+        for sock in buffers:
+            sock.close()
+        os.remove(path)
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = optparse.OptionParser(usage="usage: %prog [-f] [-s] [-i interval] [-o output_log] (logfile ...|unix:socket_path)")
+    parser.add_option("-f", "--follow", dest="follow", action="store_true", default=False,
+                      help="Follow (tail) last log file, across rotations")
+    parser.add_option("-s", "--summary", dest="summary", action="store_true", default=False,
+                      help="Summarize events by function, rather than listing them")
+    parser.add_option("-i", "--interval", dest="interval", type="float", default=0,
+                      help="Display summary every interval seconds (when following or collecting)")
+    parser.add_option("-o", "--output", dest="output", default="",
+                      help="Write events (received from socket) to rotating export log file")
+    (options, args) = parser.parse_args(args)
+
+    if not args:
+        parser.error("Specify log file(s) or unix:socket_path")
+
+    summary = Summary() if options.summary else None
+    output = otrace.RotatingExportFile(options.output) if options.output else None
+
+    def handle_records(records):
+        if records is None:
+            # Interval elapsed
+            if summary:
+                summary.display()
+                print
+            return
+        if output:
+            output.write("".join(otrace.TraceExporter.encode(record) for record in records))
+        for record in records:
+            if summary:
+                summary.add(record)
+            elif not output:
+                print format_record(record)
+        sys.stdout.flush()
+
+    try:
+        if args[0].startswith(otrace.EXPORT_SOCKET_PREFIX):
+            collect(args[0][len(otrace.EXPORT_SOCKET_PREFIX):], handle_records, interval=options.interval)
+        else:
+            for j, filename in enumerate(args):
+                reader = LogReader(filename)
+                follow = options.follow and j == len(args)-1
+                next_time = time.time() + options.interval if options.interval else None
+                while True:
+                    records = reader.read()
+                    if records:
+                        handle_records(records)
+                        continue
+                    if not follow:
+                        break
+                    if reader.rotated():
+                        reader.open()
+                        continue
+                    if next_time and time.time() >= next_time:
+                        handle_records(None)
+                        next_time = time.time() + options.interval
+                    time.sleep(FOLLOW_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+    except Exception, excp:
+        print >> sys.stderr, "otracecat: %s" % excp
+        sys.exit(1)
+    finally:
+        if output:
+            output.close()
+
+    if summary:
+        summary.display()
+
+if __name__ == "__main__":
+    main()
@@ -33,6 +33,8 @@ from tornado import ioloop
 from tornado import iostream
 from tornado import web
 
+import metrics
+
 SIGN_SEP = "|"
 SIGN_HEXDIGITS = 16
 SIGN_HASH = hashlib.sha256
@@ -49,6 +51,12 @@ MASTER_POLICY_XML_FORMAT = """<cross-domain-policy>
   <allow-access-from domain="%s" to-ports="%s" />
 </cross-domain-policy>
 """
+Packets_received = metrics.counter("gterm_packets_received_total", "Packets received", ["connector"])
+Bytes_received = metrics.counter("gterm_packet_bytes_received_total", "Packet bytes received", ["connector"])
+Packets_sent = metrics.counter("gterm_packets_sent_total", "Packets sent", ["connector"])
+Bytes_sent = metrics.counter("gterm_packet_bytes_sent_total", "Packet bytes sent", ["connector"])
+Rpc_dispatch_seconds = metrics.histogram("gterm_rpc_dispatch_seconds", "RPC method dispatch time", ["method"])
+
 SOCKET_POLICY_XML_FORMAT = """<cross-domain-policy>
   <allow-access-from domain="%s" to-ports="%s" />
 </cross-domain-policy>
@@ -180,6 +188,9 @@ class PacketConnector(object):
 
         self.last_active_time = time.time()
         if data:
+            labels = (self.__class__.__name__,)
+            Packets_received.inc(labels=labels)
+            Bytes_received.inc(len(data), labels=labels)
             if self.delimiter:
                 # Strip out delimiter
                 data = data[:-len(self.delimiter)]
@@ -290,6 +301,9 @@ class PacketConnector(object):
             callback = None
 
         if self.stream and not buffer:
+            labels = (self.__class__.__name__,)
+            Packets_sent.inc(labels=labels)
+            Bytes_sent.inc(len(data), labels=labels)
             try:
                 self.stream.write(data, callback)
             except Exception, excp:
@@ -776,6 +790,8 @@ class RPCLink(object):
         else:
             # New inbound message of the form [method, args_array, kwargs_dict]
             retval = None
+            method_label = "other"
+            start_time = time.time()
             try:
                 args = msg_obj[1] if len(msg_obj) > 1 else []
                 kwargs = dict2kwargs(msg_obj[2]) if len(msg_obj) > 2 else {}
@@ -783,12 +799,15 @@ class RPCLink(object):
                     kwargs["_content"] = _content
                 bound_method = getattr(self, "remote_"+msg_obj[0], None)
                 if bound_method:
+                    method_label = msg_obj[0]
                     retval = bound_method(*args, **kwargs)
                 else:
                     retval = self.invoke_method(msg_obj[0], *args, **kwargs)
             except Exception, excp:
                 retval = "Error: %s: %s\n%s" % (msg_obj[0], excp, "".join(traceback.format_exc()))
                 logging.error("RPCLink.process_packet: %s: %s", self.connection_id, retval)
+            # Label only known methods, to bound label cardinality
+            Rpc_dispatch_seconds.observe(time.time()-start_time, labels=(method_label,))
 
             if packet_id > 0:
                 # Acknowledge message
@@ -88,6 +88,8 @@ var gFormIndex = null;
 
 var gExpectUpload = null
 var gUploadFile = null;
+var gUploadChunked = null;
+var gPageMoreObserver = null;
 
 var gControlQ = false;
 var gShortcutMenus = null;
@@ -183,6 +185,12 @@ var JFILENAME = 2;
 var JFILEPATH = 3;
 var JQUERY = 4;
 
+var DOWNLOAD_CHUNK_BYTES = 4194304;  // Byte range size for chunked downloads
+var DOWNLOAD_STREAMS = 4;            // Parallel requests for chunked downloads
+var DOWNLOAD_MAX_RETRIES = 3;        // Max. retries for failed chunks
+var DOWNLOAD_MAX_MEMORY_BYTES = 536870912;  // Max. size for chunked downloads assembled in memory
+                                            // (if browser cannot stream to disk)
+
 var AUTH_DIGITS = 12;      // Hex digits in form authentication HMAC
 var HEX_DIGITS = 16;       // Hex digits in user authentication HMAC
 var SIGN_HEXDIGITS = 16;   // Hex digits in user-entered keys
@@ -1005,6 +1013,8 @@ function GTAppendPagelet(parentElem, row_params, entry_class, classes, markup) {
 	GTAutosizeIFrame(scrollElem);
 
     scrollElem.find('.gterm-click').bindclick(gtermPageletClickHandler);
+    scrollElem.find('.gterm-download-chunked').bindclick(GTChunkedDownload);
+    GTPageMoreBindings(scrollElem.find('.gterm-pagemore'));
     scrollElem.find('img.gterm-drag').bind("dragstart", function(evt) {evt.preventDefault();});
     scrollElem.find('.gterm-togglelink').bindclick(gtermLinkClickHandler);
     scrollElem.find('.gterm-iframeclose').bindclick(CloseIFrame);
@@ -1601,12 +1611,13 @@ GTWebSocket.prototype.onmessage = function(evt) {
 		    } else if (response_type == "upload_file") {
 			EndFullpage();
 			if (gUploadFile) {
-			    GTTransmitFile(gUploadFile[0], gUploadFile[1], gUploadFile[2]);
+			    GTTransmitFile(gUploadFile, !!response_params.chunked);
 			    gExpectUpload = null;
 			} else {
 			    var uploadContent = '<div> <b>Select file to upload:</b><input type="file" class="gterm-fileinput" name="gterm-fileinput"></input><div class="gterm-filedrop">or Drag and drop file here</div><input class="gterm-form-button gterm-form-cancel" type="button" value="Cancel"></input> </div>';
 			    var uploadHtml = '<div class="pagelet entry '+classes+' gterm-upload" data-gtermpromptindex="'+gPromptIndex+'">'+uploadContent+'</div>\n'
-			    gExpectUpload = {file_types: params.expect_type || "any", callback: null};
+			    gExpectUpload = {file_types: params.expect_type || "any", callback: null,
+					     chunked: !!response_params.chunked};
 			    var newElem = $(uploadHtml).appendTo("#session-bufscreen");
 			    newElem.find(".gterm-filedrop").rebind('dragover', GTFileDrag);
 			    newElem.find(".gterm-filedrop").rebind('dragleave', GTFileDrag);
@@ -1615,6 +1626,12 @@ GTWebSocket.prototype.onmessage = function(evt) {
 	                    newElem.find(".gterm-form-cancel").bindclick(GTUploadCancel);
 			}
 
+ 		    } else if (response_type == "upload_chunk") {
+			GTUploadChunk(response_params);
+
+ 		    } else if (response_type == "pagelet_page") {
+			GTPageContent(response_params, content);
+
  		    } else if (response_type == "pagelet_json") {
 			try {
 			    var json_obj = JSON.parse(content);
@@ -5110,6 +5127,58 @@ function GTDragBindings(elem) {
     elem.bind('dragstart', GTDragStart);
 }
 
+function GTPageMoreBindings(elems) {
+    // Page requests for paginated pagelets, when clicked or scrolled into view
+    if (!elems.length)
+	return;
+    elems.bindclick(GTPageMoreRequest);
+    if (window.IntersectionObserver) {
+	if (!gPageMoreObserver)
+	    gPageMoreObserver = new IntersectionObserver(function(entries) {
+		for (var j=0; j<entries.length; j++) {
+		    if (entries[j].isIntersecting)
+			GTPageMoreRequest.call(entries[j].target, null);
+		}
+	    });
+	elems.each(function() { gPageMoreObserver.observe(this); });
+    }
+}
+
+function GTPageMoreRequest(evt) {
+    var elem = $(this);
+    if (!elem.hasClass("gterm-pagerequested") && gWebSocket && gParams.controller) {
+	elem.addClass("gterm-pagerequested");
+	gWebSocket.write([["page_request", elem.attr("data-gtermpager"), parseInt(elem.attr("data-gtermpage"))]]);
+    }
+    if (evt)
+	return GTPreventHandler(evt);
+}
+
+function GTPageContent(params, content) {
+    // Insert page content, before page request element
+    var elem = $('#session-bufscreen .gterm-pagemore[data-gtermpager="'+params.pager+'"]');
+    if (!elem.length || parseInt(elem.attr("data-gtermpage")) != params.page)
+	return;
+    if (gPageMoreObserver)
+	gPageMoreObserver.unobserve(elem[0]);
+    if (params.error) {
+	elem.replaceWith($("<em></em>").text(params.error));
+	return;
+    }
+    var newElem = $(content).insertBefore(elem);
+    newElem.find('.gterm-click').bindclick(gtermPageletClickHandler);
+    newElem.find('img.gterm-drag').bind("dragstart", function(evt) {evt.preventDefault();});
+    GTDropBindings(newElem.find('.droppable'));
+    if (params.page >= params.pages) {
+	elem.remove();
+    } else {
+	elem.removeClass("gterm-pagerequested").attr("data-gtermpage", params.page+1);
+	elem.text("More (page "+(params.page+1)+" of "+params.pages+")");
+	if (gPageMoreObserver)
+	    gPageMoreObserver.observe(elem[0]);
+    }
+}
+
 function GTDropBindings(elem) {
     //console.log("GTDropBindings", elem);
     if (!elem.length)
@@ -5231,41 +5300,288 @@ function GTFileDropHandler(target) {
 	return;
     }
     var file = this.files[0];
+    if (gExpectUpload) {
+	var chunked = gExpectUpload.chunked;
+	gExpectUpload = null;
+	GTTransmitFile(file, chunked);
+    } else {
+	gUploadFile = file;
+    }
+}
+
+function GTTransmitFile(file, chunked) {
+    // If chunked, only file info is transmitted; chunks are transmitted on request (GTUploadChunk)
+    gExpectUpload = null;
+    gUploadFile = null;
+    gUploadChunked = null;
+    $("#session-bufscreen .gterm-upload").remove();
+    console.log("GTTransmitFile:", file.name, file.type, file.size, chunked);
+    if (!gWebSocket || !gParams.controller)
+	return;
+    if (chunked) {
+	gUploadChunked = {id: "u"+Date.now()+"-"+Math.floor(Math.random()*1000000), file: file};
+	gWebSocket.write([["save_data", {x_gterm_filepath: file.name,
+					 content_type: file.type,
+					 content_length: 0,
+					 x_gterm_location: "remote",
+					 x_gterm_upload: {id: gUploadChunked.id, size: file.size,
+							  mtime: file.lastModified || 0}}, ""]]);
+	return;
+    }
+
     var reader = new FileReader();
     reader.onload = function(evt) {
 	var arr_buffer = evt.target.result;
-	if (gExpectUpload) {
-	    gExpectUpload = null;
-	    GTTransmitFile(file.name, file.type, arr_buffer);
-	} else {
-	    gUploadFile = [file.name, file.type, arr_buffer];
-	}
+	gWebSocket.write([["save_data", {x_gterm_filepath: file.name,
+					 content_type: file.type,
+					 content_length: arr_buffer.byteLength,
+					 x_gterm_location: "remote"}, null]]);
+	gWebSocket.write(arr_buffer);
     };
 
     reader.onerror = function(evt) {
 	alert("Failed to read file "+file.name+" (code="+evt.target.error.code+")");
+	GTUploadCancel(null);
     };
 
     reader.readAsArrayBuffer(file);
 }
 
-function GTTransmitFile(filename, mimetype, arr_buffer) {
-    gExpectUpload = null;
-    gUploadFile = null;
-    $("#session-bufscreen .gterm-upload").remove();
-    console.log("GTTransmitFile:", filename, mimetype, arr_buffer.byteLength);
-    if (gWebSocket && gParams.controller) {
-	gWebSocket.write([["save_data", {x_gterm_filepath: filename,
-					 content_type: mimetype,
-					 content_length: arr_buffer.byteLength,
-					 x_gterm_location: "remote"}, null]]);
+function GTUploadChunk(params) {
+    // Transmit requested chunk of file being uploaded (via pty, or bulk transfer socket)
+    var save_params = {x_gterm_location: params.bulk ? "bulk" : "remote",
+		       x_gterm_upload: params.upload,
+		       x_gterm_offset: params.offset};
+    if (!gUploadChunked || gUploadChunked.id != params.upload) {
+	if (!params.done) {
+	    save_params.x_gterm_error = "Upload file not available";
+	    gWebSocket.write([["save_data", save_params, ""]]);
+	}
+	return;
+    }
+    if (params.done) {
+	gUploadChunked = null;
+	return;
+    }
+    var reader = new FileReader();
+    reader.onload = function(evt) {
+	var arr_buffer = evt.target.result;
+	save_params.content_length = arr_buffer.byteLength;
+	gWebSocket.write([["save_data", save_params, null]]);
 	gWebSocket.write(arr_buffer);
+    };
+
+    reader.onerror = function(evt) {
+	save_params.x_gterm_error = "Failed to read file (code="+evt.target.error.code+")";
+	gWebSocket.write([["save_data", save_params, ""]]);
+    };
+
+    reader.readAsArrayBuffer(gUploadChunked.file.slice(params.offset, params.offset+params.size));
+}
+
+var MD5_SHIFTS = new Int32Array([7,12,17,22, 5,9,14,20, 4,11,16,23, 6,10,15,21]);
+var MD5_CONSTANTS = null;
+var MD5_INDEX = null;
+
+function GTMD5Hex(buffer) {
+    // Return MD5 hex digest of ArrayBuffer (for verifying downloaded chunks)
+    if (!MD5_CONSTANTS) {
+	MD5_CONSTANTS = new Int32Array(64);
+	MD5_INDEX = new Int32Array(64);
+	for (var j=0; j<64; j++) {
+	    MD5_CONSTANTS[j] = (Math.abs(Math.sin(j+1))*4294967296)|0;
+	    MD5_INDEX[j] = [j, (5*j+1) % 16, (3*j+5) % 16, (7*j) % 16][j>>4];
+	}
     }
+
+    // (Copy to padded buffer, viewed as little-endian words)
+    var nbytes = buffer.byteLength;
+    var nwords = (((nbytes+8) >>> 6) + 1) * 16;
+    var padded = new Uint8Array(4*nwords);
+    padded.set(new Uint8Array(buffer));
+    padded[nbytes] = 0x80;
+    var words = new Int32Array(padded.buffer);
+    words[nwords-2] = (nbytes*8)|0;
+    words[nwords-1] = Math.floor(nbytes/0x20000000);
+
+    var a = 1732584193, b = -271733879, c = -1732584194, d = 271733878;
+    for (var offset=0; offset<nwords; offset+=16) {
+	var aa = a, bb = b, cc = c, dd = d;
+	for (var k=0; k<64; k++) {
+	    var f;
+	    if (k < 16)
+		f = (bb & cc) | (~bb & dd);
+	    else if (k < 32)
+		f = (dd & bb) | (~dd & cc);
+	    else if (k < 48)
+		f = bb ^ cc ^ dd;
+	    else
+		f = cc ^ (bb | ~dd);
+	    var shift = MD5_SHIFTS[((k>>4)<<2) | (k&3)];
+	    var x = (aa + f + MD5_CONSTANTS[k] + words[offset+MD5_INDEX[k]])|0;
+	    aa = dd;
+	    dd = cc;
+	    cc = bb;
+	    bb = (bb + ((x << shift) | (x >>> (32-shift))))|0;
+	}
+	a = (a+aa)|0;
+	b = (b+bb)|0;
+	c = (c+cc)|0;
+	d = (d+dd)|0;
+    }
+
+    var hex = "";
+    var state = [a, b, c, d];
+    for (var j=0; j<4; j++) {
+	for (var k=0; k<4; k++)
+	    hex += ("0" + ((state[j] >>> (8*k)) & 255).toString(16)).slice(-2);
+    }
+    return hex;
+}
+
+function GTChunkedDownload(evt) {
+    // Download large file in byte range chunks, using parallel requests (retrying failed or corrupted chunks).
+    // Chunks are streamed to disk if the browser supports the File System Access API;
+    // otherwise, they are assembled in memory, for files up to DOWNLOAD_MAX_MEMORY_BYTES.
+    // (Interrupted downloads are not resumed; use gcp for resumable copying)
+    var elem = $(this);
+    var filename = elem.attr("download");
+    var size = parseInt(elem.attr("data-gtermsize"));
+    if (elem.hasClass("gterm-downloading"))
+	return GTPreventHandler(evt);
+
+    if (window.showSaveFilePicker) {
+	elem.addClass("gterm-downloading");
+	window.showSaveFilePicker({suggestedName: filename}).then(function(handle) {
+	    return handle.createWritable();
+	}).then(function(writable) {
+	    GTDownloadChunks(elem, writable);
+	}, function(err) {
+	    elem.removeClass("gterm-downloading");
+	    if (err.name != "AbortError")
+		alert("Failed to save "+filename+": "+err);
+	});
+    } else if (size > DOWNLOAD_MAX_MEMORY_BYTES) {
+	alert("File "+filename+" is too large to download in this browser (limit "+Math.floor(DOWNLOAD_MAX_MEMORY_BYTES/1048576)+" MB); use gcp to copy it");
+    } else {
+	elem.addClass("gterm-downloading");
+	GTDownloadChunks(elem, null);
+    }
+    return GTPreventHandler(evt);
+}
+
+function GTDownloadChunks(elem, writable) {
+    // Fetch chunks for download link, writing them to writable stream (if not null) or saving assembled blob
+    var url = elem.attr("href");
+    var filename = elem.attr("download");
+    var size = parseInt(elem.attr("data-gtermsize"));
+    var label = elem.text();
+
+    var nchunks = Math.ceil(size/DOWNLOAD_CHUNK_BYTES);
+    var parts = writable ? null : new Array(nchunks);
+    var writeChain = writable ? Promise.resolve() : null;
+    var retries = {};
+    var next = 0;
+    var completed = 0;
+    var failed = false;
+
+    function fetchChunk(index) {
+	var start = index*DOWNLOAD_CHUNK_BYTES;
+	var end = Math.min(size, start+DOWNLOAD_CHUNK_BYTES) - 1;
+	var xhr = new XMLHttpRequest();
+	xhr.open("GET", url, true);
+	xhr.responseType = "arraybuffer";
+	xhr.setRequestHeader("Range", "bytes="+start+"-"+end);
+	xhr.onload = function() {
+	    if (failed)
+		return;
+	    var digest = xhr.getResponseHeader("X-Gterm-Digest");
+	    if (xhr.status != 206 || xhr.response.byteLength != end-start+1 ||
+		(digest && digest != GTMD5Hex(xhr.response))) {
+		retryChunk(index);
+	    } else if (writable) {
+		// Write chunks in sequence (limiting buffered chunks to the number of parallel requests)
+		var data = xhr.response;
+		writeChain = writeChain.then(function() {
+		    return writable.write({type: "write", position: start, data: data});
+		}).then(function() {
+		    completeChunk();
+		}, function(err) {
+		    failDownload(""+err);
+		});
+	    } else {
+		parts[index] = xhr.response;
+		completeChunk();
+	    }
+	};
+	xhr.onerror = function() { retryChunk(index); };
+	xhr.send();
+    }
+
+    function retryChunk(index) {
+	retries[index] = (retries[index] || 0) + 1;
+	if (retries[index] <= DOWNLOAD_MAX_RETRIES)
+	    fetchChunk(index);
+	else
+	    failDownload("");
+    }
+
+    function completeChunk() {
+	completed += 1;
+	elem.text(label+" ("+Math.floor(100*completed/nchunks)+"%)");
+	nextChunk();
+    }
+
+    function failDownload(errmsg) {
+	if (failed)
+	    return;
+	failed = true;
+	parts = null;
+	if (writable)
+	    writable.abort();
+	elem.removeClass("gterm-downloading").text(label);
+	alert("Failed to download "+filename+(errmsg ? ": "+errmsg : ""));
+    }
+
+    function nextChunk() {
+	if (failed)
+	    return;
+	if (next < nchunks) {
+	    fetchChunk(next++);
+	} else if (completed == nchunks) {
+	    if (writable) {
+		writable.close().then(function() {
+		    elem.removeClass("gterm-downloading").text(label);
+		}, function(err) {
+		    failDownload(""+err);
+		});
+		return;
+	    }
+	    var blobURL = URL.createObjectURL(new Blob(parts, {type: "application/octet-stream"}));
+	    var link = $('<a style="display: none;"></a>').attr({href: blobURL, download: filename}).appendTo("body");
+	    link[0].click();
+	    link.remove();
+	    parts = null;
+	    setTimeout(function() {URL.revokeObjectURL(blobURL);}, 60000);
+	    elem.removeClass("gterm-downloading").text(label);
+	}
+    }
+
+    for (var j=0; j<DOWNLOAD_STREAMS; j++)
+	nextChunk();
 }
 
 function GTUploadCancel(evt) {
     console.log("GTUploadCancel");
-    GTTransmitFile("", "none/none", "");
+    gExpectUpload = null;
+    gUploadFile = null;
+    $("#session-bufscreen .gterm-upload").remove();
+    if (gWebSocket && gParams.controller) {
+	gWebSocket.write([["save_data", {x_gterm_filepath: "",
+					 content_type: "none/none",
+					 x_gterm_location: "remote"}, null]]);
+	gWebSocket.write("");
+    }
 }
 
 function ScrollEventHandler(event) {
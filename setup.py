@@ -38,6 +38,7 @@ setup(name="graphterm",
                                        "gtermhost = graphterm.gtermhost:main",
                                        "gterm_setup = graphterm.gterm_setup:main",
                                        "gotrace = graphterm.gotrace:main",
+                                       "otracecat = graphterm.otracecat:main",
                                        "glandslide = graphterm.bin.landslide.main:main",
                                        "gtutor = graphterm.bin.pytutor.gtutor:main",
                                        ]},